@@ -1,6 +1,7 @@
 from django.contrib import admin
 from h1ds_core.models import H1DSSignal, H1DSSignalInstance, Worksheet
 from h1ds_core.models import UserSignal, Node, Filter, FilterDtype, FilterDim
+from h1ds_core.models import ShotNode
 
 class H1DSSignalAdmin(admin.ModelAdmin):
     pass
@@ -28,6 +29,11 @@ class NodeAdmin(admin.ModelAdmin):
 
 admin.site.register(Node, NodeAdmin)
 
+class ShotNodeAdmin(admin.ModelAdmin):
+    pass
+
+admin.site.register(ShotNode, ShotNodeAdmin)
+
 class FilterAdmin(admin.ModelAdmin):
     prepopulated_fields = {"slug": ("name",)}
 
@@ -0,0 +1,490 @@
+"""Data backend for HDF5, npz and npy files.
+
+Shots are read from per-shot files in H1DS_DATAFILE_DIR, with a
+subdirectory for each tree:
+
+    <H1DS_DATAFILE_DIR>/<tree>/<shot>.h5    HDF5 file (requires h5py)
+    <H1DS_DATAFILE_DIR>/<tree>/<shot>.npz   numpy zip archive
+    <H1DS_DATAFILE_DIR>/<tree>/<shot>/      directory of .npy files
+
+Groups (HDF5),  path prefixes of  archive members (npz) and directories
+(npy) are  tree nodes, and  datasets or arrays are  nodes with data. In
+HDF5  files a  dataset's  dimension is  the  dataset named  by its
+'dimension' attribute, and units are given by 'units' attributes. In npz
+archives and npy directories the dimension of <name> is stored as
+<name>.dim. Signals without a dimension are indexed by sample number.
+
+Arrays are not read into memory when they can be memory-mapped, i.e.
+uncompressed npz members, npy files and contiguous HDF5 datasets, so
+filters which slice the data read only the slices they use. Chunked or
+compressed HDF5 datasets are read through h5py.
+
+"""
+import os
+import glob
+import struct
+import hashlib
+import datetime
+import threading
+import zipfile
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from h1ds_core.base import BaseNodeData
+from h1ds_core.base import BaseDataTreeManager
+from h1ds_core.base import BaseBackendShotManager
+from h1ds_core.base import no_data_metadata
+
+datafile_dir = settings.H1DS_DATAFILE_DIR
+
+# Trees to read; by default every subdirectory of H1DS_DATAFILE_DIR.
+if hasattr(settings, "H1DS_DATAFILE_TREES"):
+    datafile_trees = settings.H1DS_DATAFILE_TREES
+else:
+    datafile_trees = None
+
+DIMENSION_SUFFIX = '.dim'
+
+if h5py is None:
+    hdf5_extensions = ()
+else:
+    hdf5_extensions = ('.h5', '.hdf5')
+
+def read_npy_header(fileobj):
+    """Read the header of a .npy stream, returning (shape, dtype, order)."""
+    version = np.lib.format.read_magic(fileobj)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fileobj)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fileobj)
+    return shape, dtype, 'F' if fortran_order else 'C'
+
+def memmap_npy(filename, offset=0):
+    """Memory-map a .npy array starting at offset in filename."""
+    with open(filename, 'rb') as npy_file:
+        npy_file.seek(offset)
+        shape, dtype, order = read_npy_header(npy_file)
+        offset = npy_file.tell()
+    if dtype.hasobject:
+        raise ValueError("Can't memory-map object arrays.")
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order=order)
+
+class ShotFile(object):
+    """Access to the nodes of one tree for one shot.
+
+    Nodes are addressed by a list of names below the tree root.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def get_paths(self):
+        """Get the paths (as tuples of names) of all nodes with data.
+
+        Override this with file format subclass.
+
+        """
+        pass
+
+    def list_children(self, parts):
+        """Get the names of a node's children.
+
+        Override this with file format subclass.
+
+        """
+        pass
+
+    def is_signal(self, parts):
+        """Return True if a node has data.
+
+        Override this with file format subclass.
+
+        """
+        pass
+
+    def get_info(self, parts):
+        """Get (shape, dtype) of a node's data without reading it.
+
+        Override this with file format subclass.
+
+        """
+        pass
+
+    def get_array(self, parts):
+        """Get a node's data as an array.
+
+        Override this with file format subclass.
+
+        """
+        pass
+
+    def get_dimension(self, parts):
+        """Get the dimension of a node's data, or None."""
+        return None
+
+    def get_units(self, parts):
+        """Get (value units, dimension units)."""
+        return "", ""
+
+    def get_structure_fingerprint(self):
+        paths = sorted("/".join(p) for p in self.get_paths())
+        return hashlib.sha1("\n".join(paths)).hexdigest()
+
+    def close(self):
+        pass
+
+class ArrayShotFile(ShotFile):
+    """Base for npz and npy layouts, which list arrays by path."""
+    def __init__(self, filename):
+        super(ArrayShotFile, self).__init__(filename)
+        self.paths = set(p for p in self.get_paths()
+                         if not p[-1].endswith(DIMENSION_SUFFIX))
+        self.groups = set(p[:i] for p in self.paths for i in range(len(p)))
+
+    def list_children(self, parts):
+        parts = tuple(parts)
+        return sorted(set(p[len(parts)] for p in self.paths | self.groups
+                          if len(p) > len(parts) and p[:len(parts)] == parts))
+
+    def is_signal(self, parts):
+        return tuple(parts) in self.paths
+
+    def get_dimension(self, parts):
+        dim_parts = tuple(parts[:-1]) + (parts[-1] + DIMENSION_SUFFIX,)
+        try:
+            return self.get_array(dim_parts)
+        except KeyError:
+            return None
+
+class NpzShotFile(ArrayShotFile):
+    def __init__(self, filename):
+        self.zip_file = zipfile.ZipFile(filename)
+        super(NpzShotFile, self).__init__(filename)
+
+    def get_paths(self):
+        return [tuple(name[:-len('.npy')].split('/'))
+                for name in self.zip_file.namelist() if name.endswith('.npy')]
+
+    def _get_member(self, parts):
+        return self.zip_file.getinfo('/'.join(parts) + '.npy')
+
+    def get_info(self, parts):
+        member_file = self.zip_file.open(self._get_member(parts))
+        try:
+            shape, dtype, order = read_npy_header(member_file)
+        finally:
+            member_file.close()
+        return shape, dtype
+
+    def get_array(self, parts):
+        member = self._get_member(parts)
+        if member.compress_type == zipfile.ZIP_STORED:
+            # Data of uncompressed members start after the local file
+            # header, whose name and extra field lengths are at byte 26.
+            with open(self.filename, 'rb') as npz_file:
+                npz_file.seek(member.header_offset + 26)
+                name_length, extra_length = struct.unpack('<HH', npz_file.read(4))
+            offset = member.header_offset + 30 + name_length + extra_length
+            try:
+                return memmap_npy(self.filename, offset)
+            except ValueError:
+                pass
+        member_file = self.zip_file.open(member)
+        try:
+            return np.lib.format.read_array(member_file)
+        finally:
+            member_file.close()
+
+    def close(self):
+        self.zip_file.close()
+
+class NpyShotFile(ArrayShotFile):
+    def get_paths(self):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.filename):
+            rel_dir = os.path.relpath(dirpath, self.filename)
+            dir_parts = () if rel_dir == '.' else tuple(rel_dir.split(os.sep))
+            paths.extend(dir_parts + (f[:-len('.npy')],)
+                         for f in filenames if f.endswith('.npy'))
+        return paths
+
+    def _get_npy_filename(self, parts):
+        filename = os.path.join(self.filename, *parts) + '.npy'
+        if not os.path.exists(filename):
+            raise KeyError(parts)
+        return filename
+
+    def get_info(self, parts):
+        with open(self._get_npy_filename(parts), 'rb') as npy_file:
+            shape, dtype, order = read_npy_header(npy_file)
+        return shape, dtype
+
+    def get_array(self, parts):
+        return np.load(self._get_npy_filename(parts), mmap_mode='r')
+
+class HDF5ShotFile(ShotFile):
+    def __init__(self, filename):
+        super(HDF5ShotFile, self).__init__(filename)
+        self.h5_file = h5py.File(filename, 'r')
+
+    def _get_item(self, parts):
+        if not parts:
+            return self.h5_file
+        return self.h5_file['/'.join(parts)]
+
+    def get_paths(self):
+        paths = []
+        def add_dataset(name, item):
+            if isinstance(item, h5py.Dataset):
+                paths.append(tuple(name.split('/')))
+        self.h5_file.visititems(add_dataset)
+        return paths
+
+    def get_structure_fingerprint(self):
+        """Checksum of the paths of all groups and datasets.
+
+        Groups are  tree nodes even  when they hold no datasets, so they
+        are included, marked with a trailing slash.
+        """
+        names = []
+        def add_item(name, item):
+            if isinstance(item, h5py.Group):
+                name += '/'
+            names.append(name)
+        self.h5_file.visititems(add_item)
+        return hashlib.sha1("\n".join(sorted(names))).hexdigest()
+
+    def list_children(self, parts):
+        item = self._get_item(parts)
+        if isinstance(item, h5py.Dataset):
+            return []
+        return sorted(item.keys())
+
+    def is_signal(self, parts):
+        return isinstance(self._get_item(parts), h5py.Dataset)
+
+    def get_info(self, parts):
+        dataset = self._get_item(parts)
+        return dataset.shape, dataset.dtype
+
+    def _read_dataset(self, dataset):
+        """Memory-map a dataset if it is stored contiguously, else read it."""
+        offset = None
+        if dataset.chunks is None and dataset.compression is None:
+            offset = dataset.id.get_offset()
+        if offset is None or dataset.dtype.hasobject:
+            return dataset[()]
+        return np.memmap(self.filename, dtype=dataset.dtype, mode='r',
+                         offset=offset, shape=dataset.shape)
+
+    def get_array(self, parts):
+        return self._read_dataset(self._get_item(parts))
+
+    def _get_dimension_dataset(self, parts):
+        dataset = self._get_item(parts)
+        dim_name = dataset.attrs.get('dimension')
+        if dim_name is None:
+            return None
+        # Relative names are siblings of the dataset.
+        return dataset.parent[dim_name]
+
+    def get_dimension(self, parts):
+        dim_dataset = self._get_dimension_dataset(parts)
+        if dim_dataset is None:
+            return None
+        return self._read_dataset(dim_dataset)
+
+    def get_units(self, parts):
+        value_units = self._get_item(parts).attrs.get('units', "")
+        dim_dataset = self._get_dimension_dataset(parts)
+        if dim_dataset is None:
+            return value_units, ""
+        return value_units, dim_dataset.attrs.get('units', "")
+
+    def close(self):
+        self.h5_file.close()
+
+def find_shot_file(tree, shot_number):
+    """Get the filename and ShotFile class for a shot, or (None, None)."""
+    base_name = os.path.join(datafile_dir, tree, str(shot_number))
+    for extension in hdf5_extensions:
+        if os.path.exists(base_name + extension):
+            return base_name + extension, HDF5ShotFile
+    if os.path.exists(base_name + '.npz'):
+        return base_name + '.npz', NpzShotFile
+    if os.path.isdir(base_name):
+        return base_name, NpyShotFile
+    return None, None
+
+# Open files are not shared between threads.
+_open_files = threading.local()
+max_open_files = 16
+
+def get_shot_file(tree, shot_number):
+    """Get an open ShotFile, reusing it within each thread.
+
+    Raises ObjectDoesNotExist if there is no file for the shot.
+    """
+    if not hasattr(_open_files, 'files'):
+        _open_files.files = {}
+    key = (tree, shot_number)
+    if not key in _open_files.files:
+        filename, shot_file_class = find_shot_file(tree, shot_number)
+        if filename is None:
+            raise ObjectDoesNotExist
+        if len(_open_files.files) >= max_open_files:
+            for shot_file in _open_files.files.values():
+                shot_file.close()
+            _open_files.files.clear()
+        _open_files.files[key] = shot_file_class(filename)
+    return _open_files.files[key]
+
+def list_shot_numbers(tree):
+    """Get the shot numbers for which a tree has files."""
+    shot_numbers = []
+    for path in glob.glob(os.path.join(datafile_dir, tree, '*')):
+        name, extension = os.path.splitext(os.path.basename(path))
+        if extension in hdf5_extensions + ('.npz', '') and name.isdigit():
+            shot_numbers.append(int(name))
+    return sorted(shot_numbers)
+
+class NodeData(BaseNodeData):
+
+    def _get_file_path(self):
+        """Get (tree, [name, name, ...]) for this node."""
+        node_ancestors = self.get_ancestry()
+        return node_ancestors[0].path, [n.path for n in node_ancestors[1:]]
+
+    def _get_shot_file(self):
+        tree, parts = self._get_file_path()
+        return get_shot_file(tree, self.shot_id), parts
+
+    def _is_signal(self):
+        if self.level == 0:
+            return False
+        try:
+            shot_file, parts = self._get_shot_file()
+            return shot_file.is_signal(parts)
+        except (ObjectDoesNotExist, KeyError):
+            return False
+
+    def _read_array(self):
+        if not hasattr(self, '_array'):
+            shot_file, parts = self._get_shot_file()
+            self._array = shot_file.get_array(parts)
+        return self._array
+
+    def get_name(self):
+        tree, parts = self._get_file_path()
+        return "/".join([tree] + parts)
+
+    def get_value(self):
+        if not self._is_signal():
+            return [None]
+        value = self._read_array()
+        if value.ndim == 0:
+            return [value[()]]
+        elif value.ndim == 1:
+            # A view, so memory-mapped data stay on disk.
+            return value[np.newaxis]
+        else:
+            return value
+
+    def get_dimension(self):
+        if not self._is_signal():
+            return []
+        value = self._read_array()
+        if value.ndim == 0:
+            return []
+        shot_file, parts = self._get_shot_file()
+        dimension = shot_file.get_dimension(parts)
+        if dimension is None:
+            dimension = np.arange(value.shape[-1])
+        return [dimension]
+
+    def get_value_units(self):
+        if not self._is_signal():
+            return ""
+        shot_file, parts = self._get_shot_file()
+        return shot_file.get_units(parts)[0]
+
+    def get_dimension_units(self):
+        if not self._is_signal():
+            return ""
+        shot_file, parts = self._get_shot_file()
+        return shot_file.get_units(parts)[1]
+
+    def get_value_dtype(self):
+        if not self._is_signal():
+            return ""
+        return str(self._read_array().dtype)
+
+    def get_dimension_dtype(self):
+        dimension = self.get_dimension()
+        if len(dimension) == 0:
+            return ""
+        return str(dimension[0].dtype)
+
+    def get_data_metadata(self):
+        """Summarise node data from array headers, without reading data.
+
+        As in get_dimension, (channels, samples) arrays have one
+        dimension shared by all channels.
+        """
+        if not self._is_signal():
+            return dict(no_data_metadata)
+        shot_file, parts = self._get_shot_file()
+        shape, dtype = shot_file.get_info(parts)
+        if len(shape) == 0:
+            return {'has_data':True, 'n_dimensions':0,
+                    'dtype':"", 'n_channels':1}
+        return {'has_data':True,
+                'n_dimensions':1,
+                'dtype':str(dtype),
+                'n_channels':1 if len(shape) == 1 else shape[0]}
+
+    def get_child_names_from_primary_source(self):
+        try:
+            shot_file, parts = self._get_shot_file()
+            return shot_file.list_children(parts)
+        except (ObjectDoesNotExist, KeyError):
+            return []
+
+class DataTreeManager(BaseDataTreeManager):
+    def get_trees(self):
+        if datafile_trees is not None:
+            return datafile_trees
+        return sorted(d for d in os.listdir(datafile_dir)
+                      if os.path.isdir(os.path.join(datafile_dir, d)))
+
+    def get_structure_fingerprint(self, tree, shot_number):
+        """Checksum of the paths of all arrays in the shot file."""
+        try:
+            return get_shot_file(tree, shot_number).get_structure_fingerprint()
+        except ObjectDoesNotExist:
+            return None
+
+class DataFileShotManager(BaseBackendShotManager):
+
+    tree_manager = DataTreeManager()
+
+    def get_latest_shot(self):
+        default_tree = self.tree_manager.get_trees()[0]
+        shot_numbers = list_shot_numbers(default_tree)
+        if not shot_numbers:
+            return None
+        return shot_numbers[-1]
+
+    def get_timestamp_for_shot(self, shot):
+        """Modification time of the shot's file in the first tree."""
+        default_tree = self.tree_manager.get_trees()[0]
+        filename, shot_file_class = find_shot_file(default_tree, shot)
+        if filename is None:
+            return datetime.datetime.now()
+        return datetime.datetime.fromtimestamp(os.path.getmtime(filename))
@@ -1,8 +1,8 @@
 """H1 backend."""
 
 from datetime import datetime
-import MDSplus
 from h1ds_core.backends import mdsplus
+from h1ds_core.backends.mdsplus import MDSplus
 
 class NodeData(mdsplus.NodeData):
     pass
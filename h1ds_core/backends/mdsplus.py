@@ -1,22 +1,66 @@
 """Module for communicating with MDSplus backend."""
 
 import os
+import time
+import hashlib
+import threading
 import numpy as np
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 
-import MDSplus
-from MDSplus import TdiException
-from MDSplus._treeshr import TreeNoDataException, TreeException
-
 # TODO: base vs models - it's not intuitive what should be where...
 from h1ds_core.base import BaseNodeData
 from h1ds_core.base import BaseDataTreeManager
 from h1ds_core.base import BaseBackendShotManager
+from h1ds_core.base import no_data_metadata
+from h1ds_core.utils import LazyModule
+
+# MDSplus is slow to import, so is only imported when first used.
+MDSplus = LazyModule('MDSplus')
+_treeshr = LazyModule('MDSplus._treeshr')
 # Load MDS trees into environment
 for config_tree in settings.EXTRA_MDS_TREES:
     os.environ[config_tree[0]+"_path"] = config_tree[1]
 
+# MDSplus tree handles are not shared between threads.
+_open_trees = threading.local()
+max_open_trees = 16
+
+# Seconds an open tree is reused for before it is opened again, so data
+# written to a shot after it was opened (e.g. when a shot is ingested
+# again) are seen.
+if hasattr(settings, "H1DS_MDS_TREE_MAX_AGE"):
+    max_tree_age = settings.H1DS_MDS_TREE_MAX_AGE
+else:
+    max_tree_age = 60
+
+def get_mds_tree(tree, shot):
+    """Get an open MDSplus tree, reusing handles within each thread.
+
+    Each thread keeps up to max_open_trees trees, each for at most
+    max_tree_age seconds.
+    """
+    if not hasattr(_open_trees, 'trees'):
+        _open_trees.trees = {}
+    key = (tree, shot)
+    now = time.time()
+    if key in _open_trees.trees:
+        mds_tree, opened = _open_trees.trees[key]
+        if now - opened <= max_tree_age:
+            return mds_tree
+        del _open_trees.trees[key]
+    if len(_open_trees.trees) >= max_open_trees:
+        _open_trees.trees.clear()
+    mds_tree = MDSplus.Tree(tree, shot)
+    _open_trees.trees[key] = (mds_tree, now)
+    return mds_tree
+
+def close_mds_trees(shot):
+    """Drop this thread's open trees for a shot."""
+    for key in getattr(_open_trees, 'trees', {}).keys():
+        if key[1] == shot:
+            del _open_trees.trees[key]
+
 
 class NodeData(BaseNodeData):
 
@@ -25,7 +69,7 @@ class NodeData(BaseNodeData):
 
         Node ancestry is [tree, node0, node1, ...].
         """
-        node_ancestors = list(self.get_ancestors(include_self=True))
+        node_ancestors = self.get_ancestry()
         # force str rather than unicode. unicode hits mds bug?
         # not tested since refactor, so casting to str may not be required.
         mds_tree = str(node_ancestors[0].path)
@@ -35,22 +79,33 @@ class NodeData(BaseNodeData):
         return self.shot.number, mds_tree, mds_path
     
     def _get_mds_node(self):
-        """Get the corresponding MDSplus node for this H1DS tree node."""
-        
-        if not hasattr(self, '_mds_node'):
-            shot, tree, path = self._get_mds_node_info()
-            try:
-                mds_tree = MDSplus.Tree(tree, shot)
-            except TreeException:
-                # Tree doesn't exist for this shot.
-                # Raise django exception, rather than backend specific
-                # exception
-                raise ObjectDoesNotExist
-            if path == "":
-                self._mds_node = mds_tree.getDefault()
-            else:
-                self._mds_node = mds_tree.getNode(path)
-        return self._mds_node
+        """Get the corresponding MDSplus node for this H1DS tree node.
+
+        MDSplus nodes belong to the tree  handle of the thread which opened
+        them, so the node is looked up again if it is used from another
+        thread, or if the thread's tree has since been reopened.
+
+        """
+        if not hasattr(self, '_mds_node_info'):
+            self._mds_node_info = self._get_mds_node_info()
+        shot, tree, path = self._mds_node_info
+        try:
+            mds_tree = get_mds_tree(tree, shot)
+        except _treeshr.TreeException:
+            # Tree doesn't exist for this shot.
+            # Raise django exception, rather than backend specific
+            # exception
+            raise ObjectDoesNotExist
+        thread_id = threading.current_thread().ident
+        cached = getattr(self, '_mds_node', None)
+        if cached is not None and cached[0] == thread_id and cached[1] is mds_tree:
+            return cached[2]
+        if path == "":
+            mds_node = mds_tree.getDefault()
+        else:
+            mds_node = mds_tree.getNode(path)
+        self._mds_node = (thread_id, mds_tree, mds_node)
+        return mds_node
 
     def get_name(self):
         node = self._get_mds_node()
@@ -62,7 +117,7 @@ class NodeData(BaseNodeData):
         mds_node = self._get_mds_node()
         try:
             primary_data = mds_node.getData().data()
-        except (TreeNoDataException, TdiException, AttributeError):
+        except (_treeshr.TreeNoDataException, MDSplus.TdiException, AttributeError):
             primary_data = None
         if np.isscalar(primary_data) or primary_data == None:
             return [primary_data]
@@ -85,7 +140,7 @@ class NodeData(BaseNodeData):
                 for i in range(len(shape)):
                     dim_list.append(mds_node.getDimensionAt(i).data())
                 raw_dim = np.array(dim_list)
-        except TdiException:
+        except MDSplus.TdiException:
             raw_dim = []#np.array([])
         return raw_dim
 
@@ -110,7 +165,7 @@ class NodeData(BaseNodeData):
                 for i in range(len(shape)):
                     units_list.append(mds_node.getDimensionAt(i).getUnits())
                 dim_units = units_list
-        except TdiException:
+        except MDSplus.TdiException:
             dim_units = ""
         return dim_units
         
@@ -133,6 +188,36 @@ class NodeData(BaseNodeData):
        
     def get_metadata(self):
         return {}    
+
+    def get_data_metadata(self):
+        """Summarise node data without reading dimensions or units.
+
+        Empty nodes are detected from the record length, which MDSplus
+        reads from the  record header without decoding  any data. Only
+        the value is decoded for nodes which have data.
+
+        """
+        if self.level == 0:
+            return dict(no_data_metadata)
+        try:
+            mds_node = self._get_mds_node()
+            if mds_node.getLength() == 0:
+                return dict(no_data_metadata)
+            primary_data = mds_node.getData().data()
+        except (ObjectDoesNotExist, _treeshr.TreeNoDataException,
+                _treeshr.TreeException, MDSplus.TdiException, AttributeError):
+            return dict(no_data_metadata)
+        if primary_data is None:
+            return dict(no_data_metadata)
+        if np.isscalar(primary_data):
+            # Scalars are stored as [value], which has no dtype.
+            return {'has_data':True, 'n_dimensions':0,
+                    'dtype':"", 'n_channels':1}
+        shape = primary_data.shape
+        return {'has_data':True,
+                'n_dimensions':len(shape),
+                'dtype':str(primary_data.dtype),
+                'n_channels':1 if len(shape) == 1 else shape[0]}
     
     def get_child_names_from_primary_source(self):
         try:
@@ -156,6 +241,30 @@ class DataTreeManager(BaseDataTreeManager):
         tree_names = [i[0] for i in settings.EXTRA_MDS_TREES]
         return tree_names
 
+    def build_shot_tree(self, shot):
+        """Build the data trees for a shot from freshly opened trees.
+
+        Trees this thread already has open for the shot may predate data
+        now in the shot, e.g. if it is being ingested again.
+        """
+        close_mds_trees(shot.number)
+        return super(DataTreeManager, self).build_shot_tree(shot)
+
+    def get_structure_fingerprint(self, tree, shot_number):
+        """Checksum of the full paths of all nodes in an MDSplus tree.
+
+        The node list is read with a single wildcard lookup, which is much
+        cheaper than walking getDescendants() for every node.
+
+        """
+        try:
+            mds_tree = get_mds_tree(str(tree), shot_number)
+            mds_nodes = mds_tree.getNodeWild("***")
+        except _treeshr.TreeException:
+            return None
+        full_paths = "\n".join(str(n.getFullPath()) for n in mds_nodes)
+        return hashlib.sha1(full_paths).hexdigest()
+
     def populate_shot(self, shot_root_node):
         for tree_name in self.get_trees():
             node = self.model(path=tree_name, parent=shot_root_node)
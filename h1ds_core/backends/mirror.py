@@ -0,0 +1,284 @@
+"""Data backend serving finished shots from a local mirror.
+
+Wraps the backend named by H1DS_MIRROR_PRIMARY_BACKEND (e.g. the H1 or
+MDSplus backend). To use, set
+
+    H1DS_DATA_BACKEND = "h1ds_core.backends.mirror"
+    H1DS_MIRROR_PRIMARY_BACKEND = "h1ds_core.backends.h1"
+    H1DS_MIRROR_DIR = "/path/to/mirror"
+
+Shots are read from the primary backend until they are finalized (see
+Shot.is_finalized), after which the  primary data of  every node with
+data are copied into one HDF5 file per shot in H1DS_MIRROR_DIR. Arrays
+are  stored in chunked,  compressed datasets,  one group per  node keyed
+by path checksum. Once a shot's file exists, nodes read their primary
+data from it instead of the primary backend.
+
+Finalized shots are mirrored in a background thread the first time one
+of their nodes is read (unless H1DS_MIRROR_ON_READ is False); historical
+shots can be mirrored and checked with the mirror_shots command.
+
+"""
+import os
+import json
+import Queue
+import hashlib
+import threading
+import numpy as np
+import h5py
+from django.conf import settings
+from django.db import connection
+from django.utils.importlib import import_module
+
+from h1ds_core import base
+from h1ds_core.base import Data
+from h1ds_core.utils import find_subclasses
+
+primary_backend = import_module(settings.H1DS_MIRROR_PRIMARY_BACKEND)
+
+mirror_dir = settings.H1DS_MIRROR_DIR
+
+if hasattr(settings, "H1DS_MIRROR_ON_READ"):
+    mirror_on_read = settings.H1DS_MIRROR_ON_READ
+else:
+    mirror_on_read = True
+
+if hasattr(settings, "H1DS_MIRROR_COMPRESSION"):
+    mirror_compression = settings.H1DS_MIRROR_COMPRESSION
+else:
+    mirror_compression = 'gzip'
+
+def get_mirror_filename(shot_number):
+    return os.path.join(mirror_dir, '%d.h5' % shot_number)
+
+def get_array_checksum(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tostring()).hexdigest()
+
+# Open mirror files are not shared between threads.
+_open_files = threading.local()
+max_open_files = 16
+
+def get_mirror_file(shot_number):
+    """Get the open mirror file of a shot, or None if not mirrored."""
+    if not hasattr(_open_files, 'files'):
+        _open_files.files = {}
+    if not shot_number in _open_files.files:
+        filename = get_mirror_filename(shot_number)
+        if not os.path.exists(filename):
+            return None
+        if len(_open_files.files) >= max_open_files:
+            for mirror_file in _open_files.files.values():
+                mirror_file.close()
+            _open_files.files.clear()
+        _open_files.files[shot_number] = h5py.File(filename, 'r')
+    return _open_files.files[shot_number]
+
+def write_array(group, name, array):
+    array = np.asarray(array)
+    if array.ndim > 0 and array.size > 0:
+        group.create_dataset(name, data=array, chunks=True, shuffle=True,
+                             compression=mirror_compression)
+    else:
+        group.create_dataset(name, data=array)
+
+def write_node_data(group, data):
+    """Store primary data in group; returns False if they can't be stored."""
+    value = np.asarray(data.value)
+    if value.dtype.hasobject:
+        # e.g. nodes without data ([None]); leave these to the primary backend.
+        return False
+    write_array(group, 'value', value)
+    group.attrs['value_is_list'] = isinstance(data.value, list)
+    group.attrs['value_sha1'] = get_array_checksum(value)
+    if isinstance(data.dimension, np.ndarray):
+        write_array(group, 'dimension', data.dimension)
+        group.attrs['n_dimension_arrays'] = -1
+    else:
+        for i, dimension in enumerate(data.dimension):
+            write_array(group, 'dimension_%d' % i, dimension)
+        group.attrs['n_dimension_arrays'] = len(data.dimension)
+    group.attrs['name'] = data.name
+    group.attrs['value_units'] = json.dumps(data.value_units)
+    group.attrs['dimension_units'] = json.dumps(data.dimension_units)
+    group.attrs['value_dtype'] = data.value_dtype
+    group.attrs['dimension_dtype'] = data.dimension_dtype
+    try:
+        group.attrs['metadata'] = json.dumps(data.metadata)
+    except TypeError:
+        group.attrs['metadata'] = json.dumps({})
+    return True
+
+def read_node_data(group):
+    """Rebuild primary data from a group written by write_node_data."""
+    value = group['value'][()]
+    if group.attrs['value_is_list']:
+        value = list(value)
+    n_dimension_arrays = group.attrs['n_dimension_arrays']
+    if n_dimension_arrays < 0:
+        dimension = group['dimension'][()]
+    else:
+        dimension = [group['dimension_%d' % i][()]
+                     for i in range(n_dimension_arrays)]
+    return Data(name=group.attrs['name'], value=value, dimension=dimension,
+                value_units=json.loads(group.attrs['value_units']),
+                dimension_units=json.loads(group.attrs['dimension_units']),
+                value_dtype=group.attrs['value_dtype'],
+                dimension_dtype=group.attrs['dimension_dtype'],
+                metadata=json.loads(group.attrs['metadata']))
+
+def get_shot_nodes(shot):
+    """Get the nodes with data of a shot, bound to it if it shares structure."""
+    from h1ds_core.models import Node, ShotNode
+    nodes = Node.objects.filter(
+        shot__number=shot.get_structure_shot_number()).order_by('tree_id', 'lft')
+    if shot.structure_shot_id is None:
+        return [n for n in nodes if n.has_data]
+    shot_nodes = dict((sn.node_id, sn) for sn in ShotNode.objects.filter(shot=shot))
+    bound_nodes = []
+    for node in nodes:
+        node.bind_shot(shot, load_data_metadata=False)
+        if node.id in shot_nodes:
+            node.set_data_metadata(shot_nodes[node.id].get_stored_data_metadata())
+        if node.has_data:
+            bound_nodes.append(node)
+    return bound_nodes
+
+def mirror_shot(shot, overwrite=False):
+    """Copy a shot's primary data into the mirror.
+
+    The file is written under a temporary name and renamed when complete,
+    so readers never see a partial mirror. Returns the number of nodes
+    stored, or None if the shot was already mirrored.
+
+    """
+    filename = get_mirror_filename(shot.number)
+    if os.path.exists(filename) and not overwrite:
+        return None
+    if not os.path.isdir(mirror_dir):
+        os.makedirs(mirror_dir)
+    tmp_filename = '%s.tmp-%d-%d' % (filename, os.getpid(),
+                                     threading.current_thread().ident)
+    n_stored = 0
+    skipped = []
+    try:
+        with h5py.File(tmp_filename, 'w') as mirror_file:
+            for node in get_shot_nodes(shot):
+                # Read through the primary backend, not the mirror.
+                data = primary_backend.NodeData.read_primary_data(node)
+                group = mirror_file.create_group(node.path_checksum)
+                if write_node_data(group, data):
+                    n_stored += 1
+                else:
+                    del mirror_file[node.path_checksum]
+                    skipped.append(node.path_checksum)
+            mirror_file.attrs['shot'] = shot.number
+            mirror_file.attrs['skipped'] = json.dumps(skipped)
+        os.rename(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    return n_stored
+
+def check_mirror(shot, against_primary=False):
+    """Check a shot's mirror, returning a list of problems found.
+
+    Every node with data  must be stored (or recorded as  skipped) and
+    match the stored checksum; with against_primary, stored values are
+    also compared with a fresh read from the primary backend.
+
+    """
+    filename = get_mirror_filename(shot.number)
+    if not os.path.exists(filename):
+        return ['shot %d is not mirrored' % shot.number]
+    problems = []
+    with h5py.File(filename, 'r') as mirror_file:
+        skipped = set(json.loads(mirror_file.attrs['skipped']))
+        for node in get_shot_nodes(shot):
+            if node.path_checksum in skipped:
+                continue
+            if not node.path_checksum in mirror_file:
+                problems.append('%s: missing' % node.nodepath)
+                continue
+            group = mirror_file[node.path_checksum]
+            value = group['value'][()]
+            checksum = get_array_checksum(value)
+            if checksum != group.attrs['value_sha1']:
+                problems.append('%s: checksum mismatch' % node.nodepath)
+            elif against_primary:
+                data = primary_backend.NodeData.read_primary_data(node)
+                if get_array_checksum(np.asarray(data.value)) != checksum:
+                    problems.append('%s: differs from primary' % node.nodepath)
+    return problems
+
+def is_finalized(shot_number):
+    """Shot.is_finalized from the shot index alone, without queries.
+
+    Shots which another process has just added may not be in the index
+    yet, in which case the shot is mirrored on a later read.
+    """
+    from h1ds_core.models import Shot
+    return Shot.backend.shot_index.get_next(shot_number) is not None
+
+class MirrorQueue(threading.Thread):
+    """Mirror shots one at a time in the background."""
+    def __init__(self):
+        super(MirrorQueue, self).__init__(name="h1ds-mirror")
+        self.daemon = True
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def add(self, shot_number):
+        with self.lock:
+            if shot_number in self.pending:
+                return
+            self.pending.add(shot_number)
+        self.queue.put(shot_number)
+
+    def mirror(self, shot_number):
+        from h1ds_core.models import Shot
+        try:
+            mirror_shot(Shot.objects.get(number=shot_number))
+        except Exception:
+            # The shot is read from the primary backend until a later
+            # attempt succeeds.
+            pass
+        finally:
+            connection.close()
+            with self.lock:
+                self.pending.discard(shot_number)
+
+    def run(self):
+        while True:
+            self.mirror(self.queue.get())
+
+_mirror_queue = None
+_mirror_queue_lock = threading.Lock()
+
+def queue_mirror_shot(shot_number):
+    global _mirror_queue
+    if _mirror_queue is None:
+        with _mirror_queue_lock:
+            if _mirror_queue is None:
+                mirror_queue = MirrorQueue()
+                mirror_queue.start()
+                _mirror_queue = mirror_queue
+    _mirror_queue.add(shot_number)
+
+class NodeData(primary_backend.NodeData):
+
+    def read_primary_data(self):
+        mirror_file = get_mirror_file(self.shot_id)
+        if mirror_file is not None:
+            if self.path_checksum in mirror_file:
+                return read_node_data(mirror_file[self.path_checksum])
+        elif mirror_on_read and is_finalized(self.shot_id):
+            queue_mirror_shot(self.shot_id)
+        return super(NodeData, self).read_primary_data()
+
+class DataTreeManager(primary_backend.DataTreeManager):
+    pass
+
+class MirrorShotManager(find_subclasses(primary_backend,
+                                        base.BaseBackendShotManager)[0]):
+    pass
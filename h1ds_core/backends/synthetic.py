@@ -0,0 +1,171 @@
+"""Synthetic data backend for benchmarks and load tests.
+
+Generates deterministic data trees and signals in memory, so H1DS can
+be run without MDSplus. To use, set
+
+    H1DS_DATA_BACKEND = "h1ds_core.backends.synthetic"
+
+Every shot has the same tree structure: each tree in H1DS_SYNTHETIC_TREES
+has H1DS_SYNTHETIC_WIDTH children per node, down to H1DS_SYNTHETIC_DEPTH
+levels below the tree root. Only the deepest nodes have data. Signals have
+H1DS_SYNTHETIC_CHANNELS  channels  of  H1DS_SYNTHETIC_SIGNAL_LENGTH
+samples  of  dtype  H1DS_SYNTHETIC_DTYPE,  and  depend  only  on  the
+shot number and node path. Each signal read sleeps for
+H1DS_SYNTHETIC_LATENCY seconds, to mimic a remote data server.
+
+"""
+import time
+import zlib
+import hashlib
+import datetime
+import numpy as np
+from django.conf import settings
+
+from h1ds_core.base import BaseNodeData
+from h1ds_core.base import BaseDataTreeManager
+from h1ds_core.base import BaseBackendShotManager
+from h1ds_core.base import no_data_metadata
+
+if hasattr(settings, "H1DS_SYNTHETIC_TREES"):
+    synthetic_trees = settings.H1DS_SYNTHETIC_TREES
+else:
+    synthetic_trees = ["synthetic"]
+
+if hasattr(settings, "H1DS_SYNTHETIC_DEPTH"):
+    synthetic_depth = settings.H1DS_SYNTHETIC_DEPTH
+else:
+    synthetic_depth = 3
+
+if hasattr(settings, "H1DS_SYNTHETIC_WIDTH"):
+    synthetic_width = settings.H1DS_SYNTHETIC_WIDTH
+else:
+    synthetic_width = 4
+
+if hasattr(settings, "H1DS_SYNTHETIC_SIGNAL_LENGTH"):
+    synthetic_signal_length = settings.H1DS_SYNTHETIC_SIGNAL_LENGTH
+else:
+    synthetic_signal_length = 10000
+
+if hasattr(settings, "H1DS_SYNTHETIC_DTYPE"):
+    synthetic_dtype = np.dtype(settings.H1DS_SYNTHETIC_DTYPE)
+else:
+    synthetic_dtype = np.dtype('float32')
+
+if hasattr(settings, "H1DS_SYNTHETIC_CHANNELS"):
+    synthetic_channels = settings.H1DS_SYNTHETIC_CHANNELS
+else:
+    synthetic_channels = 1
+
+if hasattr(settings, "H1DS_SYNTHETIC_LATENCY"):
+    synthetic_latency = settings.H1DS_SYNTHETIC_LATENCY
+else:
+    synthetic_latency = 0
+
+if hasattr(settings, "H1DS_SYNTHETIC_LATEST_SHOT"):
+    synthetic_latest_shot = settings.H1DS_SYNTHETIC_LATEST_SHOT
+else:
+    synthetic_latest_shot = 1000
+
+# Signals span this many seconds.
+SIGNAL_DURATION = 0.1
+
+# Shot n is taken at SHOT_EPOCH + n*SHOT_INTERVAL.
+SHOT_EPOCH = datetime.datetime(2000, 1, 1)
+SHOT_INTERVAL = datetime.timedelta(minutes=10)
+
+def get_child_names(level):
+    """Names of children of a node at level (the tree root is level 0)."""
+    if level >= synthetic_depth:
+        return []
+    if level == synthetic_depth - 1:
+        return ["signal_%d" % i for i in range(synthetic_width)]
+    return ["branch_%d" % i for i in range(synthetic_width)]
+
+def get_synthetic_signal(shot_number, full_path):
+    """Get (value, dimension) for a node, generated from shot and path.
+
+    value has shape (channels, samples).  Each channel is a sinusoid
+    with  noise; integer dtypes are  scaled to use  part of their range.
+
+    """
+    seed = zlib.crc32("%d:%s" % (shot_number, full_path)) & 0xffffffff
+    random_state = np.random.RandomState(seed)
+    dimension = np.linspace(0, SIGNAL_DURATION, synthetic_signal_length)
+    frequency = random_state.uniform(1.e3, 2.e4, (synthetic_channels, 1))
+    phase = random_state.uniform(0, 2*np.pi, (synthetic_channels, 1))
+    value = np.sin(2*np.pi*frequency*dimension + phase)
+    value += 0.1*random_state.standard_normal(value.shape)
+    if synthetic_dtype.kind in 'iu':
+        info = np.iinfo(synthetic_dtype)
+        value = (value + 1.5)*(info.max//4)
+    return value.astype(synthetic_dtype), [dimension]
+
+class NodeData(BaseNodeData):
+
+    def _get_full_path(self):
+        return ".".join(n.path for n in self.get_ancestry())
+
+    def _is_signal(self):
+        return self.level == synthetic_depth
+
+    def _read_signal(self):
+        if not hasattr(self, '_synthetic_signal'):
+            if synthetic_latency:
+                time.sleep(synthetic_latency)
+            self._synthetic_signal = get_synthetic_signal(self.shot_id,
+                                                          self._get_full_path())
+        return self._synthetic_signal
+
+    def get_name(self):
+        return self._get_full_path()
+
+    def get_value(self):
+        if not self._is_signal():
+            return [None]
+        return self._read_signal()[0]
+
+    def get_dimension(self):
+        if not self._is_signal():
+            return []
+        return self._read_signal()[1]
+
+    def get_value_units(self):
+        return "V" if self._is_signal() else ""
+
+    def get_dimension_units(self):
+        return "s" if self._is_signal() else ""
+
+    def get_value_dtype(self):
+        return str(synthetic_dtype) if self._is_signal() else ""
+
+    def get_dimension_dtype(self):
+        return "float64" if self._is_signal() else ""
+
+    def get_data_metadata(self):
+        """Describe node data from the settings, without generating it."""
+        if not self._is_signal():
+            return dict(no_data_metadata)
+        return {'has_data':True, 'n_dimensions':1,
+                'dtype':str(synthetic_dtype), 'n_channels':synthetic_channels}
+
+    def get_child_names_from_primary_source(self):
+        return get_child_names(self.level)
+
+class DataTreeManager(BaseDataTreeManager):
+    def get_trees(self):
+        return synthetic_trees
+
+    def get_structure_fingerprint(self, tree, shot_number):
+        """All shots have the same structure for given settings."""
+        structure = "%s:%d:%d" % (tree, synthetic_depth, synthetic_width)
+        return hashlib.sha1(structure).hexdigest()
+
+class SyntheticShotManager(BaseBackendShotManager):
+
+    tree_manager = DataTreeManager()
+
+    def get_latest_shot(self):
+        return synthetic_latest_shot
+
+    def get_timestamp_for_shot(self, shot):
+        return SHOT_EPOCH + shot*SHOT_INTERVAL
@@ -6,24 +6,53 @@ BaseURLProcessor
 
 """
 import re
+import time
+import bisect
 import inspect
+import threading
 import numpy as np
 import datetime
+from multiprocessing.pool import ThreadPool
 
 from django.db import models
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.importlib import import_module
+from django.template.defaultfilters import slugify
 
 from h1ds_core.filters import BaseFilter, excluded_filters
 
 #data_module = import_module(settings.H1DS_DATA_MODULE)
 
 # Match strings "f(fid)_name", where fid is the filter ID
-filter_name_regex = re.compile('^f(?P<fid>\d+?)')
+filter_name_regex = re.compile('^f(?P<fid>\d+)')
 
 # Match strings "f(fid)_kwarg_(arg name)", where fid is the filter ID
-filter_kwarg_regex = re.compile('^f(?P<fid>\d+?)_(?P<kwarg>.+)')
+filter_kwarg_regex = re.compile('^f(?P<fid>\d+)_(?P<kwarg>.+)')
+
+if hasattr(settings, "H1DS_INGEST_WORKERS"):
+    ingest_workers = settings.H1DS_INGEST_WORKERS
+else:
+    ingest_workers = 8
+
+# Seconds between checks of the shot index against the database. New
+# shot events refresh the index straight away (see h1ds_core.events).
+if hasattr(settings, "H1DS_SHOT_INDEX_TTL"):
+    shot_index_ttl = settings.H1DS_SHOT_INDEX_TTL
+else:
+    shot_index_ttl = 10
+
+# Probe data metadata of cloned nodes which had no data in the template
+# shot but have children. Set to False only for backends where such
+# structural nodes never have data.
+if hasattr(settings, "H1DS_PROBE_STRUCTURE_NODES"):
+    probe_structure_nodes = settings.H1DS_PROBE_STRUCTURE_NODES
+else:
+    probe_structure_nodes = True
+
+# Data metadata stored on nodes which have no primary data.
+no_data_metadata = {'has_data':False, 'n_dimensions':None,
+                    'dtype':"", 'n_channels':None}
 
 sql_type_mapping = {
     np.float32:"FLOAT",
@@ -138,6 +167,24 @@ class BaseNodeData(object):
                     dimension_dtype=dimension_dtype, metadata=metadata)
 
         return data
+
+    def get_data_metadata(self):
+        """Summarise primary data for storage on the node.
+
+        Returns a dict with has_data, n_dimensions, dtype and n_channels.
+        Backends  which  can  describe   their  data  without  reading  it
+        should override this.
+
+        """
+        data = self.read_primary_data()
+        value = data.value
+        # TODO: only single channel...
+        if value is None or all(v is None for v in value):
+            return dict(no_data_metadata)
+        return {'has_data':True,
+                'n_dimensions':data.get_n_dimensions(),
+                'dtype':data.value_dtype,
+                'n_channels':len(value)}
     
     def write_primary_data(self):
         pass
@@ -173,6 +220,9 @@ class BaseNodeData(object):
     """
     
 
+def _get_node_data_metadata(node):
+    return node.get_data_metadata()
+
 class BaseDataTreeManager(models.Manager):
 
     def get_shot_root_node(self, shot):
@@ -217,6 +267,208 @@ class BaseDataTreeManager(models.Manager):
 
     def populate_shot(self, shot_root_node):
         pass
+
+    def get_structure_fingerprint(self, tree, shot_number):
+        """Get a checksum of the node structure of a data tree.
+
+        Shots with  the same fingerprint  for a  tree are assumed  to have
+        identical node layouts. Override  this with backend subclass; the
+        default of None means the tree is always walked during ingest.
+
+        """
+        return None
+
+    def get_structure_template(self, tree, fingerprint, shot):
+        """Get root node of the latest earlier shot with matching structure.
+
+        Returns None if there is no fingerprint or no matching tree.
+        """
+        if not fingerprint:
+            return None
+        candidates = self.model.objects.filter(
+            level=0, path=tree, structure_checksum=fingerprint,
+            shot__number__lt=shot.number).order_by('-shot__number')[:1]
+        for template_root in candidates:
+            return template_root
+        return None
+
+    def build_shot_tree(self, shot):
+        """Build the data trees for a shot in memory.
+
+        The primary data source is  walked for each tree, and the MPTT
+        fields, slug and  path_checksum are computed locally  so no node
+        touches the database. tree_id is  numbered from 0 for this shot;
+        bulk_create_shot_tree  offsets  it when  the  nodes are  written.
+
+        If a tree has the same structure fingerprint as an earlier shot,
+        the  layout of  that shot  is cloned  instead of  walking the  data
+        source, see clone_tree().
+
+        Data metadata is probed once the structure is known, see
+        probe_data_metadata(). Returns the unsaved nodes in tree (depth
+        first) order.
+
+        """
+        nodes = []
+        probe_nodes = []
+        for tree_index, tree in enumerate(self.get_trees()):
+            fingerprint = self.get_structure_fingerprint(tree, shot.number)
+            template_root = self.get_structure_template(tree, fingerprint, shot)
+            if template_root is None:
+                root_node = self.model(path=tree, shot=shot)
+                tree_nodes = []
+                self._build_subtree(root_node, [], tree_index, 1, tree_nodes)
+                probe_nodes.extend(tree_nodes)
+            else:
+                tree_nodes, cloned_probe_nodes = self.clone_tree(
+                    template_root, shot, tree_index)
+                probe_nodes.extend(cloned_probe_nodes)
+            tree_nodes[0].structure_checksum = fingerprint or ""
+            nodes.extend(tree_nodes)
+        self.probe_data_metadata(probe_nodes)
+        return nodes
+
+    def needs_metadata_probe(self, template_node):
+        """Return True if a cloned node's data metadata may have changed.
+
+        A node  with children  which had no  data in the  template shot may
+        have data in  a later shot, so all nodes are  probed unless
+        settings.H1DS_PROBE_STRUCTURE_NODES is False, in which case such
+        nodes keep the metadata of the template shot.
+
+        """
+        if probe_structure_nodes:
+            return True
+        return template_node.has_data or template_node.is_leaf_node()
+
+    def clone_tree(self, template_root, shot, tree_id):
+        """Copy the node layout of template_root's tree for shot.
+
+        The  template tree  is read  with one  query. Paths,  slugs, MPTT
+        fields and path  checksums are copied, and so is  data metadata for
+        nodes which don't need a  probe (see needs_metadata_probe). Returns
+        (nodes, nodes to probe).
+
+        """
+        template_nodes = self.model.objects.filter(
+            tree_id=template_root.tree_id).order_by('lft')
+        nodes = []
+        probe_nodes = []
+        ancestry = []
+        for template_node in template_nodes:
+            node = self.model(path=template_node.path,
+                              slug=template_node.slug,
+                              shot=shot,
+                              tree_id=tree_id,
+                              level=template_node.level,
+                              lft=template_node.lft,
+                              rght=template_node.rght,
+                              path_checksum=template_node.path_checksum,
+                              slug_path=template_node.slug_path,
+                              has_data=template_node.has_data,
+                              n_dimensions=template_node.n_dimensions,
+                              dtype=template_node.dtype,
+                              n_channels=template_node.n_channels)
+            ancestry = ancestry[:node.level] + [node]
+            node._ancestry = ancestry
+            if not node.slug_path:
+                node.slug_path = "/".join([n.slug for n in ancestry])
+            node._template_node = template_node
+            nodes.append(node)
+            if self.needs_metadata_probe(template_node):
+                probe_nodes.append(node)
+        return nodes, probe_nodes
+
+    def probe_data_metadata(self, nodes):
+        """Set data metadata on in-memory nodes.
+
+        Most of the time  spent here is waiting on  the backend, so nodes
+        are probed in  a pool of settings.H1DS_INGEST_WORKERS threads. The
+        results are  applied to the  nodes in  the calling thread,  and no
+        database access is made.
+
+        """
+        if ingest_workers > 1 and len(nodes) > 1:
+            pool = ThreadPool(min(ingest_workers, len(nodes)))
+            try:
+                metadata = pool.map(_get_node_data_metadata, nodes)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            metadata = map(_get_node_data_metadata, nodes)
+        for node, node_metadata in zip(nodes, metadata):
+            node.set_data_metadata(node_metadata)
+
+    def _build_subtree(self, node, ancestry, tree_id, lft, nodes):
+        """Add node and its descendants to nodes, returning node.rght."""
+        ancestry = ancestry + [node]
+        node.slug = slugify(node.path)
+        node.tree_id = tree_id
+        node.level = len(ancestry) - 1
+        node.lft = lft
+        node.set_ancestry(ancestry)
+        nodes.append(node)
+        rght = lft + 1
+        for child_name in node.get_child_names_from_primary_source():
+            child = self.model(path=child_name, shot=node.shot)
+            rght = self._build_subtree(child, ancestry, tree_id, rght, nodes) + 1
+        node.rght = rght
+        return rght
+
+    def get_shared_structure_shot(self, nodes):
+        """Get number of the shot whose nodes can be shared by nodes.
+
+        Returns None unless all nodes were cloned from the same shot.
+        """
+        template_shots = set(getattr(n, '_template_node', n).shot_id for n in nodes)
+        if len(template_shots) != 1:
+            return None
+        template_shot = template_shots.pop()
+        if template_shot == nodes[0].shot_id:
+            return None
+        return template_shot
+
+    def bulk_create_shot_tree(self, shot, nodes):
+        """Write nodes from build_shot_tree to the database.
+
+        Nodes are  inserted with bulk_create  one tree level at  a time,
+        so  parent keys  are resolved  with one  query per  level rather
+        than  per node.  This must  be called  within a  transaction,
+        e.g. from Shot.save(): tree_ids are reserved from the TreeIdCounter
+        row, which stays locked until the transaction ends so concurrent
+        ingests get disjoint tree_ids.
+
+        """
+        from h1ds_core.models import TreeIdCounter
+        if not nodes:
+            return
+        n_trees = max(node.tree_id for node in nodes) + 1
+        tree_id_offset = TreeIdCounter.objects.allocate(n_trees)
+
+        levels = {}
+        stack = []
+        for node in nodes:
+            node.tree_id += tree_id_offset
+            while stack and stack[-1].level >= node.level:
+                stack.pop()
+            if stack:
+                node._parent_key = (node.tree_id, stack[-1].lft)
+            stack.append(node)
+            levels.setdefault(node.level, []).append(node)
+
+        parent_ids = {}
+        for level in sorted(levels):
+            level_nodes = levels[level]
+            for node in level_nodes:
+                if level > 0:
+                    node.parent_id = parent_ids[node._parent_key]
+            self.model.objects.bulk_create(level_nodes)
+            if level + 1 in levels:
+                parent_ids = dict(
+                    ((tree_id, lft), pk) for tree_id, lft, pk in
+                    self.model.objects.filter(shot=shot, level=level).values_list(
+                        'tree_id', 'lft', 'pk'))
     
     def get_node_from_ancestry(self, ancestry):
         shot_node = self.model.objects.get(path=ancestry[0], level=0)
@@ -230,30 +482,66 @@ class BaseDataTreeManager(models.Manager):
 
         
 class FilterManager(object):
-    """Get available filters for given data.
+    """Registry of filters from the modules in settings.DATA_FILTER_MODULES.
+
+    There is one  registry per process (filter_manager). Filters  are
+    loaded on first use, and the filters applicable to array data are
+    precomputed  for  each  (number  of  dimensions,  dtype  kind),  so
+    get_filters() is a dictionary lookup. Other data (e.g. lists holding
+    a scalar) are checked once per (number of dimensions, type).
 
-    FilterManager caches lookups to avoid repeated checks of filters for
-    available datatypes.
     """
+    table_ndims = (0, 1, 2)
+    # dtype kind -> dtype of the sample data for that kind.
+    table_dtypes = {'b':np.bool_, 'i':np.int64, 'u':np.uint64,
+                    'f':np.float64, 'c':np.complex128, 'S':'S1',
+                    'U':'U1', 'O':np.object_}
+
     def __init__(self):
-        self.filters = get_all_filters()
-        self.cache = {}
+        self._filters = None
+        self._table = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._filters is not None:
+                return
+            filters = get_all_filters()
+            table = {}
+            for ndim in self.table_ndims:
+                for kind, dtype in self.table_dtypes.items():
+                    sample = Data(value=np.zeros(1, dtype=dtype),
+                                  dimension=[np.zeros(1)]*ndim)
+                    table[(ndim, kind)] = self._find_filters(filters, sample)
+            self._table = table
+            self._filters = filters
+
+    def _find_filters(self, filters, data):
+        return dict((name, filter_) for name, filter_ in filters.iteritems()
+                    if filter_.is_filterable(data))
+
+    def _get_filters(self):
+        if self._filters is None:
+            self._load()
+        return self._filters
+
+    filters = property(_get_filters)
+
+    def get_data_key(self, data):
+        if isinstance(data.value, np.ndarray):
+            return (data.get_n_dimensions(), data.value.dtype.kind)
+        return (data.get_n_dimensions(), type(data.value))
 
     def get_filters(self, data):
         """Get available processing filters for data object provided."""
-        ndim = data.ndim if hasattr(data, "ndim") else 0
-        if ndim == 0:
-            _dt = type(data)
-        else:
-            _dt = data.dtype
-        data_type = (ndim, _dt)
-        if not self.cache.has_key(data_type):
-            data_filters = {}
-            for fname, filter_ in self.filters.iteritems():
-                if filter_.is_filterable(data):
-                    data_filters[fname] = filter_
-            self.cache[data_type] = data_filters
-        return self.cache[data_type]
+        filters = self.filters
+        key = self.get_data_key(data)
+        try:
+            return self._table[key]
+        except KeyError:
+            data_filters = self._find_filters(filters, data)
+            self._table[key] = data_filters
+            return data_filters
 
 filter_manager = FilterManager()
 
@@ -541,18 +829,26 @@ def get_filter_list(request):
     request -- a HttpRequest instance with HTTP GET parameters.
     
     """
-    filter_list = []
-
     if not request.method == 'GET':
         # If the HTTP method is not GET, return an empty list.
-        return filter_list
+        return []
+    return parse_filter_query(request.GET)
+
+def parse_filter_query(query_dict):
+    """Return sorted list of [fid, name, kwargs] from a query dict.
+
+    Arguments:
+    query_dict -- a QueryDict (or dict) of query parameters.
+
+    """
+    filter_list = []
 
     # First, create a dictionary with filter numbers as keys:
     # e.g. {1:{'name':filter, 'args':{1:arg1, 2:arg2, ...}, kwargs:{}}
     # note  that the  args  are stored  in  a dictionary  at this  point
     # because we cannot assume GET query will be ordered.
     filter_dict = {}
-    for key, value in request.GET.iteritems():
+    for key, value in query_dict.iteritems():
         kwarg_match = filter_kwarg_regex.match(key)
         if kwarg_match != None:
             fid = int(kwarg_match.groups()[0])
@@ -572,23 +868,237 @@ def get_filter_list(request):
     
     for fid, filter_data in sorted(filter_dict.items()):
         filter_list.append([fid, filter_data['name'], filter_data['kwargs']])
-                           
+
     return filter_list
 
+class ShotIndex(object):
+    """Sorted in-memory index of shot numbers, timestamps and versions.
+
+    The index is loaded from the  shot model on first use, searched by
+    bisection and updated  in place as shots are added  or removed (see
+    the signal handlers  in h1ds_core.models and h1ds_core.signals).
+
+    Shots may be added or removed by other processes (e.g. addshot), so
+    at most every settings.H1DS_SHOT_INDEX_TTL seconds the index is
+    checked against the database  with a single aggregate query of the
+    shot count, largest shot number and latest ingest time, and reloaded
+    if they differ.
+
+    Queries which the index couldn't answer  and the database confirmed
+    have no answer (e.g. the shot after the latest shot) are remembered
+    until the index is next checked or changed, see get_missing.
+
+    """
+    def __init__(self, model):
+        self.model = model
+        self._index = None
+        self._checked = 0
+        self._missing = set()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        shots = self.model.objects.order_by('number').values_list(
+            'number', 'timestamp', 'ingest_time')
+        self._set_index([s[0] for s in shots], [s[1] for s in shots],
+                        [s[2] for s in shots])
+
+    def _set_index(self, numbers, timestamps, versions):
+        """Replace the index; call with self._lock held."""
+        known_versions = [v for v in versions if v is not None]
+        max_version = max(known_versions) if known_versions else None
+        self._index = (tuple(numbers), tuple(timestamps), tuple(versions),
+                       max_version)
+        self._missing = set()
+
+    def _get_signature(self, index):
+        numbers, timestamps, versions, max_version = index
+        return (len(numbers), numbers[-1] if numbers else None, max_version)
+
+    def _is_current(self, index):
+        shots = self.model.objects.aggregate(
+            models.Count('number'), models.Max('number'),
+            models.Max('ingest_time'))
+        return self._get_signature(index) == (
+            shots['number__count'], shots['number__max'],
+            shots['ingest_time__max'])
+
+    def _get_index(self):
+        """Get (shot numbers, timestamps, versions, latest version).
+
+        The index is loaded if needed, and revalidated if it was last
+        checked more than shot_index_ttl seconds ago.  Updates replace
+        the tuple rather than modifying the lists, so readers always see
+        a consistent index without locking.
+        """
+        if self._index is None or time.time() - self._checked > shot_index_ttl:
+            with self._lock:
+                if self._index is None:
+                    self._load()
+                    self._checked = time.time()
+                elif time.time() - self._checked > shot_index_ttl:
+                    if not self._is_current(self._index):
+                        self._load()
+                    self._missing = set()
+                    self._checked = time.time()
+        return self._index
+
+    def invalidate(self):
+        """Check the index against the database on next use."""
+        self._checked = 0
+
+    def get_missing(self, key, query):
+        """Get the database answer to a query the index has no answer for.
+
+        query() is only called if key isn't remembered as having no
+        answer since the index was last checked or changed.
+        """
+        self._get_index()
+        missing = self._missing
+        if key in missing:
+            return None
+        value = query()
+        if value is None:
+            missing.add(key)
+        return value
+
+    def get_numbers(self):
+        return self._get_index()[0]
+
+    def get_min(self):
+        numbers = self.get_numbers()
+        return numbers[0] if numbers else None
+
+    def get_max(self):
+        numbers = self.get_numbers()
+        return numbers[-1] if numbers else None
+
+    def get_following(self, shot_number, count=1):
+        """Get up to count shot numbers after shot_number, nearest first."""
+        numbers = self.get_numbers()
+        i = bisect.bisect_right(numbers, shot_number)
+        return list(numbers[i:i+count])
+
+    def get_preceding(self, shot_number, count=1):
+        """Get up to count shot numbers before shot_number, nearest first."""
+        numbers = self.get_numbers()
+        i = bisect.bisect_left(numbers, shot_number)
+        return list(numbers[max(0, i-count):i][::-1])
+
+    def get_next(self, shot_number):
+        following = self.get_following(shot_number)
+        return following[0] if following else None
+
+    def get_previous(self, shot_number):
+        preceding = self.get_preceding(shot_number)
+        return preceding[0] if preceding else None
+
+    def _get_entry(self, shot_number):
+        """Get (timestamp, version) of a shot, or None if it isn't indexed."""
+        numbers, timestamps, versions, max_version = self._get_index()
+        i = bisect.bisect_left(numbers, shot_number)
+        if i < len(numbers) and numbers[i] == shot_number:
+            return timestamps[i], versions[i]
+        return None
+
+    def get_timestamp(self, shot_number):
+        """Get timestamp of shot, or None if it isn't in the index."""
+        entry = self._get_entry(shot_number)
+        return None if entry is None else entry[0]
+
+    def get_version(self, shot_number):
+        """Get a string which changes when a shot is ingested again.
+
+        This is  taken from the shot's ingest time,  and is empty for
+        shots which aren't in the index or were ingested before ingest
+        times were recorded.
+        """
+        entry = self._get_entry(shot_number)
+        if entry is None or entry[1] is None:
+            return ''
+        return entry[1].strftime('%Y%m%d%H%M%S%f')
+
+    def add(self, shot_number, timestamp, version=None):
+        """Add or update a shot, if the index has been loaded."""
+        with self._lock:
+            if self._index is None:
+                return
+            numbers, timestamps, versions = map(list, self._index[:3])
+            i = bisect.bisect_left(numbers, shot_number)
+            if i < len(numbers) and numbers[i] == shot_number:
+                timestamps[i] = timestamp
+                versions[i] = version
+            else:
+                numbers.insert(i, shot_number)
+                timestamps.insert(i, timestamp)
+                versions.insert(i, version)
+            self._set_index(numbers, timestamps, versions)
+
+    def refresh(self, shot_number):
+        """Update a shot from the database, if the index has been loaded."""
+        if self._index is None:
+            return
+        shots = self.model.objects.filter(number=shot_number).values_list(
+            'number', 'timestamp', 'ingest_time')
+        if shots:
+            self.add(*shots[0])
+        else:
+            self.remove(shot_number)
+
+    def remove(self, shot_number):
+        """Remove a shot, if the index has been loaded."""
+        with self._lock:
+            if self._index is None:
+                return
+            numbers, timestamps, versions = map(list, self._index[:3])
+            i = bisect.bisect_left(numbers, shot_number)
+            if i < len(numbers) and numbers[i] == shot_number:
+                del numbers[i]
+                del timestamps[i]
+                del versions[i]
+                self._set_index(numbers, timestamps, versions)
+
 class BaseBackendShotManager(models.Manager):
     """Base class for interactiing with backend shots."""
 
+    def _get_shot_index(self):
+        if not hasattr(self, '_shot_index'):
+            self._shot_index = ShotIndex(self.model)
+        return self._shot_index
+
+    shot_index = property(_get_shot_index)
+
     def get_latest_shot(self):
         pass
     
     def get_timestamp_for_shot(self, shot):
         return datetime.datetime.now()
 
+    def _get_with_fallback(self, indexed_value, aggregate, **filters):
+        """Check a missing answer from the shot index with the database.
+
+        The shot index may lag behind shots added by other processes
+        (see ShotIndex), so if it has no answer the database is asked,
+        and the index is refreshed if the database has one. An answer of
+        None is remembered by the index until it is next checked, so
+        e.g. the next shot of the latest shot needs no queries.
+        """
+        if indexed_value is not None:
+            return indexed_value
+        field = aggregate('number')
+        def query():
+            return self.model.objects.filter(**filters).aggregate(field)[
+                field.default_alias]
+        key = (field.default_alias, tuple(sorted(filters.items())))
+        value = self.shot_index.get_missing(key, query)
+        if value is not None:
+            self.shot_index.invalidate()
+        return value
+
     def get_min_shot_number(self):
-        return self.model.objects.all().aggregate(models.Min('number'))['number__min']
+        return self._get_with_fallback(self.shot_index.get_min(), models.Min)
 
     def get_max_shot_number(self):
-        return self.model.objects.all().aggregate(models.Max('number'))['number__max']
+        return self._get_with_fallback(self.shot_index.get_max(), models.Max)
 
     def get_next_shot_number(self, shot_number):
         """Get value of next shot.
@@ -596,8 +1106,8 @@ class BaseBackendShotManager(models.Manager):
         Usually, this will be shot_number+1...
 
         """
-        next_shot = self.model.objects.filter(number__gt=shot_number).aggregate(models.Min('number'))['number__min']
-        return next_shot
+        return self._get_with_fallback(self.shot_index.get_next(shot_number),
+                                       models.Min, number__gt=shot_number)
 
     def get_previous_shot_number(self, shot_number):
         """Get value of previous shot.
@@ -605,6 +1115,5 @@ class BaseBackendShotManager(models.Manager):
         Usually, this will be shot_number-1...
 
         """
-        previous_shot = self.model.objects.filter(number__lt=shot_number).aggregate(models.Max('number'))['number__max']
-        return previous_shot
-
+        return self._get_with_fallback(self.shot_index.get_previous(shot_number),
+                                       models.Max, number__lt=shot_number)
@@ -0,0 +1,272 @@
+"""Evaluation of a filter chain for a node over a range of shots.
+
+Shots are evaluated in a pool of H1DS_BATCH_WORKERS processes, kept for
+later batches, so each worker reuses its node cache and backend tree
+handles (e.g. MDSplus trees, see get_mds_tree) between shots. Filtered
+values larger than H1DS_BATCH_SHM_THRESHOLD bytes are passed back
+through files in H1DS_BATCH_SHM_DIR (shared memory under /dev/shm on
+Linux) rather than pickled through the pool's pipes.
+
+Forking a threaded process can leave the children with locks held by
+threads which don't exist in them, so the process pool is never started
+while serving requests. Call start_batch_pool() when each web worker
+process starts, before it starts any threads, e.g. from gunicorn's
+post_fork hook:
+
+    def post_fork(server, worker):
+        from h1ds_core.batch import start_batch_pool
+        start_batch_pool()
+
+Without it, shots are evaluated in a pool of H1DS_BATCH_WORKERS threads.
+
+Results are produced in shot order, with only a few shots per worker in
+progress at a time, so a client which stops reading stops the batch. A
+shot whose result hasn't arrived after waiting H1DS_BATCH_SHOT_TIMEOUT
+seconds for it is reported as failed. Values which aren't finite (NaN
+and infinities) are sent as null, as JSON has no representation for
+them.
+
+"""
+import os
+import json
+import tempfile
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.http import QueryDict
+
+from h1ds_core.models import Node
+from h1ds_core.base import parse_filter_query
+from h1ds_core.cache import get_cached_data
+
+if hasattr(settings, "H1DS_BATCH_WORKERS"):
+    batch_workers = settings.H1DS_BATCH_WORKERS
+else:
+    batch_workers = multiprocessing.cpu_count()
+
+if hasattr(settings, "H1DS_BATCH_MAX_SHOTS"):
+    batch_max_shots = settings.H1DS_BATCH_MAX_SHOTS
+else:
+    batch_max_shots = 100000
+
+# Number of shots between progress messages.
+if hasattr(settings, "H1DS_BATCH_PROGRESS_INTERVAL"):
+    batch_progress_interval = settings.H1DS_BATCH_PROGRESS_INTERVAL
+else:
+    batch_progress_interval = 100
+
+if hasattr(settings, "H1DS_BATCH_SHOT_TIMEOUT"):
+    batch_shot_timeout = settings.H1DS_BATCH_SHOT_TIMEOUT
+else:
+    batch_shot_timeout = 60
+
+if hasattr(settings, "H1DS_BATCH_SHM_THRESHOLD"):
+    batch_shm_threshold = settings.H1DS_BATCH_SHM_THRESHOLD
+else:
+    batch_shm_threshold = 1024*1024
+
+if hasattr(settings, "H1DS_BATCH_SHM_DIR"):
+    batch_shm_dir = settings.H1DS_BATCH_SHM_DIR
+elif os.path.isdir('/dev/shm'):
+    batch_shm_dir = '/dev/shm'
+else:
+    batch_shm_dir = tempfile.gettempdir()
+
+def pack_value(value):
+    """Prepare a filtered value to be returned from a worker process."""
+    if isinstance(value, list):
+        value = [pack_value(v) for v in value]
+        return ('list', value)
+    array = np.asarray(value)
+    if array.dtype.hasobject or array.nbytes < batch_shm_threshold:
+        return ('value', value)
+    fd, filename = tempfile.mkstemp(prefix='h1ds-batch-', suffix='.npy',
+                                    dir=batch_shm_dir)
+    with os.fdopen(fd, 'wb') as shm_file:
+        np.save(shm_file, array)
+    return ('shm', filename)
+
+def unpack_value(packed_value):
+    """Get a value packed by pack_value as a JSON serialisable object."""
+    kind, value = packed_value
+    if kind == 'list':
+        return [unpack_value(v) for v in value]
+    if kind == 'shm':
+        try:
+            value = np.load(value)
+        finally:
+            os.remove(packed_value[1])
+    if np.isscalar(value) or isinstance(value, np.ndarray):
+        array = np.asarray(value)
+        if array.dtype.kind == 'f':
+            non_finite = ~np.isfinite(array)
+            if non_finite.any():
+                # JSON has no NaN or infinity.
+                array = array.astype(object)
+                array[non_finite] = None
+        return array.tolist()
+    return value
+
+def discard_value(packed_value):
+    """Remove any shared memory file of an unused packed value."""
+    kind, value = packed_value
+    if kind == 'list':
+        for v in value:
+            discard_value(v)
+    elif kind == 'shm' and os.path.exists(value):
+        os.remove(value)
+
+def evaluate_shot(shot_number, nodepath, filter_query):
+    """Apply the filter chain to a node for one shot.
+
+    Runs in a worker process, and returns (shot number, packed value,
+    None), or (shot number, None, error message) if the node doesn't
+    exist for this shot or the filters fail.
+
+    """
+    try:
+        node = Node.objects.resolve(shot_number, nodepath)
+        cached_data = get_cached_data(node, filter_query)
+        if cached_data is not None:
+            node.data = cached_data[0]
+        else:
+            node.data = node.read_primary_data()
+            node.apply_filter_list(parse_filter_query(QueryDict(filter_query)))
+        return shot_number, pack_value(node.data.value), None
+    except Node.DoesNotExist:
+        return shot_number, None, 'Node not found'
+    except Exception as e:
+        return shot_number, None, '%s: %s' % (type(e).__name__, e)
+
+def evaluate_shot_in_thread(shot_number, nodepath, filter_query):
+    try:
+        return evaluate_shot(shot_number, nodepath, filter_query)
+    finally:
+        connection.close()
+
+_batch_pool = None
+_batch_thread_pool = None
+_batch_pool_lock = threading.Lock()
+
+def start_batch_pool():
+    """Start the batch worker processes of this process.
+
+    Call before this process starts any threads, see the module
+    docstring.
+    """
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            # Workers open their own database connections, and must
+            # not inherit this process's.
+            connection.close()
+            _batch_pool = multiprocessing.Pool(batch_workers)
+
+def get_batch_pool():
+    """Get (pool, function evaluating a shot in the pool).
+
+    This is the process pool if start_batch_pool() was called, and
+    otherwise a thread pool.
+    """
+    global _batch_thread_pool
+    if _batch_pool is not None:
+        return _batch_pool, evaluate_shot
+    if _batch_thread_pool is None:
+        with _batch_pool_lock:
+            if _batch_thread_pool is None:
+                _batch_thread_pool = ThreadPool(batch_workers)
+    return _batch_thread_pool, evaluate_shot_in_thread
+
+class PendingShot(object):
+    """A shot submitted to the batch pool.
+
+    A shot is abandoned if it times out, or the client goes away before
+    its result is used. Its value is then discarded when it arrives, so
+    no shared memory file is left behind.
+    """
+    def __init__(self, shot_number):
+        self.shot_number = shot_number
+        self.packed_value = None
+        self.abandoned = False
+        self.lock = threading.Lock()
+
+    def set_result(self, result):
+        """Pool callback, run when the worker returns the result."""
+        with self.lock:
+            if not self.abandoned:
+                self.packed_value = result[1]
+                return
+        if result[1] is not None:
+            discard_value(result[1])
+
+    def abandon(self):
+        with self.lock:
+            self.abandoned = True
+            packed_value, self.packed_value = self.packed_value, None
+        if packed_value is not None:
+            discard_value(packed_value)
+
+def evaluate_shots(shot_numbers, nodepath, filter_query):
+    """Yield (shot number, value, error) for each shot, in shot order."""
+    pool, evaluate = get_batch_pool()
+    shots = iter(shot_numbers)
+    pending = deque()
+    def submit_next():
+        for shot_number in shots:
+            shot = PendingShot(shot_number)
+            result = pool.apply_async(evaluate,
+                                      (shot_number, nodepath, filter_query),
+                                      callback=shot.set_result)
+            pending.append((shot, result))
+            return
+
+    for i in range(4*batch_workers):
+        submit_next()
+    try:
+        while pending:
+            shot, result = pending.popleft()
+            try:
+                shot_number, packed_value, error = result.get(batch_shot_timeout)
+            except multiprocessing.TimeoutError:
+                shot.abandon()
+                shot_number, packed_value, error = shot.shot_number, None, 'Timed out'
+            submit_next()
+            if error is None:
+                yield shot_number, unpack_value(packed_value), None
+            else:
+                yield shot_number, None, error
+    finally:
+        # The client went away; values of shots already submitted are
+        # discarded as they arrive.
+        for shot, result in pending:
+            shot.abandon()
+
+def batch_stream(shot_numbers, nodepath, filter_query):
+    """Yield results of a batch as lines of JSON.
+
+    Each shot gives {"shot": n, "value": v}, or {"shot": n, "error": e}
+    if it failed. Every batch_progress_interval shots, and at the end, a
+    {"progress": {"done": d, "failed": f, "total": t}} line is sent.
+
+    """
+    total = len(shot_numbers)
+    done, failed = 0, 0
+    for shot_number, value, error in evaluate_shots(shot_numbers, nodepath,
+                                                    filter_query):
+        done += 1
+        if error is None:
+            line = {'shot':shot_number, 'value':value}
+        else:
+            failed += 1
+            line = {'shot':shot_number, 'error':error}
+        yield json.dumps(line) + '\n'
+        if done % batch_progress_interval == 0 or done == total:
+            yield json.dumps({'progress':{'done':done, 'failed':failed,
+                                          'total':total}}) + '\n'
+    if total == 0:
+        yield json.dumps({'progress':{'done':0, 'failed':0, 'total':0}}) + '\n'
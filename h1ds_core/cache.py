@@ -0,0 +1,432 @@
+"""Caching of filtered node data.
+
+Filtered data are stored in  the cache named by settings.H1DS_DATA_CACHE,
+keyed on shot, shot version, node path checksum and canonical filter
+chain, so users requesting the same signal with the same filters share
+one backend read.
+
+When a new shot  arrives, the data cache is warmed  with the most popular
+node paths and  filter queries for that shot, taken  from user signals,
+worksheet pagelets and recent requests, before users come asking. The
+responses for those nodes in the previous shot, which the new shot has
+finalized, are rendered into the response cache (see CacheWarmer).
+
+Rendered  (non-html) node responses  for finalized shots are also cached,
+keyed on shot, shot version, node path checksum, canonical filter chain
+and renderer, in an in-process LRU cache with a byte budget in front of
+the cache named by settings.H1DS_RESPONSE_CACHE.
+
+"""
+import os
+import time
+import hashlib
+import threading
+import urlparse
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.urlresolvers import resolve, reverse, Resolver404
+from django.db import connection
+from django.http import QueryDict
+
+from h1ds_core.models import Node, Shot, UserSignal, Pagelet, shot_ingested
+from h1ds_core.base import parse_filter_query, filter_name_regex
+from h1ds_core.models import canonical_filter_chain
+from h1ds_core.utils import LRUCache
+from h1ds_core.events import subscribe_event
+
+# Name of a cache in settings.CACHES for filtered data; None disables
+# the data cache and cache warming.
+if hasattr(settings, "H1DS_DATA_CACHE"):
+    data_cache = get_cache(settings.H1DS_DATA_CACHE)
+else:
+    data_cache = None
+
+if hasattr(settings, "H1DS_DATA_CACHE_TIMEOUT"):
+    data_cache_timeout = settings.H1DS_DATA_CACHE_TIMEOUT
+else:
+    data_cache_timeout = 60*60
+
+# Number of node path and filter query combinations warmed for a new shot.
+if hasattr(settings, "H1DS_WARM_CACHE_NODES"):
+    warm_cache_nodes = settings.H1DS_WARM_CACHE_NODES
+else:
+    warm_cache_nodes = 20
+
+if hasattr(settings, "H1DS_WARM_CACHE_WORKERS"):
+    warm_cache_workers = settings.H1DS_WARM_CACHE_WORKERS
+else:
+    warm_cache_workers = 4
+
+# Base URLs (scheme and host) for which the responses of popular nodes
+# are rendered into the response cache when a shot is finalized, by
+# default the fully qualified settings.ALLOWED_HOSTS over http.
+if hasattr(settings, "H1DS_WARM_RESPONSE_URLS"):
+    warm_response_urls = settings.H1DS_WARM_RESPONSE_URLS
+else:
+    warm_response_urls = ['http://%s/' % host for host in settings.ALLOWED_HOSTS
+                          if not '*' in host and not host.startswith('.')]
+
+if hasattr(settings, "H1DS_WARM_RESPONSE_FORMATS"):
+    warm_response_formats = settings.H1DS_WARM_RESPONSE_FORMATS
+else:
+    warm_response_formats = ('json',)
+
+# Number of distinct requests counted by the access statistics.
+if hasattr(settings, "H1DS_ACCESS_STATS_SIZE"):
+    access_stats_size = settings.H1DS_ACCESS_STATS_SIZE
+else:
+    access_stats_size = 1000
+
+# Name of a cache in settings.CACHES for rendered responses, shared
+# between processes; None keeps responses in the local cache only.
+if hasattr(settings, "H1DS_RESPONSE_CACHE"):
+    shared_response_cache = get_cache(settings.H1DS_RESPONSE_CACHE)
+else:
+    shared_response_cache = None
+
+if hasattr(settings, "H1DS_RESPONSE_CACHE_TIMEOUT"):
+    response_cache_timeout = settings.H1DS_RESPONSE_CACHE_TIMEOUT
+else:
+    response_cache_timeout = 24*60*60
+
+# Total size in bytes of responses kept in each process; 0 disables the
+# local response cache.
+if hasattr(settings, "H1DS_RESPONSE_CACHE_BYTES"):
+    response_cache_bytes = settings.H1DS_RESPONSE_CACHE_BYTES
+else:
+    response_cache_bytes = 64*1024*1024
+
+# Larger responses aren't put in the shared cache (memcached's default
+# item size limit is 1 MB).
+if hasattr(settings, "H1DS_RESPONSE_CACHE_MAX_ITEM_BYTES"):
+    response_cache_max_item_bytes = settings.H1DS_RESPONSE_CACHE_MAX_ITEM_BYTES
+else:
+    response_cache_max_item_bytes = 1024*1024
+
+response_cache = LRUCache(max_entries=None, max_bytes=response_cache_bytes)
+
+def get_filter_query(query_dict):
+    """Return the filter parameters of a query dict as a query string.
+
+    Parameters are sorted and non-filter parameters (e.g. format) are
+    dropped, so equivalent requests give the same string.
+
+    """
+    filter_query = QueryDict('', mutable=True)
+    for key in sorted(query_dict.keys()):
+        if filter_name_regex.match(key):
+            filter_query[key] = query_dict[key]
+    return filter_query.urlencode()
+
+def get_data_cache_key(node, filter_query):
+    """Key for filtered node data.
+
+    The key uses the canonical filter chain, as response keys and ETags
+    do, and the shot version, so data of a shot ingested again aren't
+    served from the cache.
+    """
+    chain = canonical_filter_chain(QueryDict(filter_query))
+    version = Shot.backend.shot_index.get_version(node.shot_id)
+    return 'h1ds_data:%d:%s:%s:%s' % (node.shot_id, version, node.path_checksum,
+                                      hashlib.sha1(chain).hexdigest())
+
+def get_cached_data(node, filter_query):
+    """Get (data, filter history) for node, or None if not cached.
+
+    Equivalent filter queries share cached data, so the filter ids in
+    the history are replaced by those of filter_query.
+    """
+    if data_cache is None:
+        return None
+    cached_data = data_cache.get(get_data_cache_key(node, filter_query))
+    if cached_data is None:
+        return None
+    data, filter_history = cached_data
+    fids = [f[0] for f in parse_filter_query(QueryDict(filter_query))]
+    if len(fids) == len(filter_history):
+        filter_history = [(fid, filter_class, kwargs) for fid, (cached_fid,
+                          filter_class, kwargs) in zip(fids, filter_history)]
+    return data, filter_history
+
+def set_cached_data(node, filter_query):
+    """Store filtered data and filter history of node."""
+    if data_cache is None:
+        return
+    data_cache.set(get_data_cache_key(node, filter_query),
+                   (node.data, node.filter_history), data_cache_timeout)
+
+def response_cache_enabled():
+    return bool(response_cache_bytes) or shared_response_cache is not None
+
+def get_response_cache_key(request, shot_number, path_checksum):
+    """Key for a rendered node response.
+
+    Besides the  canonical filter chain and  the renderer, the key depends
+    on the host, as responses contain absolute links, and on the shot
+    version, so a shot ingested again isn't served from the cache.
+
+    """
+    shot_number = int(shot_number)
+    request_id = '\n'.join([canonical_filter_chain(request.GET),
+                            request.accepted_renderer.format,
+                            request.accepted_media_type,
+                            request.build_absolute_uri('/')])
+    return 'h1ds_response:%d:%s:%s:%s' % (
+        shot_number, Shot.backend.shot_index.get_version(shot_number),
+        path_checksum, hashlib.sha1(request_id).hexdigest())
+
+def get_cached_response(key):
+    """Get (content, content type) of a rendered response, or None."""
+    response = response_cache.get(key)
+    if response is None and shared_response_cache is not None:
+        response = shared_response_cache.get(key)
+        if response is not None:
+            response_cache.set(key, response, len(response[0]))
+    return response
+
+def set_cached_response(key, response):
+    """Store the content and content type of a rendered response."""
+    cached_response = (response.content, response['Content-Type'])
+    size = len(cached_response[0])
+    response_cache.set(key, cached_response, size)
+    if (shared_response_cache is not None and
+        size <= response_cache_max_item_bytes):
+        shared_response_cache.set(key, cached_response, response_cache_timeout)
+
+class AccessStats(object):
+    """Count requests for node paths and filter queries.
+
+    Counts  are kept in  this process  only. When more  than max_entries
+    requests are counted, the less popular half are dropped.
+
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, nodepath, filter_query):
+        with self.lock:
+            self.counts[(nodepath, filter_query)] += 1
+            if len(self.counts) > self.max_entries:
+                self.counts = Counter(
+                    dict(self.counts.most_common(self.max_entries//2)))
+
+    def most_common(self, n=None):
+        with self.lock:
+            return self.counts.most_common(n)
+
+access_stats = AccessStats(access_stats_size)
+
+def parse_node_url(url):
+    """Return (node path, filter query) for a node URL, or None."""
+    parsed_url = urlparse.urlparse(url)
+    try:
+        match = resolve(parsed_url.path)
+    except Resolver404:
+        return None
+    if match.url_name != 'node-detail':
+        return None
+    return match.kwargs['nodepath'], get_filter_query(QueryDict(parsed_url.query))
+
+def get_popular_requests(n=warm_cache_nodes):
+    """Return the n most popular (node path, filter query) pairs."""
+    counts = Counter(dict(access_stats.most_common()))
+    urls = list(UserSignal.objects.values_list('url', flat=True))
+    urls.extend(Pagelet.objects.values_list('url', flat=True))
+    for url in urls:
+        request = parse_node_url(url)
+        if request is not None:
+            counts[request] += 1
+    return [request for request, count in counts.most_common(n)]
+
+def warm_node(shot_number, nodepath, filter_query):
+    """Read filtered node data into the data cache.
+
+    Returns True if the node was found in the shot.
+    """
+    try:
+        node = Node.objects.resolve(shot_number, nodepath)
+        if node.has_data and not get_cached_data(node, filter_query):
+            node.apply_filter_list(parse_filter_query(QueryDict(filter_query)))
+            set_cached_data(node, filter_query)
+    except Node.DoesNotExist:
+        # Popular paths may not exist in every shot.
+        return False
+    except Exception:
+        # A filter may not suit this shot's data; users requesting it
+        # will get the error from the view.
+        pass
+    finally:
+        connection.close()
+    return True
+
+def get_warm_response_requests(shot_number, nodepath, filter_query):
+    """Requests for a node in each of warm_response_formats and urls."""
+    from django.test.client import RequestFactory
+    path = reverse('node-detail', kwargs={'shot':shot_number,
+                                          'nodepath':nodepath})
+    requests = []
+    for url in warm_response_urls:
+        parsed_url = urlparse.urlparse(url)
+        factory = RequestFactory(**{'HTTP_HOST':parsed_url.netloc,
+                                    'wsgi.url_scheme':parsed_url.scheme,
+                                    'h1ds.warm':True})
+        for response_format in warm_response_formats:
+            query = QueryDict(filter_query, mutable=True)
+            query['format'] = response_format
+            requests.append(factory.get(path + '?' + query.urlencode()))
+    return requests
+
+def warm_node_responses(shot_number, nodepath, filter_query):
+    """Render node responses into the response cache.
+
+    The data are taken from the data cache, which was warmed while the
+    shot was the latest.
+    """
+    # Imported here, as h1ds_core.views imports this module.
+    from h1ds_core.views import NodeView
+    view = NodeView.as_view()
+    try:
+        for request in get_warm_response_requests(shot_number, nodepath,
+                                                  filter_query):
+            response = view(request, shot=str(shot_number), nodepath=nodepath)
+            if hasattr(response, 'render'):
+                response.render()
+    except Exception:
+        pass
+    finally:
+        connection.close()
+
+class CacheWarmer(object):
+    """Warm caches for new shots in a background thread.
+
+    Shots are queued by start_warm_shot_cache. Only the latest queued
+    shot is warmed,  so a burst of shots (e.g. an ascending backfill
+    by addshot) warms the last one rather than starting a thread per
+    shot. Nodes are read in a pool of warm_cache_workers threads.
+
+    For  the latest shot, popular  node paths and filter queries are
+    read into the data cache. The shot before it has just become
+    finalized, so its responses can be cached; these are rendered into
+    the response cache for each of warm_response_urls.
+
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = set()
+        self.active = False
+        self.thread = None
+        self.pool = None
+
+    def add(self, shot_number):
+        with self.condition:
+            self.pending.add(shot_number)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name="h1ds-warm-cache")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait until queued shots are warmed; False if timeout expired."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.pending or self.active:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+        return True
+
+    def run(self):
+        self.pool = ThreadPool(warm_cache_workers)
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                shot_number = max(self.pending)
+                self.pending.clear()
+                self.active = True
+            try:
+                self.warm_shot(shot_number)
+            except Exception:
+                pass
+            finally:
+                with self.condition:
+                    self.active = False
+                    self.condition.notify_all()
+
+    def warm_shot(self, shot_number):
+        try:
+            requests = get_popular_requests()
+            previous_shot = Shot.backend.get_previous_shot_number(shot_number)
+        finally:
+            connection.close()
+        warm_shot_cache(shot_number, requests, self.pool.map)
+        if previous_shot is not None:
+            warm_shot_responses(previous_shot, requests, self.pool.map)
+
+cache_warmer = CacheWarmer()
+
+def warm_shot_cache(shot_number, requests, map_function=map):
+    """Read popular nodes of a shot into the data cache.
+
+    Only one process warms each shot, even if several receive the new
+    shot event. If none of the requested nodes exist in the shot (e.g.
+    the shot's nodes aren't visible yet) the shot is left for another
+    attempt.
+
+    """
+    warm_key = 'h1ds_warm:%d:%s' % (shot_number,
+                                    Shot.backend.shot_index.get_version(shot_number))
+    if not data_cache.add(warm_key, True, data_cache_timeout):
+        return
+    found = map_function(lambda r: warm_node(shot_number, *r), requests)
+    if not any(found):
+        data_cache.delete(warm_key)
+
+def warm_shot_responses(shot_number, requests, map_function=map):
+    """Render popular node responses of a finalized shot into the response cache.
+
+    Without a shared response cache each process keeps its own
+    responses, so each process warms them.
+    """
+    if not (warm_response_urls and warm_response_formats and
+            response_cache_enabled()):
+        return
+    warm_key = 'h1ds_warm_responses:%d:%s' % (
+        shot_number, Shot.backend.shot_index.get_version(shot_number))
+    if shared_response_cache is None:
+        warm_key += ':%d' % os.getpid()
+    if not data_cache.add(warm_key, True, data_cache_timeout):
+        return
+    map_function(lambda r: warm_node_responses(shot_number, *r), requests)
+
+def start_warm_shot_cache(shot_number):
+    """Queue a shot for cache warming in the background."""
+    if data_cache is None:
+        return
+    cache_warmer.add(int(shot_number))
+
+def wait_for_cache_warming(timeout=None):
+    """Wait for queued cache warming, e.g. before a command exits."""
+    if data_cache is None:
+        return True
+    return cache_warmer.wait(timeout)
+
+def warm_new_shot(sender, instance, **kwargs):
+    """Warm caches once the newest shot is ingested."""
+    if instance.number >= Shot.backend.get_max_shot_number():
+        start_warm_shot_cache(instance.number)
+
+shot_ingested.connect(warm_new_shot, sender=Shot)
+
+subscribe_event('new_shot', start_warm_shot_cache)
@@ -0,0 +1,307 @@
+"""New shot notification for stream clients.
+
+Stream clients  subscribe to a  ShotEventHub, which  wakes all of them
+when  a  new shot  is  published.  Subscribers keep  only the version
+of the last  event they have seen, and  idle clients sleep on the hub's
+condition rather than polling.
+
+The hub is fed in one of two ways.   If H1DS_EVENT_SOCKET_DIR is set,
+every process binds a Unix datagram socket in that directory, and each
+h1ds_signal  is  sent  to all of  them (see  h1ds_core.signals), so new
+shots reach every  web process as  soon as NewShotEvent is sent.
+Otherwise a single ShotPoller thread per process asks the backend for
+the latest shot.
+
+Each open stream holds a request thread of its web worker process for as
+long as the client stays connected, so at most
+H1DS_SHOT_STREAM_MAX_CLIENTS streams are served by each process at once,
+and further clients are asked to retry later (see ShotEventStream). Set
+it below the number of request threads of each worker, to keep threads
+free for other requests; more clients need more worker processes.
+
+"""
+import os
+import time
+import json
+import glob
+import errno
+import atexit
+import socket
+import threading
+
+from django.conf import settings
+from django.core.signals import request_started
+
+from h1ds_core.utils import get_backend_shot_manager
+
+# Seconds between backend queries for the latest shot.
+if hasattr(settings, "H1DS_SHOT_POLL_INTERVAL"):
+    shot_poll_interval = settings.H1DS_SHOT_POLL_INTERVAL
+else:
+    shot_poll_interval = 1
+
+# Seconds between heartbeat comments sent to idle stream clients.
+if hasattr(settings, "H1DS_SHOT_STREAM_HEARTBEAT"):
+    shot_stream_heartbeat = settings.H1DS_SHOT_STREAM_HEARTBEAT
+else:
+    shot_stream_heartbeat = 15
+
+# Shot stream clients served at once by each process.
+if hasattr(settings, "H1DS_SHOT_STREAM_MAX_CLIENTS"):
+    shot_stream_max_clients = settings.H1DS_SHOT_STREAM_MAX_CLIENTS
+else:
+    shot_stream_max_clients = 4
+
+# Directory holding event bus sockets; None disables the event bus.
+if hasattr(settings, "H1DS_EVENT_SOCKET_DIR"):
+    event_socket_dir = settings.H1DS_EVENT_SOCKET_DIR
+else:
+    event_socket_dir = None
+
+MAX_EVENT_SIZE = 65536
+
+def publish_event(signal_name, value):
+    """Send an event to every process listening on the event bus.
+
+    Sending never blocks: if a listener's queue is full the event is
+    dropped for that  listener, and sockets left  behind by processes
+    which have exited are removed.
+
+    """
+    if event_socket_dir is None:
+        return
+    message = json.dumps({'signal': signal_name, 'value': value})
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        for path in glob.glob(os.path.join(event_socket_dir, '*.sock')):
+            try:
+                sock.sendto(message, path)
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+    finally:
+        sock.close()
+
+# signal name -> callbacks for events from the event bus.
+_subscribers = {}
+
+def subscribe_event(signal_name, callback):
+    """Call callback(value) for each event bus event with signal_name.
+
+    Subscriptions may be made before the listener is started, e.g. at
+    import.
+    """
+    _subscribers.setdefault(signal_name, []).append(callback)
+
+class EventListener(threading.Thread):
+    """Receive events from the event bus and pass them to subscribers."""
+    def __init__(self, socket_dir):
+        super(EventListener, self).__init__(name="h1ds-event-listener")
+        self.daemon = True
+        self.pid = os.getpid()
+        self.path = os.path.join(socket_dir, 'h1ds-%d.sock' % self.pid)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        atexit.register(self.close)
+
+    def close(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            try:
+                event = json.loads(self.sock.recv(MAX_EVENT_SIZE))
+                callbacks = list(_subscribers.get(event['signal'], []))
+            except (ValueError, KeyError, TypeError):
+                continue
+            for callback in callbacks:
+                try:
+                    callback(event['value'])
+                except Exception:
+                    # One bad subscriber mustn't stop delivery of events.
+                    pass
+
+class ShotEventHub(object):
+    """Fan out new shot numbers to any number of subscribers."""
+    def __init__(self, max_clients=None):
+        self._condition = threading.Condition()
+        self.version = 0
+        self.latest_shot = None
+        if max_clients is None:
+            max_clients = shot_stream_max_clients
+        self.max_clients = max_clients
+        self.clients = 0
+
+    def connect(self):
+        """Take a client slot; returns False if all slots are taken."""
+        with self._condition:
+            if self.clients >= self.max_clients:
+                return False
+            self.clients += 1
+            return True
+
+    def disconnect(self):
+        """Release a client slot taken by connect()."""
+        with self._condition:
+            self.clients -= 1
+
+    def publish(self, shot_number):
+        """Record shot_number as the latest shot and wake subscribers."""
+        with self._condition:
+            if shot_number == self.latest_shot:
+                return
+            self.latest_shot = shot_number
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout=None):
+        """Wait for an event newer than version.
+
+        Returns (version, latest shot);  the version is unchanged if the
+        timeout expired first.
+
+        """
+        with self._condition:
+            if self.version == version:
+                self._condition.wait(timeout)
+            return self.version, self.latest_shot
+
+class ShotPoller(threading.Thread):
+    """Poll the backend for the latest shot and publish it to a hub."""
+    def __init__(self, hub, interval=shot_poll_interval):
+        super(ShotPoller, self).__init__(name="h1ds-shot-poller")
+        self.daemon = True
+        self.hub = hub
+        self.interval = interval
+        self.shot_manager = get_backend_shot_manager()()
+
+    def run(self):
+        while True:
+            try:
+                self.hub.publish(self.shot_manager.get_latest_shot())
+            except Exception:
+                # The backend may be briefly unavailable between shots;
+                # try again next interval.
+                pass
+            time.sleep(self.interval)
+
+_hub = None
+_listener = None
+_lock = threading.Lock()
+
+def refresh_shot_index(shot_number):
+    from h1ds_core.models import Shot
+    Shot.backend.shot_index.refresh(int(shot_number))
+
+# NewShotEvent updates the shot index in the sending process; do the
+# same here.
+subscribe_event('new_shot', refresh_shot_index)
+
+def get_event_listener():
+    """Get this process's event bus listener, or None if not enabled.
+
+    The listener binds a socket and starts a thread, so it is started
+    on first use in each process (see start_event_listener) rather than
+    at import, which may happen in the parent of forked workers.
+    """
+    global _listener
+    if event_socket_dir is None:
+        return None
+    if _listener is None or _listener.pid != os.getpid():
+        with _lock:
+            if _listener is None or _listener.pid != os.getpid():
+                listener = EventListener(event_socket_dir)
+                listener.start()
+                _listener = listener
+    return _listener
+
+def start_event_listener(**kwargs):
+    """Start the event bus listener of a worker process.
+
+    Connected to request_started, so each worker starts its listener
+    with its first request. Servers which fork workers may instead call
+    this from a post-fork hook (e.g. gunicorn's post_fork) to receive
+    events before then.
+    """
+    get_event_listener()
+
+request_started.connect(start_event_listener)
+
+def get_shot_event_hub():
+    """Get the process-wide hub, connecting it to a shot source on first use."""
+    global _hub
+    if _hub is None:
+        listener = get_event_listener()
+        with _lock:
+            if _hub is None:
+                hub = ShotEventHub()
+                try:
+                    hub.publish(get_backend_shot_manager()().get_latest_shot())
+                except Exception:
+                    pass
+                if listener is not None:
+                    subscribe_event('new_shot',
+                                    lambda value: hub.publish(int(value)))
+                else:
+                    ShotPoller(hub).start()
+                _hub = hub
+    return _hub
+
+def get_latest_shot():
+    return get_shot_event_hub().latest_shot
+
+def shot_event_stream(hub, last_shot=None, heartbeat=shot_stream_heartbeat):
+    """Generate Server-Sent Events for new shots.
+
+    If the client  reconnects with the last shot it  saw, and a newer
+    shot has  arrived in the meantime,  the latest shot is sent straight
+    away.
+
+    """
+    yield "retry: %d\n\n" % (1000*shot_poll_interval)
+    version, latest_shot = hub.version, hub.latest_shot
+    if last_shot is not None and latest_shot not in (None, last_shot):
+        yield "id: %s\nevent: new_shot\ndata: %s\n\n" % (latest_shot,
+                                                         latest_shot)
+    while True:
+        new_version, new_shot = hub.wait(version, heartbeat)
+        if new_version == version:
+            yield ": heartbeat\n\n"
+            continue
+        version = new_version
+        previous_shot, latest_shot = latest_shot, new_shot
+        # If the hub has only just started, the first shot published is
+        # the one the client is already looking at, not a new one.
+        if previous_shot is not None:
+            yield "id: %s\nevent: new_shot\ndata: %s\n\n" % (latest_shot,
+                                                             latest_shot)
+
+class ShotEventStream(object):
+    """shot_event_stream for one client, holding a client slot of the hub.
+
+    The slot is taken with connect() before the stream is created, and
+    released when the server closes the response, even if the stream
+    was never started.
+    """
+    def __init__(self, hub, last_shot=None):
+        self.hub = hub
+        self.events = shot_event_stream(hub, last_shot)
+        self.closed = False
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.events.close()
+            self.hub.disconnect()
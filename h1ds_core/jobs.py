@@ -0,0 +1,166 @@
+"""Background execution of slow filter chains.
+
+A request for a node with async=1 in its query submits a job which reads
+the node's data and applies the requested filters, and gets the job URL
+straight away instead of waiting for the data. The filtered data are
+stored in the data cache (see h1ds_core.cache), so once the job is done
+the node URL without async=1 is answered from the cache. Without a data
+cache, requests with async=1 get a 503 response.
+
+Job state is kept in the cache named by settings.H1DS_JOB_CACHE, which
+must be  shared between processes, so that any process can answer for
+the state of a job. The same node and filters for a shot share one job.
+Jobs are run by the executor named by settings.H1DS_JOB_EXECUTOR:
+
+    'thread' -- a pool of H1DS_JOB_WORKERS threads in the web process.
+    'eager'  -- run while the job is submitted, for tests.
+    'celery' -- the run_filter_job task in h1ds_core.tasks.
+
+Only the 'eager' executor may do without H1DS_JOB_CACHE, when the default
+cache is used. Clients poll the job URL for its state. A job which is
+pending or running but hasn't changed state for H1DS_JOB_TIMEOUT seconds
+(e.g. because the process running it died) is reported as failed, and
+is run again when it is next submitted.
+
+"""
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.http import QueryDict
+
+from h1ds_core.models import Node
+from h1ds_core.base import parse_filter_query
+from h1ds_core.cache import data_cache, data_cache_timeout
+from h1ds_core.cache import get_cached_data, set_cached_data
+
+if hasattr(settings, "H1DS_JOB_EXECUTOR"):
+    job_executor = settings.H1DS_JOB_EXECUTOR
+else:
+    job_executor = 'thread'
+
+if hasattr(settings, "H1DS_JOB_CACHE"):
+    job_cache = get_cache(settings.H1DS_JOB_CACHE)
+elif job_executor == 'eager' or data_cache is None:
+    # Jobs run in the process submitting them, or not at all.
+    job_cache = get_cache('default')
+else:
+    raise ImproperlyConfigured("H1DS_JOB_CACHE must name a cache shared "
+                               "between processes to run jobs with the "
+                               "%r executor." % job_executor)
+
+# Seconds after which a pending or running job is taken to have failed.
+if hasattr(settings, "H1DS_JOB_TIMEOUT"):
+    job_timeout = settings.H1DS_JOB_TIMEOUT
+else:
+    job_timeout = 10*60
+
+if hasattr(settings, "H1DS_JOB_WORKERS"):
+    job_workers = settings.H1DS_JOB_WORKERS
+else:
+    job_workers = 2
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+def jobs_enabled():
+    """Jobs need the data cache to hold their results."""
+    return data_cache is not None
+
+def get_job_id(shot_number, nodepath, filter_query):
+    job_name = u'%d:%s:%s' % (int(shot_number), nodepath, filter_query)
+    return hashlib.sha1(job_name.encode('utf-8')).hexdigest()
+
+def get_job_key(job_id):
+    return 'h1ds_job:%s' % job_id
+
+def get_job(job_id):
+    """Get the state of a job as a dict, or None if there is no such job.
+
+    Pending or running jobs which have timed out are returned as failed.
+    """
+    job = job_cache.get(get_job_key(job_id))
+    if (job is not None and job['state'] in (JOB_PENDING, JOB_RUNNING) and
+        time.time() - job.get('updated', 0) > job_timeout):
+        job['state'] = JOB_FAILED
+        job['error'] = 'Timed out'
+    return job
+
+def set_job_state(job, state, error=''):
+    job['state'] = state
+    job['error'] = error
+    job['updated'] = time.time()
+    job_cache.set(get_job_key(job['id']), job, data_cache_timeout)
+
+def run_filter_job(job_id):
+    """Read and filter the node data of a job into the data cache."""
+    job = get_job(job_id)
+    if job is None or job['state'] in (JOB_DONE, JOB_RUNNING):
+        return
+    set_job_state(job, JOB_RUNNING)
+    try:
+        node = Node.objects.resolve(job['shot'], job['nodepath'])
+        if get_cached_data(node, job['filter_query']) is None:
+            node.data = node.read_primary_data()
+            node.apply_filter_list(
+                parse_filter_query(QueryDict(job['filter_query'])))
+            set_cached_data(node, job['filter_query'])
+    except Exception as e:
+        set_job_state(job, JOB_FAILED, error=str(e))
+    else:
+        set_job_state(job, JOB_DONE)
+
+def run_filter_job_in_thread(job_id):
+    try:
+        run_filter_job(job_id)
+    finally:
+        connection.close()
+
+_job_pool = None
+_job_pool_lock = threading.Lock()
+
+def get_job_pool():
+    global _job_pool
+    if _job_pool is None:
+        with _job_pool_lock:
+            if _job_pool is None:
+                _job_pool = ThreadPool(job_workers)
+    return _job_pool
+
+def execute_job(job_id):
+    if job_executor == 'eager':
+        run_filter_job(job_id)
+    elif job_executor == 'thread':
+        get_job_pool().apply_async(run_filter_job_in_thread, (job_id,))
+    elif job_executor == 'celery':
+        from h1ds_core.tasks import run_filter_job_task
+        run_filter_job_task.delay(job_id)
+    else:
+        raise ValueError("Unknown H1DS_JOB_EXECUTOR: %s" % job_executor)
+
+def submit_filter_job(shot_number, nodepath, filter_query):
+    """Submit a job filtering node data for a shot, returning its state.
+
+    If the same job is already pending, running or done, it is returned
+    rather than submitted again; failed and timed out jobs are
+    resubmitted.
+
+    """
+    job_id = get_job_id(shot_number, nodepath, filter_query)
+    job = {'id':job_id, 'shot':int(shot_number), 'nodepath':nodepath,
+           'filter_query':filter_query, 'state':JOB_PENDING, 'error':'',
+           'updated':time.time()}
+    if not job_cache.add(get_job_key(job_id), job, data_cache_timeout):
+        existing_job = get_job(job_id)
+        if existing_job is not None and existing_job['state'] != JOB_FAILED:
+            return existing_job
+        set_job_state(job, JOB_PENDING)
+    execute_job(job_id)
+    return get_job(job_id) or job
@@ -1,13 +1,151 @@
-"""Add specified shots."""
+"""Add specified shots.
+
+Shots may be given as numbers or inclusive ranges (e.g. 80000-80100).
+Data trees  are built from  the primary data  source in a pool  of worker
+processes,  and  each shot  is  written  to  the database  in  a  single
+transaction by the  main process.  Shots which are already  in the
+database, or listed in the checkpoint file, are skipped, so an
+interrupted run can simply be restarted. The command waits for caches
+to be warmed for the last shot added (see h1ds_core.cache) before it
+exits.
+
+"""
+import os
+import time
+import traceback
+from multiprocessing import Pool
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
-from h1ds_core.models import Shot
+from django.db import connection
+from h1ds_core.models import Shot, Node
+from h1ds_core.cache import wait_for_cache_warming
+from h1ds_core import utils
+
+def parse_shot_ranges(args):
+    """Return sorted shot numbers from numbers and ranges like 80000-80100."""
+    try:
+        return utils.parse_shot_ranges(args)
+    except ValueError as e:
+        raise CommandError(str(e))
+
+def build_shot(shot_number):
+    """Build shot data trees in memory.
+
+    Runs  in a  worker process,  so returns  only picklable  values: the
+    shot number, timestamp and a list of (node field dict, template node)
+    in tree order, or the shot number and a traceback if the build
+    failed.
+
+    """
+    try:
+        shot = Shot(number=shot_number)
+        shot.timestamp = Shot.backend.get_timestamp_for_shot(shot_number)
+        nodes = Node.datatree.build_shot_tree(shot)
+        node_fields = [(dict((f.attname, getattr(n, f.attname))
+                             for f in Node._meta.fields),
+                        getattr(n, '_template_node', None)) for n in nodes]
+        return shot_number, shot.timestamp, node_fields, None
+    except Exception:
+        return shot_number, None, None, traceback.format_exc()
+
+def build_shot_in_worker(shot_number):
+    """build_shot for a worker process, which closes its connection.
+
+    Workers query the database for structure templates (see
+    BaseDataTreeManager.clone_tree), so each has its own connection.
+
+    """
+    try:
+        return build_shot(shot_number)
+    finally:
+        connection.close()
+
+def unpack_node(fields, template_node):
+    node = Node(**fields)
+    if template_node is not None:
+        node._template_node = template_node
+    return node
 
 class Command(BaseCommand):
-    args = '<shot_number shot_number ...>'
+    args = '<shot_number|first-last shot_number|first-last ...>'
     help = 'Add specified shots.'
 
-    def handle(self, *args, **kwargs):
-        for shot_number in map(int, args):
-            s = Shot(number=shot_number)
-            s.save()
-            self.stdout.write('Successfully added shot %d' % shot_number)
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of worker processes building shot trees.'),
+        make_option('--checkpoint',
+                    dest='checkpoint',
+                    default=None,
+                    help='File recording completed shots; these are skipped on rerun.'),
+        )
+
+    def read_checkpoint(self, checkpoint):
+        if checkpoint is None or not os.path.exists(checkpoint):
+            return set()
+        with open(checkpoint) as checkpoint_file:
+            return set(int(line) for line in checkpoint_file if line.strip())
+
+    def handle(self, *args, **options):
+        shot_numbers = parse_shot_ranges(args)
+        completed = self.read_checkpoint(options['checkpoint'])
+        if shot_numbers:
+            # A range query, as a long list of shots would exceed the
+            # number of query parameters allowed by some databases.
+            completed.update(Shot.objects.filter(
+                    number__gte=shot_numbers[0],
+                    number__lte=shot_numbers[-1]).values_list('number', flat=True))
+        todo = [s for s in shot_numbers if not s in completed]
+        if len(todo) < len(shot_numbers):
+            self.stdout.write('Skipping %d completed shots'
+                              % (len(shot_numbers)-len(todo)))
+
+        checkpoint_file = None
+        if options['checkpoint'] is not None:
+            checkpoint_file = open(options['checkpoint'], 'a')
+
+        if options['workers'] > 1:
+            # Worker processes open their own database connections, and
+            # must not inherit this one.
+            connection.close()
+            pool = Pool(options['workers'])
+            results = pool.imap_unordered(build_shot_in_worker, todo)
+        else:
+            pool = None
+            results = (build_shot(s) for s in todo)
+
+        t0 = time.time()
+        n_shots, n_nodes, n_failed = 0, 0, 0
+        try:
+            for shot_number, timestamp, node_fields, error in results:
+                if error is not None:
+                    n_failed += 1
+                    self.stderr.write('Failed to add shot %d\n%s'
+                                      % (shot_number, error))
+                    continue
+                shot = Shot(number=shot_number, timestamp=timestamp)
+                shot.save(nodes=[unpack_node(*n) for n in node_fields])
+                if checkpoint_file is not None:
+                    checkpoint_file.write('%d\n' % shot_number)
+                    checkpoint_file.flush()
+                n_shots += 1
+                n_nodes += len(node_fields)
+                elapsed = max(time.time() - t0, 1.e-6)
+                self.stdout.write('Successfully added shot %d (%d nodes) '
+                                  '[%.1f shots/min, %.1f nodes/s]'
+                                  % (shot_number, len(node_fields),
+                                     60*n_shots/elapsed, n_nodes/elapsed))
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if checkpoint_file is not None:
+                checkpoint_file.close()
+
+        self.stdout.write('Added %d shots (%d nodes), %d failed, in %.1f s'
+                          % (n_shots, n_nodes, n_failed, time.time() - t0))
+        # Cache warming runs in a daemon thread, which would be killed
+        # when the command exits.
+        wait_for_cache_warming()
@@ -0,0 +1,122 @@
+"""Measure the time taken to import the H1DS URL configuration.
+
+Each import is timed in a fresh Python process,  so nothing is already
+imported. Times can be recorded in a baseline file with --record; later
+runs then fail if the best time of a module exceeds its baseline time by
+more than the tolerance  (a fraction of the baseline), so the command
+can be run as a check against startup time regressions. Modules without
+a baseline are checked against the absolute budget.
+
+"""
+import os
+import sys
+import json
+import subprocess
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+if hasattr(settings, "H1DS_IMPORT_TIME_BUDGET"):
+    import_time_budget = settings.H1DS_IMPORT_TIME_BUDGET
+else:
+    import_time_budget = 2.0
+
+# JSON file of module name -> baseline import time in seconds.
+if hasattr(settings, "H1DS_IMPORT_TIME_BASELINE"):
+    import_time_baseline = settings.H1DS_IMPORT_TIME_BASELINE
+else:
+    import_time_baseline = None
+
+if hasattr(settings, "H1DS_IMPORT_TIME_TOLERANCE"):
+    import_time_tolerance = settings.H1DS_IMPORT_TIME_TOLERANCE
+else:
+    import_time_tolerance = 0.2
+
+IMPORT_TIMER = """
+import time
+t0 = time.time()
+import %s
+print(time.time() - t0)
+"""
+
+class Command(BaseCommand):
+    args = '<module module ...>'
+    help = ('Time the import of h1ds_core.urls (or the given modules) in a '
+            'new process, failing if it is slower than the baseline.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat',
+                    dest='repeat',
+                    type='int',
+                    default=3,
+                    help='Number of times to import each module; the best time is used.'),
+        make_option('--budget',
+                    dest='budget',
+                    type='float',
+                    default=import_time_budget,
+                    help='Maximum import time in seconds for modules without a baseline.'),
+        make_option('--baseline',
+                    dest='baseline',
+                    default=import_time_baseline,
+                    help='JSON file of baseline import times.'),
+        make_option('--tolerance',
+                    dest='tolerance',
+                    type='float',
+                    default=import_time_tolerance,
+                    help='Allowed slowdown, as a fraction of the baseline time.'),
+        make_option('--record',
+                    action='store_true',
+                    dest='record',
+                    default=False,
+                    help='Record the times in the baseline file instead of checking them.'),
+        )
+
+    def read_baseline(self, baseline):
+        if baseline is None or not os.path.exists(baseline):
+            return {}
+        with open(baseline) as baseline_file:
+            return json.load(baseline_file)
+
+    def write_baseline(self, baseline, times):
+        with open(baseline, 'w') as baseline_file:
+            json.dump(times, baseline_file, indent=2, sort_keys=True)
+
+    def time_import(self, module_name):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        try:
+            output = subprocess.check_output(
+                [sys.executable, '-c', IMPORT_TIMER % module_name],
+                env=env, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise CommandError('Failed to import %s:\n%s' % (module_name, e.output))
+        return float(output.strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        module_names = args or ('h1ds_core.urls',)
+        if options['record'] and options['baseline'] is None:
+            raise CommandError('--record needs a baseline file.')
+        baseline = self.read_baseline(options['baseline'])
+        times = {}
+        too_slow = []
+        for module_name in module_names:
+            best_time = min(self.time_import(module_name)
+                            for i in range(options['repeat']))
+            times[module_name] = best_time
+            if module_name in baseline:
+                limit = baseline[module_name]*(1 + options['tolerance'])
+                self.stdout.write('%-30s %8.3f s (baseline %.3f s)'
+                                  % (module_name, best_time, baseline[module_name]))
+            else:
+                limit = options['budget']
+                self.stdout.write('%-30s %8.3f s' % (module_name, best_time))
+            if best_time > limit:
+                too_slow.append('%s (%.3f s > %.3f s)'
+                                % (module_name, best_time, limit))
+        if options['record']:
+            baseline.update(times)
+            self.write_baseline(options['baseline'], baseline)
+            self.stdout.write('Recorded baseline in %s' % options['baseline'])
+        elif too_slow:
+            raise CommandError('Import time regression: %s' % ', '.join(too_slow))
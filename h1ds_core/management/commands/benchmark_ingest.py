@@ -0,0 +1,54 @@
+"""Compare database queries and time taken to ingest shots."""
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from h1ds_core.models import Shot, Node
+
+INGEST_MODES = (('serial', False), ('bulk', True))
+
+class Command(BaseCommand):
+    args = '<shot_number shot_number ...>'
+    help = ('Ingest specified shots with the serial and bulk ingest paths, '
+            'reporting queries and time per shot. Existing nodes for the '
+            'shots are deleted, and the shots are left ingested with the '
+            'bulk path.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--mode',
+                    dest='mode',
+                    default=None,
+                    help='Only benchmark this ingest mode (serial or bulk).'),
+        )
+
+    def clear_shot(self, shot_number):
+        Node.objects.filter(shot__number=shot_number).delete()
+        Shot.objects.filter(number=shot_number).delete()
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('No shot numbers given.')
+        modes = [m for m in INGEST_MODES
+                 if options['mode'] in (None, m[0])]
+        if not modes:
+            raise CommandError('Unknown ingest mode: %s' % options['mode'])
+
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            for shot_number in map(int, args):
+                for mode_name, bulk_ingest in modes:
+                    self.clear_shot(shot_number)
+                    reset_queries()
+                    t0 = time.time()
+                    Shot(number=shot_number).save(bulk_ingest=bulk_ingest)
+                    elapsed = time.time() - t0
+                    n_queries = len(connection.queries)
+                    n_nodes = Node.objects.filter(shot__number=shot_number).count()
+                    self.stdout.write('shot %d %-6s nodes: %6d  queries: %6d  time: %8.2f s'
+                                      % (shot_number, mode_name, n_nodes,
+                                         n_queries, elapsed))
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            reset_queries()
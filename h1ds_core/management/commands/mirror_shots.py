@@ -0,0 +1,75 @@
+"""Copy finalized shots into the local mirror, or check mirrored shots.
+
+Requires H1DS_DATA_BACKEND = "h1ds_core.backends.mirror".
+
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from h1ds_core.models import Shot
+from h1ds_core.management.commands.addshot import parse_shot_ranges
+
+class Command(BaseCommand):
+    args = '<shot_number|first-last shot_number|first-last ...>'
+    help = 'Mirror specified shots from the primary data backend.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check',
+                    action='store_true',
+                    dest='check',
+                    default=False,
+                    help='Check mirrored shots instead of mirroring them.'),
+        make_option('--against-primary',
+                    action='store_true',
+                    dest='against_primary',
+                    default=False,
+                    help='When checking, also compare with the primary backend.'),
+        make_option('--overwrite',
+                    action='store_true',
+                    dest='overwrite',
+                    default=False,
+                    help='Mirror shots again even if already mirrored.'),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            from h1ds_core.backends import mirror
+        except AttributeError:
+            raise CommandError('H1DS_MIRROR_PRIMARY_BACKEND and H1DS_MIRROR_DIR '
+                               'must be set to use the mirror.')
+        shot_numbers = parse_shot_ranges(args)
+        shots = []
+        if shot_numbers:
+            # A range query, as a long list of shots would exceed the
+            # number of query parameters allowed by some databases.
+            wanted = set(shot_numbers)
+            shots = [s for s in Shot.objects.filter(
+                    number__gte=shot_numbers[0],
+                    number__lte=shot_numbers[-1]).order_by('number')
+                     if s.number in wanted]
+        if len(shots) < len(shot_numbers):
+            self.stdout.write('Skipping %d shots not in the database'
+                              % (len(shot_numbers)-len(shots)))
+        t0 = time.time()
+        n_failed = 0
+        for shot in shots:
+            if options['check']:
+                problems = mirror.check_mirror(shot, options['against_primary'])
+                for problem in problems:
+                    self.stderr.write('shot %d %s' % (shot.number, problem))
+                n_failed += bool(problems)
+                continue
+            if not shot.is_finalized():
+                self.stdout.write('Skipping shot %d, which is not finalized'
+                                  % shot.number)
+                continue
+            n_stored = mirror.mirror_shot(shot, overwrite=options['overwrite'])
+            if n_stored is None:
+                self.stdout.write('Shot %d is already mirrored' % shot.number)
+            else:
+                self.stdout.write('Mirrored shot %d (%d nodes)'
+                                  % (shot.number, n_stored))
+        if options['check']:
+            self.stdout.write('Checked %d shots, %d with problems, in %.1f s'
+                              % (len(shots), n_failed, time.time() - t0))
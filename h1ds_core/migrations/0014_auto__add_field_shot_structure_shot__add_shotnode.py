@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Shot.structure_shot'
+        db.add_column(u'h1ds_core_shot', 'structure_shot',
+                      self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='+', null=True, on_delete=models.PROTECT, to=orm['h1ds_core.Shot']),
+                      keep_default=False)
+
+        # Adding model 'ShotNode'
+        db.create_table(u'h1ds_core_shotnode', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('shot', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['h1ds_core.Shot'])),
+            ('node', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['h1ds_core.Node'])),
+            ('has_data', self.gf('django.db.models.fields.BooleanField')(default=True)),
+            ('n_dimensions', self.gf('django.db.models.fields.PositiveSmallIntegerField')(null=True, blank=True)),
+            ('dtype', self.gf('django.db.models.fields.CharField')(max_length=16, blank=True)),
+            ('n_channels', self.gf('django.db.models.fields.PositiveSmallIntegerField')(null=True, blank=True)),
+        ))
+        db.send_create_signal(u'h1ds_core', ['ShotNode'])
+
+        # Adding unique constraint on 'ShotNode', fields ['shot', 'node']
+        db.create_unique(u'h1ds_core_shotnode', ['shot_id', 'node_id'])
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'ShotNode', fields ['shot', 'node']
+        db.delete_unique(u'h1ds_core_shotnode', ['shot_id', 'node_id'])
+
+        # Deleting model 'ShotNode'
+        db.delete_table(u'h1ds_core_shotnode')
+
+        # Deleting field 'Shot.structure_shot'
+        db.delete_column(u'h1ds_core_shot', 'structure_shot_id')
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'h1ds_core.filter': {
+            'Meta': {'object_name': 'Filter'},
+            'code': ('python_field.fields.PythonCodeField', [], {}),
+            'data_dim': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['h1ds_core.FilterDim']", 'symmetrical': 'False'}),
+            'data_type': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['h1ds_core.FilterDtype']", 'symmetrical': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50'})
+        },
+        u'h1ds_core.filterdim': {
+            'Meta': {'object_name': 'FilterDim'},
+            'code': ('python_field.fields.PythonCodeField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        },
+        u'h1ds_core.filterdtype': {
+            'Meta': {'object_name': 'FilterDtype'},
+            'code': ('python_field.fields.PythonCodeField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        },
+        u'h1ds_core.h1dssignal': {
+            'Meta': {'object_name': 'H1DSSignal'},
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'})
+        },
+        u'h1ds_core.h1dssignalinstance': {
+            'Meta': {'ordering': "('-time',)", 'object_name': 'H1DSSignalInstance'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'signal': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['h1ds_core.H1DSSignal']"}),
+            'time': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'value': ('django.db.models.fields.CharField', [], {'max_length': '1024', 'blank': 'True'})
+        },
+        u'h1ds_core.node': {
+            'Meta': {'object_name': 'Node'},
+            'dtype': ('django.db.models.fields.CharField', [], {'max_length': '16', 'blank': 'True'}),
+            'has_data': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'level': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'lft': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'n_channels': ('django.db.models.fields.PositiveSmallIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'n_dimensions': ('django.db.models.fields.PositiveSmallIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'parent': ('mptt.fields.TreeForeignKey', [], {'blank': 'True', 'related_name': "'children'", 'null': 'True', 'to': u"orm['h1ds_core.Node']"}),
+            'path': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'path_checksum': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'rght': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'shot': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['h1ds_core.Shot']"}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50'}),
+            'structure_checksum': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '40', 'blank': 'True'}),
+            'tree_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'})
+        },
+        u'h1ds_core.pagelet': {
+            'Meta': {'object_name': 'Pagelet'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '1024'}),
+            'pagelet_type': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '2048'})
+        },
+        u'h1ds_core.pageletcoordinates': {
+            'Meta': {'object_name': 'PageletCoordinates'},
+            'coordinates': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'pagelet': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['h1ds_core.Pagelet']"}),
+            'worksheet': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['h1ds_core.Worksheet']"})
+        },
+        u'h1ds_core.shot': {
+            'Meta': {'object_name': 'Shot'},
+            'number': ('django.db.models.fields.PositiveIntegerField', [], {'primary_key': 'True'}),
+            'structure_shot': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'on_delete': 'models.PROTECT', 'to': u"orm['h1ds_core.Shot']"}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        u'h1ds_core.shotnode': {
+            'Meta': {'unique_together': "(('shot', 'node'),)", 'object_name': 'ShotNode'},
+            'dtype': ('django.db.models.fields.CharField', [], {'max_length': '16', 'blank': 'True'}),
+            'has_data': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'n_channels': ('django.db.models.fields.PositiveSmallIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'n_dimensions': ('django.db.models.fields.PositiveSmallIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'node': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['h1ds_core.Node']"}),
+            'shot': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['h1ds_core.Shot']"})
+        },
+        u'h1ds_core.usersignal': {
+            'Meta': {'object_name': 'UserSignal'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_fixed_to_shot': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '1024'}),
+            'ordering': ('django.db.models.fields.IntegerField', [], {'blank': 'True'}),
+            'shot': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '2048'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'h1ds_core.worksheet': {
+            'Meta': {'object_name': 'Worksheet'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_public': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'pagelets': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['h1ds_core.Pagelet']", 'through': u"orm['h1ds_core.PageletCoordinates']", 'symmetrical': 'False'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        }
+    }
+
+    complete_apps = ['h1ds_core']
\ No newline at end of file
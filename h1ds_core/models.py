@@ -5,129 +5,163 @@ H1DS Core contains models for communicating between H1DS modules.
 
 """
 import hashlib
-import inspect
-import re
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import get_cache
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal
 from django.forms import ModelForm
 from django.utils.importlib import import_module
 from django.template.defaultfilters import slugify
+from django.utils.http import urlencode
+from django.utils import timezone
 
 from python_field.fields import PythonCodeField
 from mptt.models import MPTTModel, TreeForeignKey
 from mptt.managers import TreeManager
 
-from h1ds_core.filters import BaseFilter, excluded_filters
-from h1ds_core.utils import get_backend_shot_manager
+from h1ds_core.base import filter_manager, get_filter_list, parse_filter_query
+from h1ds_core.utils import get_backend_shot_manager, LRUCache, fragment_cache
+from h1ds_core.timing import timed
 
 if hasattr(settings, "WORKSHEETS_PUBLIC_BY_DEFAULT"):
     public_worksheets_default = settings.WORKSHEETS_PUBLIC_BY_DEFAULT
 else:
     public_worksheets_default = False
 
-# Match strings "f(fid)_name", where fid is the filter ID
-filter_name_regex = re.compile('^f(?P<fid>\d+)')
+if hasattr(settings, "H1DS_NODE_CACHE_SIZE"):
+    node_cache_size = settings.H1DS_NODE_CACHE_SIZE
+else:
+    node_cache_size = 10000
+
+# Name of a cache in settings.CACHES to share node resolutions between
+# processes, in addition to the in-process cache.
+if hasattr(settings, "H1DS_NODE_CACHE"):
+    shared_node_cache = get_cache(settings.H1DS_NODE_CACHE)
+else:
+    shared_node_cache = None
+
+# Shots searched  per query, and  in total, when looking  for the next
+# or previous shot in which a node has data.
+if hasattr(settings, "H1DS_NAVIGATION_WINDOW"):
+    navigation_window = settings.H1DS_NAVIGATION_WINDOW
+else:
+    navigation_window = 20
+
+if hasattr(settings, "H1DS_NAVIGATION_MAX_SHOTS"):
+    navigation_max_shots = settings.H1DS_NAVIGATION_MAX_SHOTS
+else:
+    navigation_max_shots = 100
+
+if hasattr(settings, "H1DS_SHARED_TREE_STRUCTURE"):
+    shared_tree_structure = settings.H1DS_SHARED_TREE_STRUCTURE
+else:
+    shared_tree_structure = False
 
-# Match strings "f(fid)_kwarg_(arg name)", where fid is the filter ID
-filter_kwarg_regex = re.compile('^f(?P<fid>\d+)_(?P<kwarg>.+)')
-    
 backend_module = import_module(settings.H1DS_DATA_BACKEND)
 
-def get_filter_list(request):
-    """Parse GET query sring and return sorted list of filter names.
+def canonical_filter_chain(query_dict):
+    """Return the filters in a query dict as a canonical query string.
+
+    Filters are renumbered from 0 in the order they are applied, their
+    arguments are sorted and other query parameters are dropped, so
+    equivalent queries give the same string.
 
-    Arguments:
-    request -- a HttpRequest instance with HTTP GET parameters.
-    
-    """
-    filter_list = []
-
-    if not request.method == 'GET':
-        # If the HTTP method is not GET, return an empty list.
-        return filter_list
-
-    # First, create a dictionary with filter numbers as keys:
-    # e.g. {1:{'name':filter, 'args':{1:arg1, 2:arg2, ...}, kwargs:{}}
-    # note  that the  args  are stored  in  a dictionary  at this  point
-    # because we cannot assume GET query will be ordered.
-    filter_dict = {}
-    for key, value in request.GET.iteritems():
-        kwarg_match = filter_kwarg_regex.match(key)
-        if kwarg_match != None:
-            fid = int(kwarg_match.groups()[0])
-            kwarg = kwarg_match.groups()[1]
-            if not filter_dict.has_key(fid):
-                filter_dict[fid] = {'name':"", 'kwargs':{}}
-            filter_dict[fid]['kwargs'][kwarg] = value
-            continue
-        
-        name_match = filter_name_regex.match(key)
-        if name_match != None:
-            fid = int(name_match.groups()[0])
-            if not filter_dict.has_key(fid):
-                filter_dict[fid] = {'name':"", 'kwargs':{}}
-            filter_dict[fid]['name'] = value
-            continue
-    
-    for fid, filter_data in sorted(filter_dict.items()):
-        filter_list.append([fid, filter_data['name'], filter_data['kwargs']])
-
-    return filter_list
-
-def get_all_filters():
-    """Get all filters from modules listed in settings.DATA_FILTER_MODULES."""
-    filters = {}
-    for filter_module_name in settings.DATA_FILTER_MODULES:
-        mod = import_module(filter_module_name)
-        mod_filters = [cl for name, cl in inspect.getmembers(mod) if
-                       inspect.isclass(cl) and issubclass(cl, BaseFilter) and
-                       not cl in excluded_filters]
-        filters.update((f.get_slug(), f) for f in mod_filters)
-    return filters
-
-class FilterManager(object):
-    """Get available filters for given data.
-
-    FilterManager caches lookups to avoid repeated checks of filters for
-    available datatypes.
     """
-    def __init__(self):
-        self.filters = get_all_filters()
-        self.cache = {}
-
-    def get_filters(self, data):
-        """Get available processing filters for data object provided."""
-
-        data_type = (data.get_n_dimensions(), data.value_dtype)
-        if not self.cache.has_key(data_type):
-            data_filters = {}
-            for fname, filter_ in self.filters.iteritems():
-                if filter_.is_filterable(data):
-                    data_filters[fname] = filter_
-            self.cache[data_type] = data_filters
-        return self.cache[data_type]
+    items = []
+    for i, (fid, name, kwargs) in enumerate(parse_filter_query(query_dict)):
+        items.append(('f%d' % i, name))
+        items.extend(('f%d_%s' % (i, k), v) for k, v in sorted(kwargs.items()))
+    return urlencode(items)
+
+# Sent by Shot.save once a shot  and its nodes are written and committed,
+# unlike post_save, which is sent before any nodes exist.
+shot_ingested = Signal(providing_args=["instance"])
 
 class Shot(models.Model):
     number = models.PositiveIntegerField(primary_key=True)
     timestamp = models.DateTimeField()
+
+    # With settings.H1DS_SHARED_TREE_STRUCTURE, a shot whose trees have
+    # the same structure as an earlier  shot stores no Node rows of its
+    # own.  Instead it  references the  shot which  holds the  nodes, and
+    # ShotNode rows  hold any  per-shot data  metadata which  differs from
+    # those nodes.
+    structure_shot = models.ForeignKey('self', null=True, blank=True,
+                                       related_name='+',
+                                       on_delete=models.PROTECT)
+
+    # When the shot was last written, so a shot which is deleted and
+    # ingested again gets a new version (see ShotIndex.get_version).
+    ingest_time = models.DateTimeField(null=True, blank=True)
     
     objects = models.Manager()
     backend = get_backend_shot_manager()()
 
+    def get_structure_shot_number(self):
+        """Number of the shot holding the Node rows for this shot."""
+        if self.structure_shot_id is None:
+            return self.number
+        return self.structure_shot_id
+
     def _get_root_nodes(self):
-        return Node.objects.filter(level=0, shot=self)
+        if self.structure_shot_id is None:
+            return Node.objects.filter(level=0, shot=self)
+        root_nodes = Node.objects.filter(level=0, shot__number=self.structure_shot_id)
+        return [n.bind_shot(self, load_data_metadata=False) for n in root_nodes]
 
     root_nodes = property(_get_root_nodes)
 
     def get_absolute_url(self):
         return reverse('shot-detail', kwargs={'shot':self.number})
 
+    def is_finalized(self):
+        """True once a later shot exists, after which shot data won't change."""
+        return Shot.backend.get_next_shot_number(self.number) is not None
+
     def save(self, *args, **kwargs):
-        self.timestamp = Shot.backend.get_timestamp_for_shot(self.number)
-        super(Shot, self).save(*args, **kwargs)
-        self._populate()
+        """Save shot and populate its data trees.
+
+        By default  the node  trees are  built in  memory and  written with
+        bulk_create in the same transaction as the shot. Pass
+        bulk_ingest=False to save nodes one at a time instead.
+
+        Trees which have already  been built elsewhere (e.g. in a worker
+        process) can be passed as  nodes, a list of unsaved nodes from
+        Node.datatree.build_shot_tree(). The timestamp must then already
+        be set.
+
+        shot_ingested is sent once the shot and its nodes are committed.
+
+        """
+        bulk_ingest = kwargs.pop('bulk_ingest', True)
+        nodes = kwargs.pop('nodes', None)
+        self.ingest_time = timezone.now()
+        if nodes is None:
+            self.timestamp = Shot.backend.get_timestamp_for_shot(self.number)
+        if not bulk_ingest:
+            super(Shot, self).save(*args, **kwargs)
+            self._populate()
+            shot_ingested.send(sender=Shot, instance=self)
+            return
+        if nodes is None:
+            # Walk the primary data source before opening the transaction.
+            nodes = Node.datatree.build_shot_tree(self)
+        with transaction.commit_on_success():
+            if shared_tree_structure:
+                self.structure_shot_id = Node.datatree.get_shared_structure_shot(nodes)
+            super(Shot, self).save(*args, **kwargs)
+            if self.structure_shot_id is None:
+                Node.datatree.bulk_create_shot_tree(self, nodes)
+            else:
+                ShotNode.objects.bulk_create(
+                    ShotNode(shot=self, node=n._template_node,
+                             **n.get_stored_data_metadata())
+                    for n in nodes if n.get_stored_data_metadata() !=
+                    n._template_node.get_stored_data_metadata())
+        shot_ingested.send(sender=Shot, instance=self)
 
     def _populate(self):
         for tree in Node.datatree.get_trees():
@@ -135,8 +169,146 @@ class Shot(models.Model):
             node.save()
             node.populate_child_nodes()
 
-        
-filter_manager = FilterManager()
+
+# (shot number, shot version, path checksum) -> node resolution, see
+# NodeManager.resolve
+node_cache = LRUCache(node_cache_size)
+
+class NodeManager(TreeManager):
+
+    def _get_resolution(self, node):
+        """Get everything needed to rebuild node without the database."""
+        ancestry = node.get_ancestry()
+        return {
+            'node':dict((f.attname, getattr(node, f.attname))
+                        for f in self.model._meta.fields),
+            'shot':dict((f.attname, getattr(node.shot, f.attname))
+                        for f in Shot._meta.fields),
+            'structure_shot_id':getattr(node, '_structure_shot_id', None),
+            'ancestry':[dict((f.attname, getattr(n, f.attname))
+                             for f in self.model._meta.fields)
+                        for n in ancestry[:-1]],
+            }
+
+    def _from_resolution(self, resolution):
+        node = self.model(**resolution['node'])
+        node.shot = Shot(**resolution['shot'])
+        ancestry = [self.model(**fields) for fields in resolution['ancestry']]
+        for ancestor in ancestry:
+            ancestor.shot = node.shot
+        if resolution['structure_shot_id'] is not None:
+            node._structure_shot_id = resolution['structure_shot_id']
+            for ancestor in ancestry:
+                ancestor._structure_shot_id = resolution['structure_shot_id']
+        if ancestry:
+            # Saves a query for node.parent, e.g. in NodeSerializer.
+            node.parent = ancestry[-1]
+        node._ancestry = ancestry + [node]
+        return node
+
+    def prefetch_children(self, nodes):
+        """Fetch the children of nodes in a single query, for get_children."""
+        nodes = [n for n in nodes if not n.is_leaf_node() and
+                 not hasattr(n, '_children')]
+        if not nodes:
+            return
+        children = dict((n.pk, []) for n in nodes)
+        for child in self.filter(parent__in=children.keys()).order_by('tree_id', 'lft'):
+            children[child.parent_id].append(child)
+        for node in nodes:
+            node._children = children[node.pk]
+
+    def resolve(self, shot_number, nodepath):
+        """Get node for a shot from its node path, using the node cache.
+
+        Resolutions are kept in an  in-process LRU cache and, if
+        settings.H1DS_NODE_CACHE names  a cache, shared  between processes.
+        A cached node, including its shot and ancestry, is rebuilt without
+        any database queries. Cache keys include the shot version from
+        the shot index, so a shot ingested again gets fresh resolutions.
+
+        """
+        shot_number = int(shot_number)
+        path_checksum = hashlib.sha1(nodepath.encode('utf-8')).hexdigest()
+        version = Shot.backend.shot_index.get_version(shot_number)
+        key = (shot_number, version, path_checksum)
+        shared_key = 'h1ds_node:%d:%s:%s' % key
+        resolution = node_cache.get(key)
+        if resolution is None and shared_node_cache is not None:
+            resolution = shared_node_cache.get(shared_key)
+            if resolution is not None:
+                node_cache.set(key, resolution)
+        if resolution is None:
+            node = self.get_for_shot(shot_number, path_checksum)
+            resolution = self._get_resolution(node)
+            node_cache.set(key, resolution)
+            if shared_node_cache is not None:
+                shared_node_cache.set(shared_key, resolution)
+        return self._from_resolution(resolution)
+
+    def get_tree_listing(self, shot, root_node=None, depth=None):
+        """Get nested node summaries for a shot, or a subtree of it.
+
+        All nodes are read in a  single query (an MPTT lft range for a
+        subtree), optionally limited to depth levels below root_node (or
+        below the tree roots for a whole shot). Each node is a dict with
+        path, nodepath, data metadata and a list of children. No data is
+        read from the backend.
+
+        """
+        fields = ('id', 'path', 'slug', 'level', 'has_data', 'dtype',
+                  'n_dimensions', 'n_channels')
+        if root_node is None:
+            nodes = self.filter(shot__number=shot.get_structure_shot_number())
+            max_level = depth
+            parent_path = ""
+        else:
+            nodes = self.filter(tree_id=root_node.tree_id,
+                                lft__gte=root_node.lft, lft__lte=root_node.rght)
+            max_level = None if depth is None else root_node.level + depth
+            parent_path = root_node.nodepath.rpartition("/")[0]
+        if max_level is not None:
+            nodes = nodes.filter(level__lte=max_level)
+        nodes = nodes.order_by('tree_id', 'lft').values(*fields)
+
+        metadata = {}
+        if shot.structure_shot_id is not None:
+            for shot_node in ShotNode.objects.filter(shot=shot):
+                metadata[shot_node.node_id] = shot_node.get_stored_data_metadata()
+
+        roots = []
+        stack = []
+        for node in nodes:
+            while stack and stack[-1][0] >= node['level']:
+                stack.pop()
+            if stack:
+                nodepath = stack[-1][1]['nodepath'] + "/" + node['slug']
+                siblings = stack[-1][1]['children']
+            else:
+                nodepath = "/".join(filter(None, [parent_path, node['slug']]))
+                siblings = roots
+            summary = {'path':node['path'], 'nodepath':nodepath}
+            summary.update((k, node[k]) for k in
+                           ('has_data', 'dtype', 'n_dimensions', 'n_channels'))
+            summary.update(metadata.get(node['id'], {}))
+            summary['children'] = []
+            siblings.append(summary)
+            stack.append((node['level'], summary))
+        return roots
+
+    def get_for_shot(self, shot_number, path_checksum):
+        """Get node for a shot from its path checksum.
+
+        Nodes of shots which reference a shared tree structure are looked
+        up in the structure shot and bound to the requested shot.
+
+        """
+        shot = Shot.objects.get(number=shot_number)
+        if shot.structure_shot_id is None:
+            return self.get(shot=shot, path_checksum=path_checksum)
+        node = self.get(shot__number=shot.structure_shot_id,
+                        path_checksum=path_checksum)
+        return node.bind_shot(shot)
 
 class Node(MPTTModel, backend_module.NodeData):
     """Node of a data tree.
@@ -175,6 +347,19 @@ class Node(MPTTModel, backend_module.NodeData):
     # node. The  SHA1 is simply generated  from the full tree  path of
     # the node when the node is saved.
     path_checksum = models.CharField(max_length=40)
+
+    # Full  slug path  of the  node  (as used  in URLs),  stored at  ingest
+    # so nodepath doesn't need to query the node ancestry.
+    slug_path = models.CharField(max_length=1024, blank=True)
+
+    # Fingerprint of the structure of the tree below a root node, from
+    # DataTreeManager.get_structure_fingerprint(). Only set for root
+    # nodes; used to reuse the layout of an earlier shot during ingest.
+    structure_checksum = models.CharField(max_length=40, blank=True, db_index=True)
+
+    class Meta:
+        # Nodes are looked up by shot and path checksum, see NodeManager.
+        index_together = [['shot', 'path_checksum']]
     
     ## TODO:
     ## have n_channels
@@ -192,16 +377,43 @@ class Node(MPTTModel, backend_module.NodeData):
     #primary_dim = None
     #primary_labels = None
     
+    def get_ancestry(self):
+        """Get ancestors, including self.
+
+        Nodes built  in memory during  bulk ingest carry  their ancestry,
+        otherwise it is read from the database.
+
+        """
+        if hasattr(self, '_ancestry'):
+            return self._ancestry
+        return list(self.get_ancestors(include_self=True))
+
+    def set_ancestry(self, ancestry):
+        """Set in-memory ancestry (including self), slug_path and path_checksum."""
+        self._ancestry = ancestry
+        self.slug_path = "/".join([n.slug for n in ancestry])
+        self.path_checksum = self._get_sha1()
+
+    def set_data_metadata(self, metadata):
+        """Store summary of primary data, as from get_data_metadata()."""
+        self.has_data = metadata['has_data']
+        self.n_dimensions = metadata['n_dimensions']
+        self.dtype = metadata['dtype']
+        self.n_channels = metadata['n_channels']
+
     # TODO: rename so that path, nodepath are intuitive
     def _get_node_path(self):
-        ancestry = self.get_ancestors(include_self=True)
+        if self.slug_path:
+            return self.slug_path
+        # Nodes ingested before slug_path was added.
+        ancestry = self.get_ancestry()
         return "/".join([n.slug for n in ancestry])
         
     nodepath = property(_get_node_path)
 
     # I'm not sure  why we need to  do this explicitly, but  if we don't
     # then .objects becomes DataTreeManager()
-    objects = TreeManager()
+    objects = NodeManager()
     datatree = backend_module.DataTreeManager()
 
     def get_data(self):
@@ -211,35 +423,78 @@ class Node(MPTTModel, backend_module.NodeData):
         return self.data
                 
     def get_absolute_url(self):
-        return reverse('node-detail', kwargs={'nodepath':self.nodepath, 'shot':self.shot.number})
+        return reverse('node-detail', kwargs={'nodepath':self.nodepath, 'shot':self.shot_id})
     
     def get_available_filters(self):
         return filter_manager.get_filters(self.data)
 
     def _get_sha1(self):
         nodepath = self._get_node_path()
-        return hashlib.sha1(nodepath).hexdigest()
+        return hashlib.sha1(nodepath.encode('utf-8')).hexdigest()
     
+    def get_stored_data_metadata(self):
+        """Get data metadata as stored on the node."""
+        return {'has_data':self.has_data,
+                'n_dimensions':self.n_dimensions,
+                'dtype':self.dtype,
+                'n_channels':self.n_channels}
+
+    def is_bound(self):
+        """True if node is from a shared structure, bound to another shot."""
+        return hasattr(self, '_structure_shot_id')
+
+    def bind_shot(self, shot, load_data_metadata=True):
+        """Use this node of a shared tree structure for another shot.
+
+        The node's shot is replaced (in memory only), and its data
+        metadata is replaced by the shot's ShotNode row, if one exists.
+        Bound nodes can't be saved. Returns the node.
+
+        """
+        if not self.is_bound():
+            self._structure_shot_id = self.shot_id
+        self.shot = shot
+        if load_data_metadata:
+            for shot_node in ShotNode.objects.filter(shot=shot, node=self):
+                self.set_data_metadata(shot_node.get_stored_data_metadata())
+        return self
+
+    def get_ancestors(self, *args, **kwargs):
+        ancestors = super(Node, self).get_ancestors(*args, **kwargs)
+        if not self.is_bound():
+            return ancestors
+        return [n.bind_shot(self.shot, load_data_metadata=False) for n in ancestors]
+
+    def get_parent(self):
+        """Get parent node, bound to the same shot as this node."""
+        if self.parent is None or not self.is_bound():
+            return self.parent
+        return self.parent.bind_shot(self.shot, load_data_metadata=False)
+
+    def get_children(self):
+        if hasattr(self, '_children'):
+            # See NodeManager.prefetch_children.
+            children = self._children
+        else:
+            children = super(Node, self).get_children()
+        if not self.is_bound():
+            return children
+        return [n.bind_shot(self.shot, load_data_metadata=False) for n in children]
+
     def save(self, *args, **kwargs):
+        if self.is_bound():
+            raise ValueError("Nodes bound to a shared tree structure can't be saved.")
         self.slug = slugify(self.path)
         super(Node, self).save(*args, **kwargs)
-        # TODO: only single channel...
-        self.primary_data = self.read_primary_data()
-        if not self.primary_data:
-            self.has_data = False
-        else:
-            self.has_data = True
-            self.n_dimensions = self.primary_data.get_n_dimensions()
-            self.dtype = self.primary_data.value_dtype
-            self.n_channels = len(self.primary_data.value)
-            
+        self.set_data_metadata(self.get_data_metadata())
+        self.slug_path = "/".join([n.slug for n in self.get_ancestry()])
         self.path_checksum = self._get_sha1()
         super(Node, self).save()#update_fields=['path_checksum'])
         # TODO: if the node name changes then we also need to regenerate
         # sha1 keys for all descendents...
     
     def __unicode__(self):
-        ancestry = self.get_ancestors(include_self=True)
+        ancestry = self.get_ancestry()
         unicode_val = unicode(ancestry[0].path)
         if len(ancestry)>1:
             unicode_val += unicode(":")
@@ -257,18 +512,55 @@ class Node(MPTTModel, backend_module.NodeData):
 
     def get_node_for_shot(self,shot_number):
         """Get same node in different shot tree, if it exists."""
-
-        node_ancestry = [i.slug for i in self.get_ancestors(include_self=True)]
-        node_ancestry[0] = str(shot_number)
-        return Node.datatree.get_node_from_ancestry(node_ancestry)
+        return Node.objects.resolve(shot_number, self.nodepath)
+
+    def _get_node_with_data(self, shot_numbers):
+        """Get this node for the first of shot_numbers where it has data.
+
+        Returns None if the node has no data in any of the shots.
+        """
+        if not shared_tree_structure:
+            # Single query, using the (shot, path_checksum) index.
+            nodes = Node.objects.filter(shot__number__in=shot_numbers,
+                                        path_checksum=self.path_checksum,
+                                        has_data=True)
+            nodes = dict((n.shot_id, n) for n in nodes)
+            for shot_number in shot_numbers:
+                if shot_number in nodes:
+                    return nodes[shot_number]
+            return None
+        for shot_number in shot_numbers:
+            try:
+                node = self.get_node_for_shot(shot_number)
+            except (Shot.DoesNotExist, Node.DoesNotExist):
+                continue
+            if node.has_data:
+                return node
+        return None
+
+    def _get_node_for_neighbouring_shot(self, get_shot_numbers):
+        shot_number = self.shot_id
+        n_searched = 0
+        while n_searched < navigation_max_shots:
+            shot_numbers = get_shot_numbers(shot_number, navigation_window)
+            if not shot_numbers:
+                return None
+            node = self._get_node_with_data(shot_numbers)
+            if node is not None:
+                return node
+            shot_number = shot_numbers[-1]
+            n_searched += len(shot_numbers)
+        return None
 
     def get_node_for_previous_shot(self):
-        previous_shot = Shot.backend.get_previous_shot_number(self.shot.number)
-        return self.get_node_for_shot(previous_shot)
+        """Get this node for the closest earlier shot where it has data."""
+        return self._get_node_for_neighbouring_shot(
+            Shot.backend.shot_index.get_preceding)
 
     def get_node_for_next_shot(self):
-        next_shot = Shot.backend.get_next_shot_number(self.shot.number)
-        return self.get_node_for_shot(next_shot)
+        """Get this node for the closest later shot where it has data."""
+        return self._get_node_for_neighbouring_shot(
+            Shot.backend.shot_index.get_following)
 
     
     def populate_child_nodes(self):
@@ -294,7 +586,12 @@ class Node(MPTTModel, backend_module.NodeData):
         #self.data = self.primary_data
         #self.dim = self.primary_dim
         #self.labels = self.primary_labels
-        for fid, name, kwargs in get_filter_list(request):
+        self.apply_filter_list(get_filter_list(request))
+
+    def apply_filter_list(self, filter_list):
+        """Apply filters from a list of [fid, name, kwargs]."""
+        self.get_data()
+        for fid, name, kwargs in filter_list:
             self.apply_filter(fid, name, **kwargs)
 
     def get_alternative_format_urls(self, request, alternative_formats):
@@ -328,7 +625,8 @@ class Node(MPTTModel, backend_module.NodeData):
         f_kwargs = self.preprocess_filter_kwargs(kwargs)
         #filter_class = filter_manager.filters[name](*f_args, **f_kwargs)
         filter_class = filter_manager.filters[name](**f_kwargs)
-        filter_class.apply(self)
+        with timed('filter_%s' % fid, name):
+            filter_class.apply(self)
         
         #self.filter_history.append((fid, name, kwargs))
         self.filter_history.append((fid, filter_class, kwargs))
@@ -336,6 +634,57 @@ class Node(MPTTModel, backend_module.NodeData):
         #self.available_filters = get_dtype_mappings(self.data)['filters']
         #self.available_views = get_dtype_mappings(self.data)['views'].keys()
             
+class ShotNode(models.Model):
+    """Per-shot data metadata for a node of a shared tree structure.
+
+    Only stored where the metadata differs from that of the node itself.
+    """
+    shot = models.ForeignKey(Shot)
+    node = models.ForeignKey(Node)
+    has_data = models.BooleanField(default=True)
+    n_dimensions = models.PositiveSmallIntegerField(blank=True, null=True)
+    dtype = models.CharField(max_length=16, blank=True)
+    n_channels = models.PositiveSmallIntegerField(blank=True, null=True)
+
+    class Meta:
+        unique_together = (("shot", "node"),)
+
+    def get_stored_data_metadata(self):
+        return {'has_data':self.has_data,
+                'n_dimensions':self.n_dimensions,
+                'dtype':self.dtype,
+                'n_channels':self.n_channels}
+
+    def __unicode__(self):
+        return unicode("%s: %s" %(self.shot_id, self.node))
+
+class TreeIdCounterManager(models.Manager):
+
+    def allocate(self, n_trees):
+        """Reserve n_trees consecutive MPTT tree_ids, returning the first.
+
+        The counter row  is locked (SELECT ...  FOR UPDATE) until the
+        calling transaction  ends, so concurrent ingests get disjoint tree
+        ids. Must be called within a transaction.
+
+        """
+        counter, created = self.select_for_update().get_or_create(pk=1)
+        max_tree_id = Node.objects.aggregate(models.Max('tree_id'))['tree_id__max']
+        first_tree_id = 0 if max_tree_id is None else max_tree_id + 1
+        first_tree_id = max(first_tree_id, counter.next_tree_id)
+        counter.next_tree_id = first_tree_id + n_trees
+        counter.save()
+        return first_tree_id
+
+class TreeIdCounter(models.Model):
+    """Next free tree_id for trees written by bulk ingest.
+
+    There is a single row, see TreeIdCounterManager.allocate().
+    """
+    next_tree_id = models.PositiveIntegerField(default=0)
+
+    objects = TreeIdCounterManager()
+
 class FilterDtype(models.Model):
 
     name = models.CharField(max_length=128)
@@ -442,3 +791,30 @@ class UserSignalForm(ModelForm):
     class Meta:
         model = UserSignal
         fields = ('name', 'is_fixed_to_shot',)
+
+def clear_node_cache(sender, **kwargs):
+    """Drop in-process node resolutions when a shot is removed.
+
+    Shared resolutions  are left to  expire, as their keys include the
+    shot version, which changes if the shot is ingested again.
+    """
+    node_cache.clear()
+
+post_delete.connect(clear_node_cache, sender=Shot)
+
+def clear_fragment_cache(sender, **kwargs):
+    """Rebuild cached page fragments after shots are added or removed."""
+    fragment_cache.clear()
+
+shot_ingested.connect(clear_fragment_cache)
+post_delete.connect(clear_fragment_cache, sender=Shot)
+
+def add_shot_to_index(sender, instance, **kwargs):
+    Shot.backend.shot_index.add(instance.number, instance.timestamp,
+                                instance.ingest_time)
+
+def remove_shot_from_index(sender, instance, **kwargs):
+    Shot.backend.shot_index.remove(instance.number)
+
+post_save.connect(add_shot_to_index, sender=Shot)
+post_delete.connect(remove_shot_from_index, sender=Shot)
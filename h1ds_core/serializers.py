@@ -1,4 +1,3 @@
-import hashlib
 import numpy as np
 
 from rest_framework import serializers
@@ -15,7 +14,7 @@ class NodeHyperlinkedIdentityField(serializers.HyperlinkedIdentityField):
         format = self.context.get('format', None)
         view_name = self.view_name or self.parent.opts.view_name
         # This line is the only difference between NodeHyperlinkedIdentityField and HyperlinkedIdentityField
-        kwargs = {'shot':obj.shot.number, 'nodepath':obj.nodepath}
+        kwargs = {'shot':obj.shot_id, 'nodepath':obj.nodepath}
 
         if request is None:
             warnings.warn("Using `HyperlinkedIdentityField` without including the "
@@ -62,15 +61,16 @@ class NodeHyperlinkedIdentityField(serializers.HyperlinkedIdentityField):
 
 class NodeHyperlinkedField(serializers.HyperlinkedRelatedField):
     def get_url(self, obj, view_name, request, format):
-        kwargs = {'shot': obj.shot.number, 'nodepath': obj.nodepath}#, 'format':format}
+        # shot_id and nodepath (Node.slug_path) are stored on the node, so
+        # no queries are needed for each linked node.
+        kwargs = {'shot': obj.shot_id, 'nodepath': obj.nodepath}#, 'format':format}
         return reverse(view_name, kwargs=kwargs, request=request, format=format)
 
 
     def get_object(self, queryset, view_name, view_args, view_kwargs):
         shot = view_kwargs['shot']
         nodepath = view_kwargs['nodepath']
-        checksum = hashlib.sha1(nodepath).hexdigest()
-        node = Node.objects.get(shot__number=shot, path_checksum=checksum)
+        node = Node.objects.resolve(shot, nodepath)
         return node
 
 class DataField(serializers.WritableField):
@@ -78,7 +78,8 @@ class DataField(serializers.WritableField):
         if np.isscalar(obj):
             return obj
         else:
-            output = [d.tolist() for d in obj]
+            # Nodes without data have the value [None].
+            output = [d.tolist() if hasattr(d, 'tolist') else d for d in obj]
             return output
         
     def from_native(self,obj):
@@ -107,11 +108,22 @@ class DataSerializer(serializers.Serializer):
 
     
 class NodeSerializer(serializers.HyperlinkedModelSerializer):
+    """Serialize a node, with links to its parent and children.
+
+    Nodes from  Node.objects.resolve() already have their parent,  so the
+    only query is for the children, prefetched for all nodes serialized
+    in a single query (see NodeManager.prefetch_children).
+    """
     # slug ?
     # data (optional depending on ?show_data query string
     path = serializers.CharField()
-    parent = NodeHyperlinkedField(view_name='node-detail')
-    children = NodeHyperlinkedField(view_name='node-detail', many=True)
+    # Use Node methods rather than the relations, so nodes of a shared
+    # tree structure link to the same shot. Method sources have no
+    # queryset, so the fields must be read only.
+    parent = NodeHyperlinkedField(view_name='node-detail', source='get_parent',
+                                  read_only=True)
+    children = NodeHyperlinkedField(view_name='node-detail', many=True,
+                                    source='get_children', read_only=True)
     #data = serializers.Field()
     data = DataSerializer(source='get_data')
     url = NodeHyperlinkedIdentityField(view_name="node-detail", slug_field="nodepath")
@@ -119,6 +131,14 @@ class NodeSerializer(serializers.HyperlinkedModelSerializer):
         model = Node
         fields = ('path', 'parent', 'children', 'data', 'url')
 
+    def __init__(self, instance=None, *args, **kwargs):
+        many = kwargs.get('many')
+        if many and instance is not None:
+            instance = list(instance)
+        super(NodeSerializer, self).__init__(instance, *args, **kwargs)
+        if instance is not None:
+            Node.objects.prefetch_children(instance if many else [instance])
+
     #data = serializers.SerializerMethodField('get_node_data')
     
     def get_node_data(self, obj):
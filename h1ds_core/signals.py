@@ -1,6 +1,8 @@
 import django.dispatch
 
-from h1ds_core.models import H1DSSignal, H1DSSignalInstance
+from h1ds_core.models import H1DSSignal, H1DSSignalInstance, Shot
+from h1ds_core.events import publish_event
+from h1ds_core.cache import start_warm_shot_cache
 
 h1ds_signal = django.dispatch.Signal(providing_args=["h1ds_sig", "value"])
 
@@ -11,13 +13,44 @@ def create_instance(sender, **kwargs):
 
 h1ds_signal.connect(create_instance)
 
-new_shot_inst, c = H1DSSignal.objects.get_or_create(name="new_shot",
-                                                    description="New Shot")
+_new_shot_signal = None
+
+def get_new_shot_signal():
+    """Get the new_shot H1DSSignal, creating it on first use."""
+    global _new_shot_signal
+    if _new_shot_signal is None:
+        _new_shot_signal, created = H1DSSignal.objects.get_or_create(
+            name="new_shot", description="New Shot")
+    return _new_shot_signal
+
+def update_shot_index(sender, **kwargs):
+    """Add a new shot to the shot index, once it is in the database.
+
+    Shots  ingested later are  added when saved, see
+    h1ds_core.models.add_shot_to_index.
+    """
+    if kwargs['h1ds_sig'].name != "new_shot":
+        return
+    Shot.backend.shot_index.refresh(int(kwargs.get('value')))
+
+h1ds_signal.connect(update_shot_index)
+
+def warm_cache(sender, **kwargs):
+    if kwargs['h1ds_sig'].name == "new_shot":
+        start_warm_shot_cache(kwargs.get('value'))
+
+h1ds_signal.connect(warm_cache)
+
+def broadcast_event(sender, **kwargs):
+    """Pass the signal on to other processes over the event bus."""
+    publish_event(kwargs['h1ds_sig'].name, kwargs.get('value', ""))
+
+h1ds_signal.connect(broadcast_event)
 
 class NewShotEvent(object):
     def __init__(self, shot_number):
         self.shot_number = shot_number
     def send_event(self):
         h1ds_signal.send(sender=self,
-                         h1ds_sig=new_shot_inst,
+                         h1ds_sig=get_new_shot_signal(),
                          value=self.shot_number)
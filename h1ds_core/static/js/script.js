@@ -114,7 +114,7 @@ function loadCookie() {
 ////////////////////////////////////////////////////////////////////////
 
 
-var shot_stream_client = new XMLHttpRequest();
+var shot_stream_client = null;
 
 // TODO: rather not have big chunks of html here - use js instead, eg http://stackoverflow.com/questions/3365325/form-action-javascriptblock-redirects-to-javascriptblock-url-in-firefo
 function turnOffShotTracker() {
@@ -122,7 +122,10 @@ function turnOffShotTracker() {
     $("#h1ds-shot-controller").show();
     $("#h1ds-toggle-track-latest-shot").html('<FORM class="inline-form right" action="." onsubmit="javascript:toggleTrackLatestShot()" method="post"><INPUT type="submit" id="h1ds-toggletrack-shot" name="h1ds-toggletrack-shot" value="track latest shot"></FORM>');
     $.cookie("shotTracking", 'false', {path:'/'});
-    shot_stream_client.abort();
+    if (shot_stream_client !== null) {
+	shot_stream_client.close();
+	shot_stream_client = null;
+    }
 }
 
 // TODO: rather not have big chunks of html here - use js instead, eg http://stackoverflow.com/questions/3365325/form-action-javascriptblock-redirects-to-javascriptblock-url-in-firefo
@@ -132,16 +135,15 @@ function turnOnShotTracker() {
     $("#h1ds-toggletrack-latest-shot").html('<FORM class="inline-form right" action="." onsubmit="javascript:toggleTrackLatestShot()" method="post"><INPUT type="submit" id="h1ds-toggletrack-shot" name="h1ds-toggletrack-shot" value="stop tracking latest shot"></FORM>');
     $.cookie("shotTracking", 'true', {path:'/'});
 
-    shot_stream_client.open('get', '/_/shot_stream/');
-    shot_stream_client.send();
-    shot_stream_client.onprogress = function(){
-	var split_response = this.responseText.split("\n");
-	// -2 because each shot has a trailing \n
-	var new_shot = split_response[split_response.length-2];
+    if (shot_stream_client !== null) {
+	return;
+    }
+    shot_stream_client = new EventSource('/_/shot_stream/');
+    shot_stream_client.addEventListener('new_shot', function(e){
 	$.getJSON("/_/url_for_shot",
-		  {'input_path':window.location.toString(), 'shot':new_shot},
+		  {'input_path':window.location.toString(), 'shot':e.data},
 		  function(d){window.location = d.new_url;});
-    };
+    });
 }
 
 function toggleTrackLatestShot() {
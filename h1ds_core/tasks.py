@@ -0,0 +1,8 @@
+"""Celery tasks, used when settings.H1DS_JOB_EXECUTOR is 'celery'."""
+from celery import task
+
+from h1ds_core.jobs import run_filter_job
+
+@task(ignore_result=True)
+def run_filter_job_task(job_id):
+    run_filter_job(job_id)
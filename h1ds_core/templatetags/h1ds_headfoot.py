@@ -2,6 +2,8 @@ from django import template
 from django.conf import settings
 from django.core.urlresolvers import reverse
 
+from h1ds_core.utils import fragment_cache
+
 register = template.Library()
 
 h1ds_installed_apps = []
@@ -33,51 +35,57 @@ def do_h1ds_title(parser, token):
     """Returns the value of H1DS_TITLE in settings.py"""
     return H1DSTitleNode()
 
+def build_header():
+    subtitle_string_list = ['<a href="/data">Data</a>']
+    for app in h1ds_installed_apps:
+        if app not in h1ds_ignore:
+            app_module =  __import__(app, globals(), locals(), [])
+            app_doc_name = app_module.MODULE_DOC_NAME
+            homepage_url_name = app.replace('_', '-')+'-homepage'
+            homepage_url = reverse(homepage_url_name)
+            html_str = '<a href="%s">%s</a>' % (homepage_url, app_doc_name)
+            subtitle_string_list.append(html_str)
+    if hasattr(settings, 'H1DS_EXTRA_SUBLINKS'):
+        sublinks = []
+        for name, url, doc in settings.H1DS_EXTRA_SUBLINKS:
+            sublinks.append('<a href="%s">%s</a>' %(url, name))
+        subtitle_string_list.extend(sublinks)
+    subtitle_strings = " &middot; ".join(subtitle_string_list)
+    if hasattr(settings, 'H1DS_TITLE'):
+        title = settings.H1DS_TITLE
+    else:
+        title = "H1 Data Server"            
+    return_string = '<div id="title"><h1><a href="/">%s</a></h1>' % (title)
+    return_string += '<div id="subtitle">'+subtitle_strings+'</div></div>'
+    return return_string
+
 class H1DSHeaderNode(template.Node):
     def render(self, context):
-        subtitle_string_list = ['<a href="/data">Data</a>']
-        for app in h1ds_installed_apps:
-            if app not in h1ds_ignore:
-                app_module =  __import__(app, globals(), locals(), [])
-                app_doc_name = app_module.MODULE_DOC_NAME
-                homepage_url_name = app.replace('_', '-')+'-homepage'
-                homepage_url = reverse(homepage_url_name)
-                html_str = '<a href="%s">%s</a>' % (homepage_url, app_doc_name)
-                subtitle_string_list.append(html_str)
-        if hasattr(settings, 'H1DS_EXTRA_SUBLINKS'):
-            sublinks = []
-            for name, url, doc in settings.H1DS_EXTRA_SUBLINKS:
-                sublinks.append('<a href="%s">%s</a>' %(url, name))
-            subtitle_string_list.extend(sublinks)
-        subtitle_strings = " &middot; ".join(subtitle_string_list)
-        if hasattr(settings, 'H1DS_TITLE'):
-            title = settings.H1DS_TITLE
-        else:
-            title = "H1 Data Server"            
-        return_string = '<div id="title"><h1><a href="/">%s</a></h1>' % (title)
-        return_string += '<div id="subtitle">'+subtitle_strings+'</div></div>'
-        return return_string
+        return fragment_cache.get('h1ds_header', build_header)
 
 def do_h1ds_header(parser, token):
     """This populates the H1DS header, providing links to H1DS modules."""
     return H1DSHeaderNode()
 
+def build_footer():
+    app_string = ('<a href="%s"><strong>%s</strong></a> %s '
+                  '[<a href="%s">bug/feature request</a>]')
+    app_strings = []
+    for app in h1ds_installed_apps:
+        try:
+            version_mod = '.'.join([app, 'version'])
+            app_module =  __import__(version_mod, globals(), locals(), [])
+            app_urls = app_module.version.get_module_urls()
+            app_version = app_module.version.get_version()
+            app_strings.append(app_string %(app_urls[0], app,
+                                            app_version, app_urls[1]))
+        except:
+            app_strings.append("<strong>%s</strong>" %app)
+    return '<p>%s</p>' %" &middot; ".join(app_strings)
+
 class H1DSFooterNode(template.Node):
     def render(self, context):
-        app_string = ('<a href="%s"><strong>%s</strong></a> %s '
-                      '[<a href="%s">bug/feature request</a>]')
-        app_strings = []
-        for app in h1ds_installed_apps:
-            try:
-                version_mod = '.'.join([app, 'version'])
-                app_module =  __import__(version_mod, globals(), locals(), [])
-                app_urls = app_module.version.get_module_urls()
-                app_version = app_module.version.get_version()
-                app_strings.append(app_string %(app_urls[0], app,
-                                                app_version, app_urls[1]))
-            except:
-                app_strings.append("<strong>%s</strong>" %app)
-        return '<p>%s</p>' %" &middot; ".join(app_strings)
+        return fragment_cache.get('h1ds_footer', build_footer)
 
 def do_h1ds_footer(parser, token):
     """Populate the H1DS footer.
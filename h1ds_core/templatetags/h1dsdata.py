@@ -7,6 +7,8 @@ from django import template
 from django.core.urlresolvers import reverse
 from django.utils.html import escape
 
+from h1ds_core.base import filter_manager
+
 register = template.Library()
 
 class H1DSDataTemplateNode(template.Node):
@@ -65,64 +67,101 @@ active_filter_html = """\
 </div>
 """
 
-def get_filter(context, f_class, is_active=False, f_id=None, f_data=None):
+def escape_format(value):
+    """Escape value for use in a %-format string."""
+    return unicode(value).replace('%', '%%')
+
+# filter class -> filter_html with everything but path and input_query
+# filled in, see get_filter_template.
+filter_templates = {}
+
+# filter class -> active_filter_html with everything but path, input_query,
+# existing_query, fid and input_str filled in.
+active_filter_templates = {}
+
+# data key (see FilterManager.get_data_key) -> templates of all available
+# filters, joined.
+filter_list_templates = {}
+
+def get_filter_template(f_class, is_active=False):
+    """Get the HTML form template of a filter, built once per class."""
+    templates = active_filter_templates if is_active else filter_templates
     try:
-        request = context['request']
+        return templates[f_class]
+    except KeyError:
+        pass
+    docstring = inspect.getdoc(f_class)
+    if is_active:
+        f_template = active_filter_html % {
+            'update_url': escape_format(reverse("update-filter")),
+            'text': escape_format(docstring),
+            'input_str': '%(input_str)s',
+            'clsname': escape_format(f_class.slug),
+            'path': '%(path)s',
+            'input_query': '%(input_query)s',
+            'fid': '%(fid)s',
+            'remove_url': escape_format(reverse("remove-filter")),
+            'existing_query': '%(existing_query)s',
+            }
+    else:
+        arg_input = ('<input title="%(name)s" type="text" size=5 '
+                     'name="%(name)s" placeholder="%(name)s">')
+        input_str = "".join(arg_input % {'name': j} for j in f_class.kwarg_names)
+        f_template = filter_html % {'text': escape_format(docstring),
+                                    'input_str': escape_format(input_str),
+                                    'clsname': escape_format(f_class.slug),
+                                    'submit_url': escape_format(reverse("apply-filter")),
+                                    'path': '%(path)s',
+                                    'input_query': '%(input_query)s'}
+    templates[f_class] = f_template
+    return f_template
+
+def get_existing_query(request):
+    """Get the request's query as hidden inputs, once per request."""
+    if not hasattr(request, '_h1ds_existing_query'):
         hidden_input = '<input type="hidden" name="{}" value="{}" />'
-        existing_query_string = ""
-        for k, v in request.GET.items():
-            existing_query_string += hidden_input.format(k, v)
-        arg_list = f_class.kwarg_names
-        docstring = inspect.getdoc(f_class)
-        if is_active:
-            arg_input = ('<input title="%(name)s" type="text" '
-                         'size=5 name="%(name)s" value="%(value)s">')
-            if f_data == None:
-                f_data = []
-            update_url = reverse("update-filter")
-            remove_url = reverse("remove-filter")
-            input_str = ''
-            for i, j in enumerate(arg_list):
-                input_str += arg_input % {'name': j, 'value': f_data[j]}
-
-            return_string = active_filter_html % {
-                'update_url': update_url,
-                'text': docstring,
-                'input_str': input_str,
-                'clsname': f_class.slug,
-                'path': request.path,
-                'input_query': existing_query_string,
-                'fid': f_id,
-                'remove_url': remove_url,
-                'existing_query': existing_query_string,
-                }
-            return return_string
-
-        else:
-            submit_url = reverse("apply-filter")
-            arg_input = ('<input title="%(name)s" type="text" size=5 '
-                         'name="%(name)s" placeholder="%(name)s">')
-            input_str = ""
-            for j in arg_list:
-                input_str += arg_input % {'name': j}
-            return_string =  filter_html % {'text': docstring,
-                                           'input_str': input_str,
-                                           'clsname': f_class.slug,
-                                           'submit_url': submit_url,
-                                           'path': request.path,
-                                           'input_query': existing_query_string}
-            return return_string
-    except template.VariableDoesNotExist:
-        #return ''
-        raise
+        request._h1ds_existing_query = "".join(hidden_input.format(k, v)
+                                               for k, v in request.GET.items())
+    return request._h1ds_existing_query
+
+def get_filter(context, f_class, is_active=False, f_id=None, f_data=None):
+    request = context['request']
+    existing_query_string = get_existing_query(request)
+    f_template = get_filter_template(f_class, is_active)
+    if is_active:
+        arg_input = ('<input title="%(name)s" type="text" '
+                     'size=5 name="%(name)s" value="%(value)s">')
+        if f_data == None:
+            f_data = []
+        input_str = ''
+        for j in f_class.kwarg_names:
+            input_str += arg_input % {'name': j, 'value': f_data[j]}
+        return f_template % {'input_str': input_str,
+                             'path': request.path,
+                             'input_query': existing_query_string,
+                             'fid': f_id,
+                             'existing_query': existing_query_string}
+    return f_template % {'path': request.path,
+                         'input_query': existing_query_string}
 
 @register.simple_tag(takes_context=True)
 def show_filters(context, data_node):
-    # TODO: HACK
-    filters = ""
-    for n, f in data_node.get_available_filters().iteritems():
-        filters += get_filter(context, f)
-    return filters
+    """Show forms for the filters available for the node's data.
+
+    The forms of all available filters are joined into one template per
+    kind of data, so only the request path and query are filled in here.
+    """
+    request = context['request']
+    data_key = filter_manager.get_data_key(data_node.data)
+    try:
+        filter_list_template = filter_list_templates[data_key]
+    except KeyError:
+        filters = data_node.get_available_filters()
+        filter_list_template = "".join(get_filter_template(filters[n])
+                                       for n in sorted(filters))
+        filter_list_templates[data_key] = filter_list_template
+    return filter_list_template % {'path': request.path,
+                                   'input_query': get_existing_query(request)}
 
 @register.simple_tag(takes_context=True)
 def show_active_filters(context, data_node):
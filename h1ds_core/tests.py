@@ -0,0 +1,956 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import datetime
+import StringIO
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.template import Template, Context
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.unittest import skipIf
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from h1ds_core import base, models, cache, views, events, batch, jobs, timing
+from h1ds_core.base import no_data_metadata
+from h1ds_core.serializers import NodeSerializer
+from h1ds_core.templatetags import h1dsdata
+from h1ds_core.models import Shot, Node, ShotNode, TreeIdCounter, node_cache
+from h1ds_core.models import shot_ingested
+from h1ds_core.utils import fragment_cache
+
+# Node layout used in place of the data backend: tree -> nested children.
+# Nodes without children have data.
+FAKE_TREES = {
+    'tree_a': {'x': {'y': {}, 'z': {}}, 'W.1': {}},
+    'tree_b': {'v': {'u': {}}},
+    }
+
+def fake_child_names(node):
+    children = FAKE_TREES
+    for ancestor in node.get_ancestry():
+        children = children[ancestor.path]
+    return sorted(children.keys())
+
+def fake_data_metadata(node):
+    if fake_child_names(node):
+        return dict(no_data_metadata)
+    return {'has_data':True, 'n_dimensions':1, 'dtype':'float64', 'n_channels':1}
+
+class FakeBackendTestCase(TestCase):
+    """Test case with the data backend replaced by FAKE_TREES."""
+
+    def patch(self, owner, name, value):
+        self._patched.append((owner, name, name in owner.__dict__,
+                              owner.__dict__.get(name)))
+        setattr(owner, name, value)
+
+    def setUp(self):
+        self._patched = []
+        node_cache.clear()
+        # The shot index outlives the rolled back test transactions.
+        Shot.backend.shot_index.invalidate()
+        self.patch(Node, 'get_child_names_from_primary_source', fake_child_names)
+        self.patch(Node, 'get_data_metadata', fake_data_metadata)
+        self.patch(type(Node.datatree), 'get_trees',
+                   lambda self: sorted(FAKE_TREES.keys()))
+        self.patch(type(Node.datatree), 'get_structure_fingerprint',
+                   lambda self, tree, shot_number: None)
+        self.patch(type(Shot.backend), 'get_timestamp_for_shot',
+                   lambda self, shot: datetime.datetime(2013, 1, 1) +
+                   datetime.timedelta(minutes=shot))
+
+    def tearDown(self):
+        for owner, name, existed, value in reversed(self._patched):
+            if existed:
+                setattr(owner, name, value)
+            else:
+                delattr(owner, name)
+
+    def get_layout(self, shot_number):
+        """(slug path, level, lft, rght, tree number) for each node of a shot."""
+        nodes = Node.objects.filter(shot__number=shot_number).order_by('tree_id', 'lft')
+        tree_ids = sorted(set(n.tree_id for n in nodes))
+        return [(n.slug_path, n.level, n.lft, n.rght, tree_ids.index(n.tree_id))
+                for n in nodes]
+
+class BulkIngestTest(FakeBackendTestCase):
+
+    def test_bulk_tree_matches_serial(self):
+        Shot(number=1).save(bulk_ingest=False)
+        Shot(number=2).save()
+        self.assertEqual(self.get_layout(1), self.get_layout(2))
+        for shot_number in (1, 2):
+            for node in Node.objects.filter(shot__number=shot_number, level__gt=0):
+                self.assertEqual(node.parent.tree_id, node.tree_id)
+                self.assertTrue(node.parent.lft < node.lft < node.rght < node.parent.rght)
+
+    def test_tree_ids_are_disjoint(self):
+        Shot(number=1).save()
+        Shot(number=2).save(bulk_ingest=False)
+        Shot(number=3).save()
+        tree_ids = {}
+        for shot_number in (1, 2, 3):
+            tree_ids[shot_number] = set(Node.objects.filter(
+                    shot__number=shot_number).values_list('tree_id', flat=True))
+            self.assertEqual(len(tree_ids[shot_number]), len(FAKE_TREES))
+        self.assertEqual(len(set.union(*tree_ids.values())), 3*len(FAKE_TREES))
+
+    def test_reserved_tree_ids_are_skipped(self):
+        # tree_ids reserved by an ingest in another transaction which
+        # hasn't committed its nodes yet.
+        TreeIdCounter.objects.create(pk=1, next_tree_id=100)
+        Shot(number=1).save()
+        tree_ids = Node.objects.filter(shot__number=1).values_list('tree_id', flat=True)
+        self.assertEqual(sorted(set(tree_ids)), [100, 101])
+        self.assertEqual(TreeIdCounter.objects.get(pk=1).next_tree_id, 102)
+
+    def test_structure_node_gaining_data_is_probed(self):
+        Shot(number=1).save()
+        self.patch(type(Node.datatree), 'get_structure_fingerprint',
+                   lambda self, tree, shot_number: 'fingerprint-%s' % tree)
+        Shot(number=2).save()
+        def data_metadata(node):
+            if node.slug_path == 'tree_a/x' and node.shot_id == 3:
+                return {'has_data':True, 'n_dimensions':1, 'dtype':'float64',
+                        'n_channels':1}
+            return fake_data_metadata(node)
+        self.patch(Node, 'get_data_metadata', data_metadata)
+        Shot(number=3).save()
+        self.assertFalse(Node.objects.get(shot__number=2, slug_path='tree_a/x').has_data)
+        self.assertTrue(Node.objects.get(shot__number=3, slug_path='tree_a/x').has_data)
+
+class SharedStructureTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(SharedStructureTest, self).setUp()
+        self.patch(models, 'shared_tree_structure', True)
+        self.patch(type(Node.datatree), 'get_structure_fingerprint',
+                   lambda self, tree, shot_number: 'fingerprint-%s' % tree)
+        def data_metadata(node):
+            if node.slug_path == 'tree_a/w1' and node.shot_id == 2:
+                return {'has_data':True, 'n_dimensions':2, 'dtype':'int32',
+                        'n_channels':1}
+            return fake_data_metadata(node)
+        self.patch(Node, 'get_data_metadata', data_metadata)
+        Shot(number=1).save()
+        Shot(number=2).save()
+
+    def test_shot_shares_structure_shot_nodes(self):
+        shot = Shot.objects.get(number=2)
+        self.assertEqual(shot.structure_shot_id, 1)
+        self.assertEqual(shot.get_structure_shot_number(), 1)
+        self.assertEqual(Node.objects.filter(shot__number=2).count(), 0)
+        self.assertEqual(Node.objects.filter(shot__number=1).count(), 8)
+        # Only the differing data metadata are stored for the shot.
+        self.assertEqual([sn.node.slug_path for sn in ShotNode.objects.filter(shot=shot)],
+                         ['tree_a/w1'])
+        self.assertEqual(sorted(n.path for n in shot.root_nodes),
+                         ['tree_a', 'tree_b'])
+
+    def test_nodes_are_bound_to_shot(self):
+        node = Node.objects.resolve(2, 'tree_a/x/y')
+        self.assertTrue(node.is_bound())
+        self.assertEqual(node.shot.number, 2)
+        self.assertTrue(node.get_absolute_url().endswith('/2/tree_a/x/y/'))
+        parent = node.get_parent()
+        self.assertEqual((parent.nodepath, parent.shot.number), ('tree_a/x', 2))
+        self.assertEqual([(n.nodepath, n.shot.number) for n in parent.get_children()],
+                         [('tree_a/x/y', 2), ('tree_a/x/z', 2)])
+        self.assertEqual([n.shot.number for n in node.get_ancestors()], [2, 2])
+        self.assertRaises(ValueError, node.save)
+        self.assertFalse(Node.objects.resolve(1, 'tree_a/x/y').is_bound())
+
+    def test_shot_data_metadata(self):
+        node = Node.objects.resolve(2, 'tree_a/w1')
+        self.assertEqual((node.n_dimensions, node.dtype), (2, 'int32'))
+        node = Node.objects.resolve(1, 'tree_a/w1')
+        self.assertEqual((node.n_dimensions, node.dtype), (1, 'float64'))
+        listing = Node.objects.get_tree_listing(Shot.objects.get(number=2))
+        w1 = [n for n in listing[0]['children'] if n['nodepath'] == 'tree_a/w1'][0]
+        self.assertEqual((w1['n_dimensions'], w1['dtype']), (2, 'int32'))
+
+class NodePathTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(NodePathTest, self).setUp()
+        Shot(number=1).save()
+
+    def test_unicode_uses_paths(self):
+        node = Node.objects.get(shot__number=1, slug_path='tree_a/w1')
+        self.assertEqual(unicode(node), u'tree_a:W.1')
+        node = Node.objects.resolve(1, 'tree_a/x/y')
+        self.assertEqual(unicode(node), u'tree_a:x\u2192y')
+
+    def test_resolved_node_paths_need_no_queries(self):
+        node = Node.objects.resolve(1, 'tree_a/x/y')
+        with self.assertNumQueries(0):
+            self.assertEqual(node.nodepath, 'tree_a/x/y')
+            node.get_absolute_url()
+            self.assertEqual(node.get_parent().nodepath, 'tree_a/x')
+            unicode(node)
+
+    def test_child_paths_need_no_queries(self):
+        node = Node.objects.resolve(1, 'tree_a/x')
+        with self.assertNumQueries(1):
+            children = list(node.get_children())
+        with self.assertNumQueries(0):
+            self.assertEqual([c.nodepath for c in children],
+                             ['tree_a/x/y', 'tree_a/x/z'])
+            for child in children:
+                child.get_absolute_url()
+
+    def test_serializer_queries_dont_grow_with_children(self):
+        many_children = dict(('c%d' % i, {}) for i in range(20))
+        self.patch(sys.modules[__name__], 'FAKE_TREES',
+                   dict(FAKE_TREES, tree_c={'many':many_children}))
+        Shot(number=2).save()
+        node = Node.objects.resolve(2, 'tree_c/many')
+        with self.assertNumQueries(1):
+            data = NodeSerializer(node).data
+        self.assertEqual(len(data['children']), 20)
+        self.assertTrue(data['children'][0].endswith('/2/tree_c/many/c0/'))
+        nodes = [Node.objects.resolve(2, 'tree_c/many'),
+                 Node.objects.resolve(2, 'tree_a/x')]
+        with self.assertNumQueries(1):
+            data = NodeSerializer(nodes, many=True).data
+        self.assertEqual([len(d['children']) for d in data], [20, 2])
+
+class NodeViewTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(NodeViewTest, self).setUp()
+        Shot(number=1).save()
+
+    def test_json_node(self):
+        url = reverse('node-detail', kwargs={'shot':1, 'nodepath':'tree_a/x/y'})
+        response = self.client.get(url, {'format':'json'})
+        self.assertEqual(response.status_code, 200)
+        node = json.loads(response.content)
+        self.assertTrue(node['parent'].endswith('/1/tree_a/x/'))
+        self.assertEqual(node['children'], [])
+
+    def test_missing_shot(self):
+        url = reverse('node-detail', kwargs={'shot':5, 'nodepath':'tree_a/x/y'})
+        response = self.client.get(url, {'format':'json'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_non_ascii_path(self):
+        self.assertRaises(Node.DoesNotExist, Node.objects.resolve, 1, u'tree_a/\xe9')
+        url = reverse('node-detail', kwargs={'shot':1, 'nodepath':u'tree_a/\xe9'})
+        response = self.client.get(url, {'format':'json'})
+        self.assertEqual(response.status_code, 404)
+        # Responses about finalized shots may be cached.
+        Shot(number=2).save()
+        self.patch(views, 'response_cache_enabled', lambda: True)
+        response = self.client.get(url, {'format':'json'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_finalized_shot_etag(self):
+        url = reverse('node-detail', kwargs={'shot':1, 'nodepath':'tree_a/x/y'})
+        response = self.client.get(url, {'format':'json'})
+        self.assertFalse(response.has_header('ETag'))
+        Shot(number=2).save()
+        response = self.client.get(url, {'format':'json'})
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(url, {'format':'json'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        url = reverse('node-detail', kwargs={'shot':1, 'nodepath':'tree_a/x/z'})
+        response = self.client.get(url, {'format':'json'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_async_without_jobs(self):
+        self.patch(views, 'jobs_enabled', lambda: False)
+        url = reverse('node-detail', kwargs={'shot':1, 'nodepath':'tree_a/x/y'})
+        response = self.client.get(url, {'format':'json', 'async':'1'})
+        self.assertEqual(response.status_code, 503)
+
+@override_settings(MIDDLEWARE_CLASSES=settings.MIDDLEWARE_CLASSES +
+                   ('h1ds_core.timing.ServerTimingMiddleware',))
+class TimingTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(TimingTest, self).setUp()
+        Shot(number=1).save()
+        self.url = reverse('node-detail', kwargs={'shot':1, 'nodepath':'tree_a/x/y'})
+
+    def get_metrics(self, response):
+        return [metric.split(';')[0]
+                for metric in response['Server-Timing'].split(', ')]
+
+    def test_server_timing_header(self):
+        self.patch(timing, 'request_timing', True)
+        response = self.client.get(self.url, {'format':'json', 'f0':'max'})
+        self.assertEqual(response.status_code, 200)
+        metrics = self.get_metrics(response)
+        for name in ('get_object', 'lookup', 'read', 'filter_0', 'serialize',
+                     'render', 'total'):
+            self.assertTrue(name in metrics, name)
+        self.assertEqual(metrics[-1], 'total')
+        self.assertEqual(timing.get_request_timer(), None)
+
+    def test_timing_disabled(self):
+        response = self.client.get(self.url, {'format':'json'})
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertTrue(timing.timed('read') is timing.not_timed)
+
+    def test_timings_logged(self):
+        self.patch(timing, 'log_request_timing', True)
+        records = []
+        self.patch(timing.logger, 'info',
+                   lambda msg, extra: records.append(extra['h1ds_timing']))
+        response = self.client.get(self.url, {'format':'json'})
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['status'], 200)
+        self.assertEqual(records[0]['timings'][-1]['name'], 'total')
+
+class NodeTreeViewTest(FakeBackendTestCase):
+
+    def test_depth(self):
+        Shot(number=1).save()
+        url = reverse('shot-tree', kwargs={'shot':1})
+        response = self.client.get(url, {'depth':'1', 'format':'json'})
+        self.assertEqual(response.status_code, 200)
+        for depth in ('abc', '-1'):
+            response = self.client.get(url, {'depth':depth, 'format':'json'})
+            self.assertEqual(response.status_code, 400)
+
+class FilterTest(TestCase):
+
+    def test_parse_filter_query(self):
+        self.assertEqual(base.parse_filter_query({'f10':'max', 'f2':'resample',
+                                                  'f2_n':'10', 'shot':'1'}),
+                         [[2, 'resample', {'n':'10'}], [10, 'max', {}]])
+
+    def test_filter_table_matches_filters(self):
+        filters = base.filter_manager.filters
+        for value in (np.zeros((1, 10)), np.zeros((1, 10), dtype=int), [1.0]):
+            data = base.Data(value=value, dimension=[np.arange(10)])
+            self.assertEqual(
+                sorted(base.filter_manager.get_filters(data)),
+                sorted(n for n, f in filters.items() if f.is_filterable(data)))
+
+class FragmentCacheTest(FakeBackendTestCase):
+
+    def render_header(self):
+        return Template('{% load h1ds_headfoot %}{% h1ds_header %}').render(Context())
+
+    def test_fragments_are_rebuilt_when_shots_change(self):
+        with self.settings(H1DS_TITLE='Old title'):
+            fragment_cache.clear()
+            self.assertIn('Old title', self.render_header())
+        with self.settings(H1DS_TITLE='New title'):
+            self.assertIn('Old title', self.render_header())
+            Shot(number=1).save()
+            self.assertIn('New title', self.render_header())
+        with self.settings(H1DS_TITLE='Newer title'):
+            Shot.objects.get(number=1).delete()
+            self.assertIn('Newer title', self.render_header())
+
+class NodeCacheTest(FakeBackendTestCase):
+
+    def test_reingested_shot_is_not_resolved_from_shared_cache(self):
+        self.patch(models, 'shared_node_cache', get_cache(
+                'django.core.cache.backends.locmem.LocMemCache'))
+        Shot(number=1).save()
+        Shot(number=2).save()
+        node_id = Node.objects.resolve(1, 'tree_a/x').id
+        Shot.objects.get(number=1).delete()
+        Shot(number=1).save()
+        new_node_id = Node.objects.get(shot__number=1, slug_path='tree_a/x').id
+        self.assertNotEqual(new_node_id, node_id)
+        self.assertEqual(Node.objects.resolve(1, 'tree_a/x').id, new_node_id)
+
+class DataCacheTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(DataCacheTest, self).setUp()
+        self.patch(cache, 'data_cache', get_cache(
+                'django.core.cache.backends.locmem.LocMemCache'))
+        self.patch(base, 'shot_index_ttl', 0)
+        Shot(number=1).save()
+
+    def cache_node(self, filter_query, filter_history):
+        node = Node.objects.resolve(1, 'tree_a/x/y')
+        node.data = 'data'
+        node.filter_history = filter_history
+        cache.set_cached_data(node, filter_query)
+
+    def test_equivalent_filter_queries_share_data(self):
+        self.cache_node('f3_name=max&f7_name=resample&f7_n=10',
+                        [(3, 'max', {}), (7, 'resample', {'n':'10'})])
+        node = Node.objects.resolve(1, 'tree_a/x/y')
+        data, filter_history = cache.get_cached_data(
+            node, 'f0_name=max&f1_n=10&f1_name=resample')
+        self.assertEqual(data, 'data')
+        self.assertEqual(filter_history,
+                         [(0, 'max', {}), (1, 'resample', {'n':'10'})])
+
+    def test_reingested_shot_misses(self):
+        self.cache_node('f0_name=max', [(0, 'max', {})])
+        node = Node.objects.resolve(1, 'tree_a/x/y')
+        self.assertNotEqual(cache.get_cached_data(node, 'f0_name=max'), None)
+        # Shot ingested again by another process.
+        Shot.objects.filter(number=1).update(
+            ingest_time=datetime.datetime(2030, 1, 1))
+        self.assertEqual(cache.get_cached_data(node, 'f0_name=max'), None)
+
+class JobTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(JobTest, self).setUp()
+        self.patch(cache, 'data_cache', get_cache(
+                'django.core.cache.backends.locmem.LocMemCache'))
+        self.patch(jobs, 'job_cache', get_cache(
+                'django.core.cache.backends.locmem.LocMemCache'))
+        self.patch(jobs, 'job_executor', 'eager')
+        Shot(number=1).save()
+
+    def test_job_runs(self):
+        job = jobs.submit_filter_job(1, u'tree_a/x/y', '')
+        self.assertEqual(job['state'], jobs.JOB_DONE)
+        node = Node.objects.resolve(1, 'tree_a/x/y')
+        self.assertNotEqual(cache.get_cached_data(node, ''), None)
+
+    def test_stuck_job_is_run_again(self):
+        job_id = jobs.get_job_id(1, u'tree_a/x/y', '')
+        job = {'id':job_id, 'shot':1, 'nodepath':u'tree_a/x/y',
+               'filter_query':'', 'state':jobs.JOB_RUNNING, 'error':''}
+        jobs.set_job_state(job, jobs.JOB_RUNNING)
+        self.assertEqual(jobs.submit_filter_job(1, u'tree_a/x/y', '')['state'],
+                         jobs.JOB_RUNNING)
+        # The process running the job died.
+        jobs.job_cache.set(jobs.get_job_key(job_id),
+                           dict(job, updated=time.time() - jobs.job_timeout - 1))
+        self.assertEqual(jobs.get_job(job_id)['state'], jobs.JOB_FAILED)
+        self.assertEqual(jobs.submit_filter_job(1, u'tree_a/x/y', '')['state'],
+                         jobs.JOB_DONE)
+
+    def test_non_ascii_job(self):
+        job = jobs.submit_filter_job(1, u'tree_a/\xe9', '')
+        self.assertEqual(job['state'], jobs.JOB_FAILED)
+
+class FilterSidebarTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(FilterSidebarTest, self).setUp()
+        self.patch(h1dsdata, 'filter_templates', {})
+        self.patch(h1dsdata, 'active_filter_templates', {})
+        self.patch(h1dsdata, 'filter_list_templates', {})
+        Shot(number=1).save()
+        self.request = RequestFactory().get('/data/1/tree_a/x/y/%25/',
+                                            {'f0':'max'})
+
+    def get_node(self, nodepath):
+        node = Node.objects.resolve(1, nodepath)
+        node.data = node.read_primary_data()
+        return node
+
+    def render(self, template_string, node):
+        return Template('{% load h1dsdata %}' + template_string).render(
+            Context({'request':self.request, 'node':node}))
+
+    def test_forms_are_filled_in(self):
+        node = self.get_node('tree_a/x/y')
+        html = self.render('{% show_filters node %}', node)
+        filters = node.get_available_filters()
+        self.assertTrue(filters)
+        self.assertEqual(html.count('<form '), len(filters))
+        self.assertEqual(html.count('name="path" value="/data/1/tree_a/x/y/%/"'),
+                         len(filters))
+        self.assertEqual(html.count('<input type="hidden" name="f0" value="max" />'),
+                         len(filters))
+        context = Context({'request':self.request})
+        self.assertEqual(html, ''.join(h1dsdata.get_filter(context, filters[n])
+                                       for n in sorted(filters)))
+
+    def test_forms_are_shared_by_data_kind(self):
+        self.render('{% show_filters node %}', self.get_node('tree_a/x/y'))
+        self.assertEqual(len(h1dsdata.filter_list_templates), 1)
+        node = self.get_node('tree_a/x/z')
+        self.patch(node, 'get_available_filters', None)
+        self.assertTrue('<form ' in self.render('{% show_filters node %}', node))
+        self.assertEqual(len(h1dsdata.filter_list_templates), 1)
+
+    def test_active_filters(self):
+        node = self.get_node('tree_a/x/y')
+        node.apply_filter_list(base.parse_filter_query(
+                self.request.GET.copy()))
+        html = self.render('{% show_active_filters node %}', node)
+        self.assertEqual(html.count('name="fid" value="0"'), 2)
+        self.assertTrue('name="filter" value="max"' in html)
+
+class CacheWarmingTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(CacheWarmingTest, self).setUp()
+        self.patch(cache, 'data_cache', get_cache(
+                'django.core.cache.backends.locmem.LocMemCache'))
+        self.patch(cache, 'warm_response_urls', ['http://testserver/'])
+        cache.response_cache.clear()
+
+    def test_shot_ingested_after_nodes_are_written(self):
+        n_nodes = []
+        def count_nodes(sender, instance, **kwargs):
+            n_nodes.append(Node.objects.filter(shot=instance).count())
+        shot_ingested.connect(count_nodes)
+        try:
+            Shot(number=1).save()
+            Shot(number=2).save(bulk_ingest=False)
+        finally:
+            shot_ingested.disconnect(count_nodes)
+        self.assertEqual(n_nodes, [8, 8])
+
+    def test_warm_lock_released_if_no_nodes_found(self):
+        Shot(number=1).save()
+        cache.warm_shot_cache(1, [('tree_c/q', '')])
+        self.assertTrue(cache.data_cache.add(
+                'h1ds_warm:1:%s' % Shot.backend.shot_index.get_version(1), True))
+
+    def test_data_and_responses_are_warmed(self):
+        Shot(number=1).save()
+        Shot(number=2).save()
+        node = Node.objects.resolve(2, 'tree_a/x/y')
+        cache.warm_shot_cache(2, [('tree_a/x/y', '')])
+        self.assertNotEqual(cache.get_cached_data(node, ''), None)
+        cache.warm_shot_responses(1, [('tree_a/x/y', '')])
+        self.assertEqual(len(cache.response_cache), 1)
+        # The request is answered from the warmed response.
+        self.patch(views, 'set_cached_response',
+                   lambda key, response: self.fail('Response not cached'))
+        url = reverse('node-detail', kwargs={'shot':1, 'nodepath':'tree_a/x/y'})
+        response = self.client.get(url, {'format':'json'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_warmer_warms_latest_queued_shot(self):
+        warmed = []
+        self.patch(cache.CacheWarmer, 'warm_shot',
+                   lambda warmer, shot_number: warmed.append(shot_number))
+        warmer = cache.CacheWarmer()
+        with warmer.condition:
+            for shot_number in (1, 2, 3):
+                warmer.add(shot_number)
+        self.assertTrue(warmer.wait(timeout=10))
+        self.assertEqual(warmed, [3])
+
+class EventListenerTest(FakeBackendTestCase):
+
+    def test_listener_started_by_first_request(self):
+        socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, socket_dir)
+        self.patch(events, 'event_socket_dir', socket_dir)
+        self.patch(events, '_listener', None)
+        self.client.get(reverse('shot-tree', kwargs={'shot':1}))
+        self.assertEqual(events._listener.pid, os.getpid())
+        self.assertTrue(os.path.exists(events._listener.path))
+
+class ShotStreamTest(FakeBackendTestCase):
+
+    def test_heartbeat(self):
+        stream = events.shot_event_stream(events.ShotEventHub(), heartbeat=0.01)
+        self.assertTrue(next(stream).startswith('retry: '))
+        self.assertEqual(next(stream), ': heartbeat\n\n')
+
+    def test_resumed_client_gets_missed_shot(self):
+        hub = events.ShotEventHub()
+        hub.publish(5)
+        stream = events.shot_event_stream(hub, last_shot=3, heartbeat=0.01)
+        next(stream)
+        self.assertEqual(next(stream), 'id: 5\nevent: new_shot\ndata: 5\n\n')
+        stream = events.shot_event_stream(hub, last_shot=5, heartbeat=0.01)
+        next(stream)
+        self.assertEqual(next(stream), ': heartbeat\n\n')
+
+    def test_clients_are_limited(self):
+        hub = events.ShotEventHub(max_clients=1)
+        self.patch(views, 'get_shot_event_hub', lambda: hub)
+        url = reverse('h1ds-shot-stream')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url).status_code, 503)
+        response.close()
+        self.assertEqual(hub.clients, 0)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+class ShotIndexTest(FakeBackendTestCase):
+
+    def add_shot_elsewhere(self, number, **kwargs):
+        # As if by another process: no signals reach this process's index.
+        Shot.objects.bulk_create([Shot(number=number,
+                                       timestamp=datetime.datetime(2013, 1, 1),
+                                       **kwargs)])
+
+    def test_shots_added_elsewhere_are_seen(self):
+        self.patch(base, 'shot_index_ttl', 0)
+        Shot(number=1).save()
+        self.assertEqual(Shot.backend.get_max_shot_number(), 1)
+        self.assertFalse(Shot(number=1).is_finalized())
+        self.add_shot_elsewhere(2)
+        self.assertEqual(Shot.backend.get_max_shot_number(), 2)
+        self.assertEqual(Shot.backend.get_next_shot_number(1), 2)
+        self.assertTrue(Shot(number=1).is_finalized())
+        Shot.objects.filter(number=2).delete()
+        self.assertEqual(Shot.backend.get_max_shot_number(), 1)
+
+    def test_reingested_shot_gets_new_version(self):
+        self.patch(base, 'shot_index_ttl', 0)
+        Shot(number=1).save()
+        Shot(number=2).save()
+        version = Shot.backend.shot_index.get_version(1)
+        self.assertNotEqual(version, '')
+        # Shot 1 deleted and ingested again by another process.
+        Shot.objects.filter(number=1).update(
+            ingest_time=datetime.datetime(2030, 1, 1))
+        self.assertNotEqual(Shot.backend.shot_index.get_version(1), version)
+
+    def test_index_is_checked_after_ttl(self):
+        self.patch(base, 'shot_index_ttl', 3600)
+        Shot(number=1).save()
+        self.assertEqual(Shot.backend.get_max_shot_number(), 1)
+        self.add_shot_elsewhere(2)
+        with self.assertNumQueries(0):
+            self.assertEqual(Shot.backend.get_max_shot_number(), 1)
+        Shot.backend.shot_index.invalidate()
+        self.assertEqual(Shot.backend.get_max_shot_number(), 2)
+
+    def test_missing_neighbours_are_checked_in_database(self):
+        self.patch(base, 'shot_index_ttl', 3600)
+        Shot(number=1).save()
+        self.assertEqual(Shot.backend.get_previous_shot_number(1), None)
+        self.add_shot_elsewhere(2)
+        self.assertEqual(Shot.backend.get_next_shot_number(1), 2)
+        self.assertEqual(Shot.backend.shot_index.get_next(1), 2)
+
+    def test_latest_shot_finalized_needs_no_queries(self):
+        self.patch(base, 'shot_index_ttl', 3600)
+        Shot(number=1).save()
+        self.assertFalse(Shot(number=1).is_finalized())
+        with self.assertNumQueries(0):
+            self.assertFalse(Shot(number=1).is_finalized())
+        Shot(number=2).save()
+        with self.assertNumQueries(0):
+            self.assertTrue(Shot(number=1).is_finalized())
+        self.assertFalse(Shot(number=2).is_finalized())
+        with self.assertNumQueries(0):
+            self.assertFalse(Shot(number=2).is_finalized())
+
+class DataFileBackendTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(DataFileBackendTest, self).setUp()
+        self.datafile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datafile_dir)
+        # The backend reads settings.H1DS_DATAFILE_DIR when imported.
+        with self.settings(H1DS_DATAFILE_DIR=self.datafile_dir):
+            from h1ds_core.backends import datafile
+        self.datafile = datafile
+        self.patch(self.datafile, 'datafile_dir', self.datafile_dir)
+        self.patch(self.datafile._open_files, 'files', {})
+        shot_dir = os.path.join(self.datafile_dir, 'tree_c', '1', 'probe')
+        os.makedirs(shot_dir)
+        np.save(os.path.join(shot_dir, 'signal.npy'), np.ones((2, 10)))
+        np.save(os.path.join(shot_dir, 'signal.dim.npy'), np.arange(10.)/10)
+        np.save(os.path.join(shot_dir, 'scalar.npy'), np.array(3.0))
+        np.savez(os.path.join(self.datafile_dir, 'tree_c', '2'),
+                 **{'probe/signal':np.ones(10)})
+
+    def get_node(self, shot_number, *parts):
+        """Get a node of the data file backend, outside the database."""
+        class FileNode(self.datafile.NodeData):
+            def __init__(self, parts):
+                self.parts = parts
+                self.path = parts[-1]
+                self.level = len(parts) - 1
+                self.shot_id = shot_number
+            def get_ancestry(self):
+                return [FileNode(self.parts[:i+1]) for i in range(len(self.parts))]
+        return FileNode(parts)
+
+    def test_shot_files(self):
+        shot_file = self.datafile.get_shot_file('tree_c', 1)
+        self.assertEqual(shot_file.list_children(()), ['probe'])
+        self.assertEqual(shot_file.list_children(['probe']), ['scalar', 'signal'])
+        self.assertEqual(list(shot_file.get_dimension(['probe', 'signal'])),
+                         list(np.arange(10.)/10))
+        shot_file = self.datafile.get_shot_file('tree_c', 2)
+        self.assertEqual(shot_file.list_children(['probe']), ['signal'])
+        self.assertTrue(isinstance(shot_file.get_array(['probe', 'signal']),
+                                   np.memmap))
+        self.assertEqual(self.datafile.list_shot_numbers('tree_c'), [1, 2])
+
+    @skipIf(h5py is None, 'HDF5 files need h5py.')
+    def test_hdf5_files(self):
+        filename = os.path.join(self.datafile_dir, 'tree_c', '3.h5')
+        with h5py.File(filename, 'w') as h5_file:
+            probe = h5_file.create_group('probe')
+            signal = probe.create_dataset('signal', data=np.ones((2, 10)))
+            signal.attrs['dimension'] = 'time'
+            signal.attrs['units'] = 'V'
+            probe.create_dataset('time', data=np.arange(10.)/10).attrs['units'] = 's'
+        shot_file = self.datafile.get_shot_file('tree_c', 3)
+        self.assertEqual(shot_file.list_children(['probe']), ['signal', 'time'])
+        self.assertTrue(isinstance(shot_file.get_array(['probe', 'signal']),
+                                   np.memmap))
+        self.assertEqual(shot_file.get_units(['probe', 'signal']), ('V', 's'))
+        node = self.get_node(3, 'tree_c', 'probe', 'signal')
+        self.assertEqual(node.get_data_metadata(),
+                         base.BaseNodeData.get_data_metadata(node))
+        # Groups without datasets are part of the structure.
+        fingerprint = shot_file.get_structure_fingerprint()
+        shot_file.close()
+        with h5py.File(filename, 'a') as h5_file:
+            h5_file.create_group('empty')
+        shot_file = self.datafile.HDF5ShotFile(filename)
+        self.assertNotEqual(shot_file.get_structure_fingerprint(), fingerprint)
+        shot_file.close()
+
+    def test_data_metadata_matches_data(self):
+        node = self.get_node(1, 'tree_c', 'probe', 'signal')
+        self.assertEqual(node.get_data_metadata(),
+                         {'has_data':True, 'n_dimensions':1,
+                          'dtype':'float64', 'n_channels':2})
+        self.assertEqual(node.get_data_metadata(),
+                         base.BaseNodeData.get_data_metadata(node))
+        node = self.get_node(1, 'tree_c', 'probe', 'scalar')
+        self.assertEqual(node.get_data_metadata()['n_dimensions'], 0)
+        node = self.get_node(1, 'tree_c', 'probe')
+        self.assertEqual(node.get_data_metadata(), no_data_metadata)
+
+@skipIf(h5py is None, 'The mirror backend needs h5py.')
+class SyntheticBackendTest(TestCase):
+
+    def setUp(self):
+        from h1ds_core.backends import synthetic
+        self.synthetic = synthetic
+        self._patched = []
+        for name, value in (('synthetic_depth', 2), ('synthetic_width', 3),
+                            ('synthetic_signal_length', 50),
+                            ('synthetic_channels', 2),
+                            ('synthetic_dtype', np.dtype('float32')),
+                            ('synthetic_latency', 0)):
+            self.patch(name, value)
+
+    def patch(self, name, value):
+        self._patched.append((name, getattr(self.synthetic, name)))
+        setattr(self.synthetic, name, value)
+
+    def tearDown(self):
+        for name, value in reversed(self._patched):
+            setattr(self.synthetic, name, value)
+
+    def get_node(self, shot_number, *parts):
+        """Get a node of the synthetic backend, outside the database."""
+        class SyntheticNode(self.synthetic.NodeData):
+            def __init__(self, parts):
+                self.parts = parts
+                self.path = parts[-1]
+                self.level = len(parts) - 1
+                self.shot_id = shot_number
+            def get_ancestry(self):
+                return [SyntheticNode(self.parts[:i+1]) for i in range(len(self.parts))]
+        return SyntheticNode(parts)
+
+    def test_tree_structure(self):
+        root = self.get_node(1, 'synthetic')
+        self.assertEqual(root.get_child_names_from_primary_source(),
+                         ['branch_0', 'branch_1', 'branch_2'])
+        branch = self.get_node(1, 'synthetic', 'branch_1')
+        self.assertEqual(branch.get_child_names_from_primary_source(),
+                         ['signal_0', 'signal_1', 'signal_2'])
+        signal = self.get_node(1, 'synthetic', 'branch_1', 'signal_0')
+        self.assertEqual(signal.get_child_names_from_primary_source(), [])
+        self.assertEqual(branch.get_data_metadata(), no_data_metadata)
+        self.assertEqual(branch.get_value(), [None])
+        tree_manager = self.synthetic.DataTreeManager()
+        fingerprint = tree_manager.get_structure_fingerprint('synthetic', 1)
+        self.assertEqual(tree_manager.get_structure_fingerprint('synthetic', 2),
+                         fingerprint)
+        self.patch('synthetic_width', 4)
+        self.assertNotEqual(tree_manager.get_structure_fingerprint('synthetic', 1),
+                            fingerprint)
+
+    def test_signals_are_deterministic(self):
+        value = self.get_node(1, 'synthetic', 'branch_0', 'signal_0').get_value()
+        self.assertEqual(value.shape, (2, 50))
+        same_value = self.get_node(1, 'synthetic', 'branch_0', 'signal_0').get_value()
+        self.assertTrue(np.array_equal(value, same_value))
+        for shot_number, parts in ((2, ('branch_0', 'signal_0')),
+                                   (1, ('branch_0', 'signal_1'))):
+            other_value = self.get_node(shot_number, 'synthetic', *parts).get_value()
+            self.assertFalse(np.array_equal(value, other_value))
+        dimension = self.get_node(1, 'synthetic', 'branch_0', 'signal_0').get_dimension()
+        self.assertEqual(len(dimension), 1)
+        self.assertEqual(dimension[0].shape, (50,))
+
+    def test_data_metadata_matches_data(self):
+        for dtype in ('float32', 'int16', 'uint8'):
+            self.patch('synthetic_dtype', np.dtype(dtype))
+            node = self.get_node(1, 'synthetic', 'branch_0', 'signal_0')
+            value = node.get_value()
+            self.assertEqual(node.get_data_metadata(),
+                             {'has_data':True, 'n_dimensions':1,
+                              'dtype':str(value.dtype),
+                              'n_channels':value.shape[0]})
+            self.assertEqual(node.get_value_dtype(), dtype)
+            if value.dtype.kind in 'iu':
+                # Scaled into the range of the dtype, without wrapping.
+                info = np.iinfo(value.dtype)
+                self.assertTrue(info.min < value.min() < value.max() < info.max)
+
+    def test_signal_is_read_once(self):
+        sleeps = []
+        self.patch('synthetic_latency', 0.5)
+        self.patch('time', type('FakeTime', (object,),
+                                {'sleep':staticmethod(sleeps.append)}))
+        node = self.get_node(1, 'synthetic', 'branch_0', 'signal_0')
+        node.get_value()
+        node.get_dimension()
+        self.assertEqual(sleeps, [0.5])
+
+    def test_shot_timestamps(self):
+        shot_manager = self.synthetic.SyntheticShotManager()
+        self.assertEqual(shot_manager.get_timestamp_for_shot(3) -
+                         shot_manager.get_timestamp_for_shot(2),
+                         self.synthetic.SHOT_INTERVAL)
+
+class MirrorBackendTest(FakeBackendTestCase):
+
+    def setUp(self):
+        super(MirrorBackendTest, self).setUp()
+        self.mirror_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.mirror_dir)
+        # The backend reads its settings when imported.
+        with self.settings(H1DS_MIRROR_PRIMARY_BACKEND='h1ds_core.backends.synthetic',
+                           H1DS_MIRROR_DIR=self.mirror_dir):
+            from h1ds_core.backends import mirror
+        self.mirror = mirror
+        self.patch(mirror, 'mirror_dir', self.mirror_dir)
+        self.patch(mirror._open_files, 'files', {})
+        Shot(number=1).save()
+        Shot(number=2).save()
+
+    def get_node(self, shot_number, nodepath):
+        """Get a node of the mirror backend, outside the database."""
+        node = Node.objects.resolve(shot_number, nodepath)
+        class MirrorNode(self.mirror.NodeData):
+            shot_id = node.shot_id
+            level = node.level
+            path_checksum = node.path_checksum
+            def get_ancestry(self):
+                return node.get_ancestry()
+        return MirrorNode()
+
+    def test_mirror_and_check_shot(self):
+        shot = Shot.objects.get(number=1)
+        # Nodes with synthetic signals; tree_a/W.1 has no data to store.
+        self.assertEqual(self.mirror.mirror_shot(shot), 3)
+        self.assertEqual(self.mirror.mirror_shot(shot), None)
+        self.assertEqual(self.mirror.check_mirror(shot, against_primary=True), [])
+        with h5py.File(self.mirror.get_mirror_filename(1), 'r+') as mirror_file:
+            checksum = Node.objects.resolve(1, 'tree_a/x/y').path_checksum
+            mirror_file[checksum].attrs['value_sha1'] = 'x'
+        self.assertEqual(self.mirror.check_mirror(shot),
+                         ['tree_a/x/y: checksum mismatch'])
+        self.assertEqual(self.mirror.check_mirror(Shot.objects.get(number=2)),
+                         ['shot 2 is not mirrored'])
+
+    def test_finalized_shot_is_mirrored_on_read(self):
+        queued = []
+        self.patch(self.mirror, 'queue_mirror_shot', queued.append)
+        node = self.get_node(1, 'tree_a/x/y')
+        primary_value = node.read_primary_data().value
+        self.assertEqual(queued, [1])
+        # The latest shot isn't finalized, which the shot index answers.
+        node = self.get_node(2, 'tree_a/x/y')
+        node.read_primary_data()
+        with self.assertNumQueries(0):
+            node.read_primary_data()
+        self.assertEqual(queued, [1])
+        self.mirror.MirrorQueue().mirror(1)
+        self.assertTrue(os.path.exists(self.mirror.get_mirror_filename(1)))
+        data = self.get_node(1, 'tree_a/x/y').read_primary_data()
+        self.assertTrue(np.array_equal(data.value, primary_value))
+        self.assertEqual(queued, [1])
+
+def fake_evaluate_shot(shot_number, nodepath, filter_query):
+    if shot_number == 2:
+        time.sleep(0.5)
+    return shot_number, batch.pack_value(
+        np.array([1.0, np.nan, np.inf])), None
+
+class BatchTest(FakeBackendTestCase):
+
+    def test_non_finite_values_are_null(self):
+        value = batch.unpack_value(batch.pack_value(
+                np.array([[1.5, np.nan], [-np.inf, 2.0]])))
+        self.assertEqual(value, [[1.5, None], [None, 2.0]])
+        self.assertEqual(batch.unpack_value(batch.pack_value(np.nan)), None)
+
+    def use_thread_pool(self):
+        """Evaluate shots with fake_evaluate_shot in a fresh thread pool."""
+        self.patch(batch, 'evaluate_shot_in_thread', fake_evaluate_shot)
+        self.patch(batch, 'batch_workers', 3)
+        self.patch(batch, '_batch_thread_pool', None)
+        self.shm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.shm_dir)
+        self.patch(batch, 'batch_shm_dir', self.shm_dir)
+        self.patch(batch, 'batch_shm_threshold', 0)
+
+    def join_thread_pool(self):
+        pool = batch._batch_thread_pool
+        pool.close()
+        pool.join()
+
+    def test_slow_shots_time_out(self):
+        self.use_thread_pool()
+        self.patch(batch, 'batch_shot_timeout', 0.1)
+        results = list(batch.evaluate_shots([1, 2, 3], 'tree_a/x/y', ''))
+        self.join_thread_pool()
+        self.assertEqual(results, [(1, [1.0, None, None], None),
+                                   (2, None, 'Timed out'),
+                                   (3, [1.0, None, None], None)])
+        # The late value of the shot which timed out was discarded.
+        self.assertEqual(os.listdir(self.shm_dir), [])
+
+    def test_values_are_discarded_when_client_goes_away(self):
+        self.use_thread_pool()
+        results = batch.evaluate_shots([1, 2, 3], 'tree_a/x/y', '')
+        self.assertEqual(next(results), (1, [1.0, None, None], None))
+        results.close()
+        self.join_thread_pool()
+        self.assertEqual(os.listdir(self.shm_dir), [])
+
+class AddShotTest(FakeBackendTestCase):
+
+    def test_large_range_of_completed_shots(self):
+        # SQLite builds often allow only 999 query parameters, so the
+        # completed shots mustn't be looked up with a parameter per shot.
+        Shot.objects.bulk_create(
+            Shot(number=n, timestamp=datetime.datetime(2013, 1, 1))
+            for n in range(1, 1201))
+        stdout = StringIO.StringIO()
+        connection.use_debug_cursor = True
+        try:
+            call_command('addshot', '1-1201', stdout=stdout)
+            shot_queries = [q['sql'] for q in connection.queries
+                            if 'FROM "h1ds_core_shot"' in q['sql']]
+        finally:
+            connection.use_debug_cursor = None
+        self.assertTrue(all(len(sql) < 1000 for sql in shot_queries))
+        self.assertIn('Skipping 1200 completed shots', stdout.getvalue())
+        self.assertEqual(Node.objects.filter(shot__number=1201).count(), 8)
@@ -0,0 +1,174 @@
+"""Per-request timing breakdown.
+
+Code timed with the timed() context manager is recorded against the
+current request, and the timings are returned in a Server-Timing header,
+shown in  the debug toolbar  TimingPanel and optionally logged  to the
+h1ds_core.timing logger.
+
+To use,  set  H1DS_REQUEST_TIMING (and/or  H1DS_LOG_REQUEST_TIMING) and
+add  h1ds_core.timing.ServerTimingMiddleware  to  MIDDLEWARE_CLASSES.
+For the debug toolbar panel, add h1ds_core.timing.TimingPanel to
+DEBUG_TOOLBAR_PANELS  and put  ServerTimingMiddleware after  the toolbar
+middleware.
+
+When neither  setting is  on, timed()  only checks for  a timer  on the
+current thread.
+
+"""
+import json
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.utils.html import format_html, format_html_join
+
+if hasattr(settings, "H1DS_REQUEST_TIMING"):
+    request_timing = settings.H1DS_REQUEST_TIMING
+else:
+    request_timing = False
+
+if hasattr(settings, "H1DS_LOG_REQUEST_TIMING"):
+    log_request_timing = settings.H1DS_LOG_REQUEST_TIMING
+else:
+    log_request_timing = False
+
+logger = logging.getLogger('h1ds_core.timing')
+
+_local = threading.local()
+
+class RequestTimer(object):
+    """Timings recorded during one request."""
+    def __init__(self):
+        self.start = time.time()
+        self.timings = []
+
+    def add(self, name, duration, description=""):
+        self.timings.append((name, duration, description))
+
+    def get_total(self):
+        return time.time() - self.start
+
+    def get_header(self):
+        """Timings formatted for the Server-Timing header, in ms."""
+        metrics = []
+        for name, duration, description in self.timings:
+            metric = '%s;dur=%.2f' % (name, 1000*duration)
+            if description:
+                metric += ';desc="%s"' % description.replace('"', "'")
+            metrics.append(metric)
+        return ', '.join(metrics)
+
+    def as_dict(self):
+        return [{'name':name, 'duration':duration, 'description':description}
+                for name, duration, description in self.timings]
+
+class Timed(object):
+    def __init__(self, timer, name, description):
+        self.timer = timer
+        self.name = name
+        self.description = description
+
+    def __enter__(self):
+        self.t0 = time.time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timer.add(self.name, time.time() - self.t0, self.description)
+
+class NotTimed(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+not_timed = NotTimed()
+
+def timed(name, description=""):
+    """Context manager recording time taken against the current request.
+
+    name must be a token (no spaces or punctuation other than - and _).
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return not_timed
+    return Timed(timer, name, description)
+
+def get_request_timer():
+    return getattr(_local, 'timer', None)
+
+class ServerTimingMiddleware(object):
+    """Time requests and return timings in a Server-Timing header."""
+
+    def process_request(self, request):
+        if request_timing or log_request_timing:
+            _local.timer = request.h1ds_timer = RequestTimer()
+        else:
+            _local.timer = None
+
+    def process_template_response(self, request, response):
+        # Template responses (including rest framework responses) are
+        # rendered after this; time rendering up to process_response.
+        timer = getattr(_local, 'timer', None)
+        if timer is not None:
+            timer.render_start = time.time()
+        return response
+
+    def process_response(self, request, response):
+        timer = getattr(_local, 'timer', None)
+        if timer is None:
+            return response
+        _local.timer = None
+        if hasattr(timer, 'render_start'):
+            timer.add('render', time.time() - timer.render_start)
+        timer.add('total', timer.get_total())
+        if request_timing:
+            response['Server-Timing'] = timer.get_header()
+        if log_request_timing:
+            record = {'method':request.method,
+                      'path':request.get_full_path(),
+                      'status':response.status_code,
+                      'timings':timer.as_dict()}
+            logger.info(json.dumps(record), extra={'h1ds_timing':record})
+        return response
+
+try:
+    from debug_toolbar.panels import DebugPanel
+except ImportError:
+    DebugPanel = None
+
+if DebugPanel is not None:
+    class TimingPanel(DebugPanel):
+        """Debug toolbar panel showing the H1DS request timings."""
+        name = 'H1DSTiming'
+        has_content = True
+
+        def nav_title(self):
+            return 'H1DS timing'
+
+        def nav_subtitle(self):
+            timer = getattr(self, 'timer', None)
+            if timer is None:
+                return ''
+            return '%.1f ms' % (1000*timer.get_total())
+
+        def title(self):
+            return 'H1DS request timing'
+
+        def url(self):
+            return ''
+
+        def process_response(self, request, response):
+            self.timer = getattr(request, 'h1ds_timer', None)
+
+        def content(self):
+            timer = getattr(self, 'timer', None)
+            if timer is None:
+                return 'Request timing is not enabled.'
+            rows = format_html_join(
+                '', '<tr><td>{0}</td><td>{1}</td><td>{2}</td></tr>',
+                ((name, description, '%.2f' % (1000*duration))
+                 for name, duration, description in timer.timings))
+            return format_html('<table><thead><tr><th>Stage</th>'
+                               '<th>Description</th><th>Time (ms)</th>'
+                               '</tr></thead><tbody>{0}</tbody></table>', rows)
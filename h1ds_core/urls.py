@@ -2,7 +2,6 @@ from django.conf.urls.defaults import *
 
 from h1ds_core.views import homepage, logout_view, edit_profile
 from h1ds_core.views import UserMainView, WorksheetView
-from django.views.decorators.cache import cache_page
 from django.conf import settings
 
 from h1ds_core.views import ApplyFilterView, UpdateFilterView, RemoveFilterView
@@ -10,6 +9,7 @@ from h1ds_core.views import UserSignalCreateView, UserSignalDeleteView
 from h1ds_core.views import UserSignalUpdateView, ShotStreamView
 from h1ds_core.views import AJAXShotRequestURL, AJAXLatestShotView, NodeView
 from h1ds_core.views import RequestShotView, request_url, ShotListView, ShotDetailView
+from h1ds_core.views import NodeTreeView, JobView, BatchView
 
 if hasattr(settings, "H1DS_DATA_PREFIX"):
     DATA_PREFIX = settings.H1DS_DATA_PREFIX
@@ -57,12 +57,17 @@ internal_patterns =  patterns('',
     url(r'^latest_shot/$', AJAXLatestShotView.as_view(), name="h1ds-latest-shot-for-default-tree"),
     url(r'^latest_shot/(?P<tree_name>[^/]+)/$', AJAXLatestShotView.as_view(), name="h1ds-latest-shot"),
     url(r'^request_url/$', request_url, name="h1ds-request-url"),
+    url(r'^job/(?P<job_id>[0-9a-f]+)/$', JobView.as_view(), name="h1ds-job"),
     )
 
 ## Data modules
 data_patterns = patterns('',
     url(r'^$', ShotListView.as_view(), name="shot-list"),
+    url(r'^_batch/$', BatchView.as_view(), name="batch"),
     url(r'^(?P<shot>\d+)/$', ShotDetailView.as_view(), name="shot-detail"),
+    # _tree can't clash with node slugs, which start with a letter.
+    url(r'^(?P<shot>\d+)/_tree/$', NodeTreeView.as_view(), name="shot-tree"),
+    url(r'^(?P<shot>\d+)/(?P<nodepath>.+)/_tree/$', NodeTreeView.as_view(), name="node-tree"),
     url(r'^(?P<shot>\d+)/(?P<nodepath>.+)/$', NodeView.as_view(), name="node-detail"),
     )
 
@@ -20,6 +20,8 @@ Original Author: Boyd Blackwell.
 
 """
 import inspect
+import threading
+from collections import OrderedDict
 import numpy as np
 from django.utils.importlib import import_module
 from django.conf import settings
@@ -177,6 +179,128 @@ def try_discretise_array(arr, eps=0, bits=0, deltar=None, delta_encode=False):
 ##     new_shot.save()
 ##     Node.datatree.populate_shot(new_shot)
 
+class LRUCache(object):
+    """Thread-safe mapping which discards the least recently used entries.
+
+    Entries are discarded when there are more than max_entries or, if
+    max_bytes is given, when the sizes passed to set() total more than
+    max_bytes. Either limit may be None for no limit.
+
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = (value, size)
+            return value
+
+    def set(self, key, value, size=0):
+        """Store value, whose size in bytes counts towards max_bytes."""
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.n_bytes += size
+            while ((self.max_entries is not None and
+                    len(self._entries) > self.max_entries) or
+                   (self.max_bytes is not None and
+                    self.n_bytes > self.max_bytes)):
+                old_value, old_size = self._entries.popitem(last=False)[1]
+                self.n_bytes -= old_size
+
+    def _pop(self, key):
+        try:
+            value, size = self._entries.pop(key)
+        except KeyError:
+            return
+        self.n_bytes -= size
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+class FragmentCache(object):
+    """Per-process cache of rendered page fragments.
+
+    Fragments which depend only  on settings and installed apps (e.g. the
+    page header) are built on first use. They are cleared whenever a shot
+    is ingested or deleted (see h1ds_core.models); call clear() if
+    anything else they depend on changes.
+
+    """
+
+    def __init__(self):
+        self._fragments = {}
+
+    def get(self, name, build):
+        """Get fragment name, calling build() to make it if not cached."""
+        try:
+            return self._fragments[name]
+        except KeyError:
+            fragment = build()
+            self._fragments[name] = fragment
+            return fragment
+
+    def clear(self):
+        self._fragments.clear()
+
+fragment_cache = FragmentCache()
+
+class LazyModule(object):
+    """Module which is imported when one of its attributes is first used."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = import_module(self._name)
+        return getattr(self._module, attr)
+
+def parse_shot_ranges(args, max_shots=None):
+    """Return sorted shot numbers from numbers and ranges like 80000-80100.
+
+    Raises ValueError for arguments which aren't numbers or ranges, or
+    if there are more than max_shots shots.
+
+    """
+    shots = set()
+    for arg in args:
+        try:
+            if '-' in arg:
+                first, last = map(int, arg.split('-', 1))
+            else:
+                first = last = int(arg)
+        except ValueError:
+            raise ValueError('Invalid shot number or range: %s' % arg)
+        if max_shots is not None and (last - first >= max_shots or
+                                      len(shots) > max_shots):
+            raise ValueError('More than %d shots requested' % max_shots)
+        shots.update(range(first, last+1))
+    if max_shots is not None and len(shots) > max_shots:
+        raise ValueError('More than %d shots requested' % max_shots)
+    return sorted(shots)
+
 def find_subclasses(module, requested_class):
     subclasses = []
     for name, class_ in inspect.getmembers(module):
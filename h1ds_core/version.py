@@ -13,15 +13,21 @@ from subprocess import Popen, PIPE
 from os.path import abspath, dirname
 
 
+_git_sha = None
+
 def git_sha():
-    loc = abspath(dirname(__file__))
-    p = Popen(
-        "cd \"%s\" && git log -1 --format=format:%%h\ /\ %%cD" % loc,
-        shell=True,
-        stdout=PIPE,
-        stderr=PIPE
-    )
-    return p.communicate()[0]
+    """Get the latest commit of this package, running git only once."""
+    global _git_sha
+    if _git_sha is None:
+        loc = abspath(dirname(__file__))
+        p = Popen(
+            "cd \"%s\" && git log -1 --format=format:%%h\ /\ %%cD" % loc,
+            shell=True,
+            stdout=PIPE,
+            stderr=PIPE
+        )
+        _git_sha = p.communicate()[0]
+    return _git_sha
 
 
 VERSION = (1, 0, 0, 'alpha', 0)
@@ -4,17 +4,16 @@ TODO: most of the  response mixins do a check for  ndim etc, we should
 be able to refactor code to remove duplication..
 """
 import csv
+import hashlib
 import xml.etree.ElementTree as etree
 import json
-import time
 import StringIO
 import numpy as np
-import hashlib
-import pylab
 
 from django.shortcuts import render_to_response, redirect, get_object_or_404
 from django.template import RequestContext
 from django.http import HttpResponse, StreamingHttpResponse, Http404
+from django.http import HttpResponseBadRequest
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
@@ -22,35 +21,88 @@ from django.core.exceptions import PermissionDenied
 from django import forms
 from django.views.generic import View, ListView, DetailView, RedirectView
 from django.utils.decorators import method_decorator
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.conf import settings
 from django.utils.importlib import import_module
 
 from h1ds_core.models import UserSignal, UserSignalForm, Worksheet, Node, Shot
-from h1ds_core.utils import get_backend_shot_manager
-from h1ds_core.base import get_filter_list
+from h1ds_core.models import canonical_filter_chain
+from h1ds_core.utils import get_backend_shot_manager, parse_shot_ranges
+from h1ds_core.base import get_filter_list, filter_manager
+from h1ds_core.events import get_shot_event_hub, ShotEventStream
+from h1ds_core.events import shot_stream_heartbeat
+from h1ds_core.events import get_latest_shot
+from h1ds_core.cache import access_stats, get_filter_query
+from h1ds_core.cache import get_cached_data, set_cached_data
+from h1ds_core.cache import response_cache_enabled, get_response_cache_key
+from h1ds_core.cache import get_cached_response, set_cached_response
+from h1ds_core.timing import timed
+from h1ds_core.jobs import jobs_enabled, submit_filter_job, get_job, JOB_DONE
+from h1ds_core.batch import batch_stream, batch_max_shots
+from h1ds_core.version import get_version
 
 backend_shot_manager = get_backend_shot_manager()
 
-def get_shot_stream_generator():
-    shotman = backend_shot_manager()
-    def new_shot_generator():
-        latest_shot = shotman.get_latest_shot()
-        while True:
-            time.sleep(1)
-            tmp = shotman.get_latest_shot()
-            if tmp != latest_shot:
-                latest_shot = tmp
-                yield "{}\n".format(latest_shot)
-    return new_shot_generator
-    
-new_shot_generator = get_shot_stream_generator()
+# Responses for finalized shots don't change, so may be cached this long.
+if hasattr(settings, "H1DS_FINALIZED_MAX_AGE"):
+    finalized_max_age = settings.H1DS_FINALIZED_MAX_AGE
+else:
+    finalized_max_age = 365*24*60*60
+
+def get_response_validators(request, shot, *parts):
+    """Get (ETag, Last-Modified) for a response about a finalized shot.
+
+    The ETag  is taken  from the  shot  number, timestamp and version
+    (see ShotIndex.get_version), response format, code version and any
+    other parts identifying the response, so it changes if any of them
+    do. Returns (None, None) for shots which aren't finalized and for
+    html responses, which also depend on the user and session. Only the
+    shot index is used, so a request with a matching ETag is answered
+    without reading any data.
+
+    """
+    if not hasattr(request, '_h1ds_validators'):
+        validators = (None, None)
+        shot = int(shot)
+        timestamp = Shot.backend.shot_index.get_timestamp(shot)
+        response_format = request.accepted_renderer.format
+        if (timestamp is not None and response_format != 'html' and
+            Shot(number=shot).is_finalized()):
+            etag_parts = [str(shot), timestamp.isoformat(),
+                          Shot.backend.shot_index.get_version(shot),
+                          response_format, get_version()]
+            etag_parts.extend(unicode(p).encode('utf-8') for p in parts)
+            etag = hashlib.sha1('\n'.join(etag_parts)).hexdigest()
+            validators = (etag, timestamp)
+        request._h1ds_validators = validators
+    return request._h1ds_validators
+
+def validated_shot_response(get_parts=None):
+    """Decorator for  view  methods adding  ETag and Last-Modified headers.
+
+    get_parts(request, shot, *args, **kwargs) returns the parts passed to
+    get_response_validators, or None if there is no such resource.
+
+    """
+    def get_validators(request, shot, *args, **kwargs):
+        if get_parts is None:
+            parts = ()
+        else:
+            parts = get_parts(request, shot, *args, **kwargs)
+            if parts is None:
+                return (None, None)
+        return get_response_validators(request, shot, *parts)
+
+    def etag_func(*args, **kwargs):
+        return get_validators(*args, **kwargs)[0]
+
+    def last_modified_func(*args, **kwargs):
+        return get_validators(*args, **kwargs)[1]
 
-### TEMP ###
-#import h1ds_core.filters
-from h1ds_core.base import get_all_filters
-############
-all_filters = get_all_filters()
+    return method_decorator(condition(etag_func=etag_func,
+                                      last_modified_func=last_modified_func))
 
 def get_format(request, default='html'):
     """get format URI query key.
@@ -179,7 +231,7 @@ class FilterBaseView(RedirectView):
 
         # Get the actual filter function
         #filter_function = getattr(df, filter_name)
-        filter_class = all_filters[filter_name]
+        filter_class = filter_manager.filters[filter_name]
         
         # We'll append the filter to this path and redirect there.
         return_path = qdict.pop('path')[-1]
@@ -269,8 +321,53 @@ class ShotStreamView(View):
     http_method_names = ['get']
 
     def get(self, request, *args, **kwargs):
-        return StreamingHttpResponse(new_shot_generator())
+        try:
+            last_shot = int(request.META.get('HTTP_LAST_EVENT_ID'))
+        except (TypeError, ValueError):
+            last_shot = None
+        hub = get_shot_event_hub()
+        if not hub.connect():
+            response = HttpResponse('Too many shot stream clients, try again later.',
+                                    status=503, content_type='text/plain')
+            response['Retry-After'] = str(shot_stream_heartbeat)
+            return response
+        response = StreamingHttpResponse(ShotEventStream(hub, last_shot),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop nginx buffering events.
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class BatchView(View):
+    """Evaluate a node's filter chain over a range of shots.
+
+    Query keys are nodepath, shots (comma separated shot numbers or ranges,
+    e.g. 80000-90000) and the filters, as for a node. Results are streamed
+    as lines of JSON, see h1ds_core.batch.batch_stream. Shots which aren't
+    in the database are left out.
 
+    """
+
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):
+        nodepath = request.GET.get('nodepath', '').strip('/')
+        if not nodepath:
+            return HttpResponseBadRequest('nodepath is required')
+        try:
+            shot_numbers = parse_shot_ranges(request.GET.get('shots', '').split(','),
+                                             max_shots=batch_max_shots)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        shot_index = set(Shot.backend.shot_index.get_numbers())
+        shot_numbers = [s for s in shot_numbers if s in shot_index]
+        response = StreamingHttpResponse(
+            batch_stream(shot_numbers, nodepath, get_filter_query(request.GET)),
+            content_type='application/x-ndjson')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 class RequestShotView(RedirectView):
     """Redirect to shot, as requested by HTTP post."""
@@ -365,34 +462,128 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.renderers import YAMLRenderer
 from rest_framework.renderers import XMLRenderer
 from rest_framework.generics import ListAPIView
+from rest_framework.reverse import reverse
+from rest_framework.exceptions import ParseError, APIException
 from h1ds_core.serializers import NodeSerializer, ShotSerializer
 
+def get_node_validator_parts(request, shot, nodepath, format=None):
+    """Node path checksum and canonical filter chain of a node request."""
+    try:
+        node = Node.objects.resolve(shot, nodepath)
+    except (Shot.DoesNotExist, Node.DoesNotExist):
+        return None
+    return (node.path_checksum, canonical_filter_chain(request.GET))
+
+def get_tree_validator_parts(request, shot, nodepath=None, format=None):
+    return (nodepath or '', request.GET.get('depth', ''))
+
+class JobsUnavailable(APIException):
+    """async=1 was requested, but jobs need settings.H1DS_DATA_CACHE."""
+    status_code = 503
+    default_detail = 'Background jobs are not enabled.'
+
+def get_job_data(request, job):
+    """Job state for a response, with its URL and, when done, the result URL."""
+    data = dict(job)
+    data['url'] = reverse('h1ds-job', kwargs={'job_id':job['id']}, request=request)
+    if job['state'] == JOB_DONE:
+        data['result_url'] = reverse('node-detail', request=request,
+                                     kwargs={'shot':job['shot'],
+                                             'nodepath':job['nodepath']})
+        if job['filter_query']:
+            data['result_url'] += '?' + job['filter_query']
+    return data
+
+class JobView(APIView):
+    """State of a background filter job, see h1ds_core.jobs."""
+
+    renderer_classes = (JSONRenderer, YAMLRenderer, XMLRenderer,)
+
+    def get(self, request, job_id, format=None):
+        job = get_job(job_id)
+        if job is None:
+            raise Http404
+        return Response(get_job_data(request, job))
+
 class NodeView(APIView):
 
     renderer_classes = (TemplateHTMLRenderer, JSONRenderer, YAMLRenderer, XMLRenderer,)
+
+    def resolve_node(self, shot, nodepath):
+        try:
+            return Node.objects.resolve(shot, nodepath)
+        except (Shot.DoesNotExist, Node.DoesNotExist):
+            raise Http404
     
     def get_object(self, shot, nodepath):
         """Get node object for request.
 
-        TODO:  this  method  does  a   lookup  for  each  level  of  the
-        tree. There  are probably more efficient  ways...
-        Options (need to evaluate performace of each):
-        1. We  could store the full  path in the Node  table (maybe ugly
-        but faster?)
-        2. Could use filter by tree  level and slug, and while there are
-        more than 1 candidate nodes, track  back up the tree and compare
-        parent nodes.
-        
-        """
-        checksum = hashlib.sha1(nodepath).hexdigest()
+        Nodes  are resolved  through  the node  cache,  so repeated  requests
+        for a node don't query the database, see NodeManager.resolve. Filtered
+        data are taken from the data cache when available.
 
-        node = Node.objects.get(shot__number=shot, path_checksum=checksum)
-        node.data = node.read_primary_data()
+        """
+        with timed('lookup', 'Node lookup'):
+            node = self.resolve_node(shot, nodepath)
+        filter_query = get_filter_query(self.request.GET)
+        if not self.request.META.get('h1ds.warm'):
+            # Requests made by the cache warmer aren't user demand.
+            access_stats.record(nodepath, filter_query)
+        with timed('cache', 'Data cache lookup'):
+            cached_data = get_cached_data(node, filter_query)
+        if cached_data is not None:
+            node.data, node.filter_history = cached_data
+            return node
+        with timed('read', 'Primary data read'):
+            node.data = node.read_primary_data()
         node.apply_filters(self.request)
+        set_cached_data(node, filter_query)
         return node
-        
+
+    def get_response_cache_key(self, shot, nodepath):
+        """Response cache key, or None if the response shouldn't be cached.
+
+        Only  non-html  responses for  finalized  shots  are cached,  as
+        html responses depend on the user and session.
+
+        """
+        if (not response_cache_enabled() or
+            self.request.accepted_renderer.format == 'html' or
+            not Shot(number=int(shot)).is_finalized()):
+            return None
+        path_checksum = hashlib.sha1(nodepath.encode('utf-8')).hexdigest()
+        return get_response_cache_key(self.request, shot, path_checksum)
+
+    def submit_job(self, shot, nodepath):
+        """Submit a job reading and filtering the node data.
+
+        Responds  with the job state  and URL (202 Accepted), or redirects
+        to the job URL for html requests.
+
+        """
+        node = self.resolve_node(shot, nodepath)
+        job = submit_filter_job(node.shot_id, nodepath,
+                                get_filter_query(self.request.GET))
+        job_data = get_job_data(self.request, job)
+        if self.request.accepted_renderer.format == 'html':
+            return redirect(job_data['url'])
+        return Response(job_data, status=202, headers={'Location':job_data['url']})
+
+    @validated_shot_response(get_node_validator_parts)
     def get(self, request, shot, nodepath, format=None):
-        node = self.get_object(shot, nodepath)
+        if request.GET.get('async') == '1':
+            if not jobs_enabled():
+                raise JobsUnavailable()
+            return self.submit_job(shot, nodepath)
+        response_key = self.get_response_cache_key(shot, nodepath)
+        if response_key is not None:
+            with timed('response_cache', 'Response cache lookup'):
+                cached_response = get_cached_response(response_key)
+            if cached_response is not None:
+                content, content_type = cached_response
+                return HttpResponse(content, content_type=content_type)
+        with timed('get_object'):
+            node = self.get_object(shot, nodepath)
         # TODO: yaml not working yet
         # TODO: format list shoudl be maintained elsewhere... probably in settings.
         node.get_alternative_format_urls(self.request, ["html", "json", "xml"]) 
@@ -403,8 +594,13 @@ class NodeView(APIView):
             else:
                 template = "node_with_data.html"
             return Response({'node':node}, template_name='h1ds_core/'+template)
-        serializer = NodeSerializer(node)
-        return Response(serializer.data)
+        with timed('serialize'):
+            data = NodeSerializer(node).data
+        response = Response(data)
+        if response_key is not None:
+            response.add_post_render_callback(
+                lambda r: set_cached_response(response_key, r))
+        return response
             
 
 class ShotListView(ListAPIView):
@@ -431,8 +627,45 @@ class ShotDetailView(APIView):
     def get_template_names(self):
         return ("h1ds_core/shot_detail.html", )
 
+    @validated_shot_response()
     def get(self, request, shot, format=None):
         shot = self.get_object()
         serializer = self.serializer_class(shot)
         return Response(serializer.data)
         
+
+class NodeTreeView(APIView):
+    """Nested listing of  all nodes of a shot, or  a subtree of a node.
+
+    The optional depth query limits the  number of levels returned. Only
+    node metadata  is included, no signal data.  Responses for finalized
+    shots are marked as cacheable for settings.H1DS_FINALIZED_MAX_AGE.
+    """
+
+    renderer_classes = (JSONRenderer, YAMLRenderer, XMLRenderer,)
+
+    @validated_shot_response(get_tree_validator_parts)
+    def get(self, request, shot, nodepath=None, format=None):
+        try:
+            shot = Shot.objects.get(number=shot)
+        except Shot.DoesNotExist:
+            raise Http404
+        root_node = None
+        if nodepath is not None:
+            try:
+                root_node = Node.objects.resolve(shot.number, nodepath)
+            except Node.DoesNotExist:
+                raise Http404
+        depth = request.GET.get('depth', None)
+        if depth is not None:
+            try:
+                depth = int(depth)
+            except ValueError:
+                raise ParseError('depth must be an integer')
+            if depth < 0:
+                raise ParseError('depth must not be negative')
+        tree = Node.objects.get_tree_listing(shot, root_node=root_node, depth=depth)
+        response = Response({'shot':shot.number, 'nodes':tree})
+        if shot.is_finalized():
+            patch_cache_control(response, public=True, max_age=finalized_max_age)
+        return response